@@ -33,9 +33,12 @@ __license__ = "GPLv2 License"
 
 import os
 import signal
+import select
 import sys
 import threading
 import time
+import itertools
+import libxml2
 from datetime import datetime
 from distutils import sysconfig
 from rteval.modules.loads import LoadModules
@@ -43,6 +46,8 @@ from rteval.modules.measurement import MeasurementModules, MeasurementProfile
 from rteval.rtevalReport import rtevalReport
 from rteval.rtevalXMLRPC import rtevalXMLRPC
 from rteval.Log import Log
+from rteval.misc import expand_cpulist
+from rteval.settle import SettleDetector
 from rteval import rtevalConfig
 from rteval import rtevalMailer
 from rteval import version
@@ -51,13 +56,57 @@ RTEVAL_VERSION = version.RTEVAL_VERSION
 
 earlystop = False
 
+class WakeupPipe:
+    """Wakes up the measurement loop, like a threading.Event.  The modules
+    set it from their threads.  A signal handler must not: the Event lock
+    may be held by the main thread it interrupts.  The pipe is given to
+    signal.set_wakeup_fd() instead, so a signal sets it on its own"""
+
+    def __init__(self):
+        (self.__rfd, self.__wfd) = os.pipe()
+        os.set_blocking(self.__rfd, False)
+        os.set_blocking(self.__wfd, False)
+
+    def fileno(self):
+        "Returns the write end of the pipe, for signal.set_wakeup_fd()"
+        return self.__wfd
+
+    def set(self):
+        try:
+            os.write(self.__wfd, b'\0')
+        except BlockingIOError:
+            # the pipe is full, so it is set already
+            pass
+
+    def is_set(self):
+        return self.wait(0)
+
+    def wait(self, timeout=None):
+        "Waits until it is set, at most timeout seconds.  Returns True if it is set"
+        return bool(select.select([self.__rfd], [], [], timeout)[0])
+
+    def clear(self):
+        try:
+            while os.read(self.__rfd, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+
+# Wakes up the measurement loop: set by the modules when they need
+# attention, and by the stop signals
+wakeup_event = WakeupPipe()
+
+# Seconds between the liveness checks of the measurement loop
+CHECK_INTERVAL = 60.0
+
 stopsig_received = False
 def sig_handler(signum, frame):
     """ Handle SIGINT (CTRL + C) or SIGTERM (Termination signal) """
     if signum in (signal.SIGINT, signal.SIGTERM):
+        # the measurement loop is woken up through the wakeup fd
         global stopsig_received
         stopsig_received = True
-        print("*** stop signal received - stopping rteval run ***")
     else:
         raise RuntimeError("SIGNAL received! (%d)" % signum)
 
@@ -84,6 +133,7 @@ class RtEval(rtevalReport):
 
         self.__rtevcfg = self.__cfg.GetSection('rteval')
         self.__reportdir = None
+        self.__modparams = None
 
         # Import SystemInfo here, to avoid DMI warnings if RtEval() is not used
         from .sysinfo import SystemInfo
@@ -161,13 +211,34 @@ class RtEval(rtevalReport):
                   'numanodes':self._sysinfo.mem_get_numa_nodes(),
                   'duration': float(self.__rtevcfg.duration),
                   }
+        self.__modparams = params
         self._loadmods.Setup(params)
 
         self.__logger.log(Log.INFO, "Preparing measurement modules")
         self._measuremods.Setup(params)
 
 
-    def __RunMeasurementProfile(self, measure_profile):
+    def __wait_for_settle(self):
+        """Waits until the load on the load CPUs is stable, within the
+        configured bounds.  The time it took is recorded for the report"""
+        cpulist = self._loadmods._cfg.GetSection("loads").cpulist
+        metrics = [m.strip() for m in str(self.__rtevcfg.settle_metrics).split(',') if m.strip()]
+        detector = SettleDetector(cpulist and expand_cpulist(cpulist) or None,
+                                  metrics=metrics,
+                                  tolerance=float(self.__rtevcfg.settle_tolerance),
+                                  minwait=float(self.__rtevcfg.settle_min),
+                                  maxwait=float(self.__rtevcfg.settle_max),
+                                  logger=self.__logger)
+        self.__logger.log(Log.INFO, "Waiting for the load modules to settle down (%s-%s seconds)"
+                          % (self.__rtevcfg.settle_min, self.__rtevcfg.settle_max))
+        self._settle_time = detector.wait(wakeup_event)
+        self.__logger.log(Log.INFO, "Load settle wait took %.1f seconds" % self._settle_time[0])
+
+
+    def __RunMeasurementProfile(self, measure_profile, loads_running=False):
+        """Runs the modules of a measurement profile for the configured
+        duration.  With loads_running the loads have already been started
+        and settled, and are left running afterwards"""
         global earlystop
         if not isinstance(measure_profile, MeasurementProfile):
             raise Exception("measure_profile is not an MeasurementProfile object")
@@ -180,7 +251,9 @@ class RtEval(rtevalReport):
             nthreads = 0
 
             # start the loads
-            if with_loads:
+            wakeup_event.clear()
+            if with_loads and not loads_running:
+                self._loadmods.SetNotifyEvent(wakeup_event)
                 self._loadmods.Start()
 
             print("rteval run on %s started at %s" % (os.uname()[2], time.asctime()))
@@ -202,54 +275,85 @@ class RtEval(rtevalReport):
             print("Run duration: %s seconds" % str(self.__rtevcfg.duration))
 
             # start the cyclictest thread
+            measure_profile.SetNotifyEvent(wakeup_event)
             measure_profile.Start()
 
             # Unleash the loads and measurement threads
             report_interval = int(self.__rtevcfg.report_interval)
-            if with_loads:
+            if with_loads and not loads_running:
                 self._loadmods.Unleash()
                 nthreads = len(threading.enumerate())
+                self.__wait_for_settle()
+            elif with_loads:
+                nthreads = len(threading.enumerate())
             else:
                 nthreads = None
-            self.__logger.log(Log.INFO, "Waiting 30 seconds to let load modules settle down")
-            time.sleep(30)
+                self.__wait_for_settle()
+            duration = float(self.__rtevcfg.duration)
+            needed = measure_profile.Calibrate(duration)
+            if needed is not None and needed < duration:
+                if self.__rtevcfg.calibrate_shorten:
+                    self.__logger.log(Log.INFO,
+                                      "Calibration shows %d seconds are enough, shortening the run"
+                                      % needed)
+                    duration = needed
+                else:
+                    self.__logger.log(Log.INFO, "Calibration shows %d seconds are enough, "
+                                      "keeping the duration of %d seconds" % (needed, duration))
             measure_profile.Unleash()
             measure_start = datetime.now()
 
-            # wait for time to expire or thread to die
+            # wait for time to expire, a thread to die or a stop signal.  The
+            # modules and the signal handler wake us up at once, the timers
+            # are only for the regular checks and the progress reports
             signal.signal(signal.SIGINT, sig_handler)
             signal.signal(signal.SIGTERM, sig_handler)
-            self.__logger.log(Log.INFO, "waiting for duration (%s)" % str(self.__rtevcfg.duration))
-            stoptime = (time.time() + float(self.__rtevcfg.duration))
+            signal.set_wakeup_fd(wakeup_event.fileno())
+            self.__logger.log(Log.INFO, "waiting for duration (%s)" % str(duration))
+            stoptime = (time.time() + duration)
             currtime = time.time()
+            checktime = currtime + CHECK_INTERVAL
             rpttime = currtime + report_interval
             load_avg_checked = 5
-            while (currtime <= stoptime) and not stopsig_received:
-                time.sleep(60.0)
+            while (currtime < stoptime) and not stopsig_received:
+                wakeup_event.wait(max(0, min(stoptime, checktime, rpttime) - currtime))
+                wakeup_event.clear()
+                currtime = time.time()
+                if stopsig_received:
+                    break
+
                 if not measure_profile.isAlive():
                     stoptime = currtime
                     earlystop = True
                     self.__logger.log(Log.WARN,
                                       "Measurement threads did not use the full time slot. Doing a controlled stop.")
+                elif measure_profile.isConverged():
+                    stoptime = currtime
+                    self.__logger.log(Log.INFO,
+                                      "Measurement results have converged. Stopping the run early.")
 
                 if with_loads:
                     if len(threading.enumerate()) < nthreads:
                         raise RuntimeError("load thread died!")
 
-                if not load_avg_checked:
-                    self._loadmods.SaveLoadAvg()
-                    load_avg_checked = 5
-                else:
-                    load_avg_checked -= 1
+                if currtime >= checktime:
+                    checktime = currtime + CHECK_INTERVAL
+                    if not load_avg_checked:
+                        self._loadmods.SaveLoadAvg()
+                        load_avg_checked = 5
+                    else:
+                        load_avg_checked -= 1
 
                 if currtime >= rpttime:
                     left_to_run = stoptime - currtime
                     self.__show_remaining_time(left_to_run)
                     rpttime = currtime + report_interval
                     print("load average: %.2f" % self._loadmods.GetLoadAvg())
-                currtime = time.time()
 
             self.__logger.log(Log.DEBUG, "out of measurement loop")
+            if stopsig_received:
+                print("*** stop signal received - stopping rteval run ***")
+            signal.set_wakeup_fd(-1)
             signal.signal(signal.SIGINT, signal.SIG_DFL)
             signal.signal(signal.SIGTERM, signal.SIG_DFL)
 
@@ -262,7 +366,7 @@ class RtEval(rtevalReport):
             measure_profile.Stop()
 
             # stop the loads
-            if with_loads:
+            if with_loads and not loads_running:
                 self._loadmods.Stop()
 
         print("stopping run at %s" % time.asctime())
@@ -273,10 +377,182 @@ class RtEval(rtevalReport):
         return measure_start
 
 
+    def __sweep_matrix(self):
+        """Returns the parameter settings of all the sweep combinations, each as a
+        list of (module, option, value) tuples, or None if no sweep is configured.
+        The [sweep] config section has a comma separated list of values for
+        each swept module option, named as on the command line (e.g.
+        cyclictest-interval: 100,200,500), and the repeat count"""
+        if not self.__cfg.HasSection('sweep'):
+            return None
+
+        axes = []
+        for (key, values) in sorted(self.__cfg.GetSection('sweep').items()):
+            if key in ('repeat', 'keep_loads_running'):
+                continue
+            if '-' not in key:
+                raise RuntimeError("sweep parameter '%s' is not of the form module-option" % key)
+            (module, option) = key.split('-', 1)
+            if not self.__cfg.HasSection(module):
+                raise RuntimeError("sweep parameter '%s': unknown module '%s'" % (key, module))
+            axes.append([(module, option, v.strip()) for v in str(values).split(',') if v.strip()])
+        return [list(c) for c in itertools.product(*axes)]
+
+
+    def __start_sweep_loads(self):
+        "Starts the loads of a sweep and waits for them to settle"
+        self._loadmods.SetNotifyEvent(wakeup_event)
+        self._loadmods.Start()
+        self._loadmods.Unleash()
+        self.__wait_for_settle()
+
+
+    def __MeasureSweep(self, matrix):
+        """Runs the measurements once for each parameter combination of the
+        sweep, as many times as the sweep is repeated.  The loads are built,
+        started and settled once, and keep running through all iterations,
+        unless keep_loads_running in the [sweep] section is off: then fresh
+        loads are started and settled for each iteration, and stopped after
+        it.  Each iteration writes a complete report into its own directory in the
+        report directory, the summary report holds the overview and the
+        cyclictest results of each combination combined over the repeats"""
+        from rteval.modules.measurement import cyclictest
+
+        repeat = int(self.__cfg.GetSection('sweep').repeat or 1)
+        keep_loads = str(self.__cfg.GetSection('sweep').keep_loads_running or 'yes').lower() \
+            not in ('0', 'no', 'false', 'off')
+        niter = repeat * len(matrix)
+        sweep_n = libxml2.newNode('sweep')
+        sweep_n.newProp('iterations', str(niter))
+        sweep_n.newProp('repeat', str(repeat))
+        combos = []
+        for (i, settings) in enumerate(matrix):
+            comb_n = sweep_n.newChild(None, 'combination', None)
+            comb_n.newProp('id', str(i + 1))
+            for (module, option, value) in settings:
+                set_n = comb_n.newChild(None, 'setting', None)
+                set_n.newProp('module', module)
+                set_n.newProp('option', option)
+                set_n.newProp('value', value)
+            combos.append((comb_n, []))
+
+        self.__logger.log(Log.INFO, "Sweeping %d parameter combinations, %d iterations"
+                          % (len(matrix), niter))
+        loads_running = False
+        if keep_loads:
+            self.__start_sweep_loads()
+            loads_running = True
+
+        measure_start = None
+        iterreports = []
+        iteration = 0
+        try:
+            # Repeats are the outer loop, so slow drifts of the system are
+            # spread over all the combinations
+            for rep in range(1, repeat + 1):
+                for (i, settings) in enumerate(matrix):
+                    iteration += 1
+                    print("sweep iteration %d/%d: %s" % (iteration, niter,
+                          " ".join(["--%s-%s=%s" % s for s in settings]) or "(repeat %d)" % rep))
+                    for (module, option, value) in settings:
+                        setattr(self.__cfg.GetSection(module), option, value)
+                    if not keep_loads:
+                        if iteration > 1:
+                            # the module threads of the last iteration are done
+                            self._loadmods = LoadModules(self.__cfg, logger=self.__logger)
+                            self._loadmods.Setup(self.__modparams)
+                        self.__start_sweep_loads()
+                        loads_running = True
+
+                    iterdir = os.path.join(self.__reportdir, "sweep-%03d" % iteration)
+                    os.mkdir(iterdir)
+                    os.mkdir(os.path.join(iterdir, "logs"))
+                    params = dict(self.__modparams)
+                    params['reportdir'] = iterdir
+                    measuremods = MeasurementModules(self.__cfg, self.__logger)
+                    measuremods.Setup(params)
+
+                    iter_start = None
+                    for meas_prf in measuremods:
+                        if not meas_prf.GetProfile()[0]:
+                            self.__logger.log(Log.WARN, "measurement profile without loads "
+                                              "runs with the sweep loads running")
+                        mstart = self.__RunMeasurementProfile(meas_prf, loads_running=True)
+                        if iter_start is None:
+                            iter_start = mstart
+                    if measure_start is None:
+                        measure_start = iter_start
+                    if not keep_loads:
+                        loads_running = False
+                        self._loadmods.Stop()
+
+                    (comb_n, files) = combos[i]
+                    it_n = libxml2.newNode('iteration')
+                    it_n.newProp('number', str(iteration))
+                    it_n.newProp('combination', str(i + 1))
+                    it_n.newProp('repeat', str(rep))
+                    it_n.newProp('start', str(iter_start))
+                    for (module, option, value) in settings:
+                        set_n = it_n.newChild(None, 'setting', None)
+                        set_n.newProp('module', module)
+                        set_n.newProp('option', option)
+                        set_n.newProp('value', value)
+                    fname = os.path.join(iterdir, "summary.xml")
+                    report = self._iteration_report(iter_start, measuremods, it_n, fname)
+                    if self.__xmlrpc:
+                        iterreports.append(report)
+                    files.append(fname)
+
+                    sum_n = comb_n.newChild(None, 'iteration', None)
+                    sum_n.newProp('number', str(iteration))
+                    sum_n.newProp('repeat', str(rep))
+                    sum_n.newProp('report', os.path.relpath(fname, self.__reportdir))
+                    if stopsig_received or earlystop:
+                        break
+                if stopsig_received or earlystop:
+                    break
+        finally:
+            if loads_running:
+                self._loadmods.Stop()
+
+        # Combine the cyclictest histograms of the repeats of each combination
+        if self.__cfg.HasSection('cyclictest'):
+            percentiles = self.__cfg.GetSection('cyclictest').percentiles
+            for (comb_n, files) in combos:
+                if not files:
+                    continue
+                try:
+                    comb_n.addChild(cyclictest.AggregateReports(files, self.__logger.log,
+                                                                percentiles))
+                except (RuntimeError, ValueError) as err:
+                    self.__logger.log(Log.WARN, "can't combine the results of sweep "
+                                      "combination %s: %s" % (comb_n.prop('id'), err))
+
+        return (measure_start, sweep_n, iterreports)
+
+
     def Measure(self):
         """ Run the full measurement suite with reports """
         global earlystop
         rtevalres = 0
+
+        matrix = self.__sweep_matrix()
+        if matrix is not None:
+            (measure_start, sweep_n, iterreports) = self.__MeasureSweep(matrix)
+            self._report(measure_start, self.__rtevcfg.xslt_report, sweep_n)
+            if self.__rtevcfg.sysreport:
+                self._sysinfo.run_sysreport(self.__reportdir)
+
+            # Each iteration is a complete run of its own for the XML-RPC server
+            for report in iterreports:
+                rtevalres = max(rtevalres, self.__xmlrpc.SendReport(report.GetXMLdocument()))
+
+            if earlystop:
+                rtevalres = 1
+            self._sysinfo.copy_dmesg(self.__reportdir)
+            self._tar_results()
+            return rtevalres
+
         measure_start = None
         for meas_prf in self._measuremods:
             mstart = self.__RunMeasurementProfile(meas_prf)
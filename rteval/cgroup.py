@@ -0,0 +1,302 @@
+#
+#   cgroup.py - cgroup v2 groups holding the load processes
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with this program; if not, write to the Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+#   For the avoidance of doubt the "preferred form" of this code is one which
+#   is in an open unpatent encumbered format. Where cryptographic key signing
+#   forms part of the process of creating an executable the information
+#   including keys needed to generate an equivalently functional executable
+#   are deemed to be part of the source code.
+#
+
+import os
+import sys
+import glob
+import time
+import signal
+import threading
+import subprocess
+from rteval.Log import Log
+
+CGROUP_ROOT = '/sys/fs/cgroup'
+
+# Controllers enabled for the load groups
+CGROUP_CONTROLLERS = ('cpuset', 'cpu', 'memory')
+
+# Prefix of the group of a rteval run, followed by the pid of rteval
+CGROUP_PREFIX = 'rteval-'
+
+_toplock = threading.RLock()
+
+
+def _enable_controllers(path):
+    "Enables the controllers for the child groups of path, as far as possible"
+    for ctrl in CGROUP_CONTROLLERS:
+        try:
+            with open(os.path.join(path, 'cgroup.subtree_control'), 'w') as f:
+                f.write('+%s' % ctrl)
+        except OSError:
+            pass
+
+
+class LoadCgroup:
+    """A cgroup v2 group for the processes of a load module.  The groups of
+    a run are created below CGROUP_ROOT/rteval-<pid>.  The cpuset of a group
+    binds its processes to CPUs and memory nodes without any taskset or
+    numactl wrapper, kill() ends all of them at once and stat() returns
+    the accounting of all the processes which ever ran in the group"""
+
+    def __init__(self, path, logfnc=None):
+        self.path = path
+        self.__logfnc = logfnc
+
+
+    def __log(self, logtype, msg):
+        if self.__logfnc:
+            self.__logfnc(logtype, msg)
+
+
+    def __write(self, fname, value):
+        with open(os.path.join(self.path, fname), 'w') as f:
+            f.write(value)
+
+
+    @staticmethod
+    def supported():
+        "Returns True if the cgroup v2 hierarchy with the cpuset controller is mounted"
+        try:
+            with open(os.path.join(CGROUP_ROOT, 'cgroup.controllers')) as f:
+                return 'cpuset' in f.read().split()
+        except OSError:
+            return False
+
+
+    @staticmethod
+    def top():
+        "Returns the path of the group of this rteval run"
+        return os.path.join(CGROUP_ROOT, '%s%d' % (CGROUP_PREFIX, os.getpid()))
+
+
+    @classmethod
+    def remove_stale(cls, logfnc=None):
+        "Removes the groups, and kills the processes, left behind by aborted runs"
+        for path in glob.glob(os.path.join(CGROUP_ROOT, CGROUP_PREFIX + '*')):
+            try:
+                pid = int(os.path.basename(path)[len(CGROUP_PREFIX):])
+            except ValueError:
+                continue
+            if pid != os.getpid() and not os.path.exists('/proc/%d' % pid):
+                if logfnc:
+                    logfnc(Log.INFO, "removing %s left behind by an aborted run" % path)
+                cls(path, logfnc).remove()
+
+
+    @classmethod
+    def create(cls, name, cpus=None, mems=None, logfnc=None):
+        """Creates the group of a load module, bound to the cpus and the memory
+        nodes mems when given.  Returns None if cgroup v2 cannot be used"""
+        if not cls.supported():
+            return None
+        try:
+            with _toplock:
+                top = cls.top()
+                if not os.path.isdir(top):
+                    cls.remove_stale(logfnc)
+                    _enable_controllers(CGROUP_ROOT)
+                    os.mkdir(top)
+                    _enable_controllers(top)
+            return cls(top, logfnc).child(name, cpus, mems)
+        except OSError as err:
+            if logfnc:
+                logfnc(Log.DEBUG, "not using cgroup v2: %s" % err)
+            return None
+
+
+    def child(self, name, cpus=None, mems=None):
+        "Creates a child group, bound to cpus and the memory nodes mems when given"
+        _enable_controllers(self.path)
+        grp = LoadCgroup(os.path.join(self.path, name), self.__logfnc)
+        os.mkdir(grp.path)
+        try:
+            if cpus:
+                grp.__write('cpuset.cpus', ",".join([str(c) for c in cpus]))
+            if mems:
+                grp.__write('cpuset.mems', ",".join([str(m) for m in mems]))
+        except OSError:
+            grp.remove()
+            raise
+        return grp
+
+
+    def attach(self, pid):
+        "Moves the process pid into the group"
+        self.__write('cgroup.procs', str(pid))
+
+
+    def popen(self, args, **kwargs):
+        """Starts a process in the group, with the arguments of subprocess.Popen.
+        A preexec_fn is not safe in a threaded program and forces the slow
+        fork path, so rteval moves the process into the group itself: it
+        starts as a shell waiting on a pipe, which runs args once its pid is
+        in the group.  Nothing the process starts can end up outside"""
+        if kwargs.pop('shell', False):
+            args = ['/bin/sh', '-c', args]
+        (rfd, wfd) = os.pipe()
+        try:
+            proc = subprocess.Popen(['/bin/sh', '-c',
+                                     'read -r go <&%d || exit 1; exec %d<&-; exec "$@"'
+                                     % (rfd, rfd), 'sh'] + list(args),
+                                    pass_fds=(rfd,), **kwargs)
+        finally:
+            os.close(rfd)
+        try:
+            self.attach(proc.pid)
+            os.write(wfd, b'go\n')
+        except OSError:
+            # the shell exits on end of file without running args
+            os.close(wfd)
+            proc.wait()
+            raise
+        os.close(wfd)
+        return proc
+
+
+    def pids(self):
+        "Returns the pids of all the processes in the group and its children"
+        pids = []
+        for (dirpath, dirnames, filenames) in os.walk(self.path):
+            try:
+                with open(os.path.join(dirpath, 'cgroup.procs')) as f:
+                    pids.extend([int(p) for p in f.read().split()])
+            except OSError:
+                pass
+        return pids
+
+
+    def populated(self):
+        "Returns True if there are processes in the group or its children"
+        try:
+            with open(os.path.join(self.path, 'cgroup.events')) as f:
+                for line in f:
+                    if line.startswith('populated'):
+                        return line.split()[1] == '1'
+        except OSError:
+            pass
+        return len(self.pids()) > 0
+
+
+    def kill(self):
+        "Kills all the processes in the group and its children"
+        try:
+            self.__write('cgroup.kill', '1')
+        except OSError:
+            # cgroup.kill is new in Linux 5.14
+            for pid in self.pids():
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except OSError:
+                    pass
+
+
+    def memory_current(self):
+        "Returns the memory used by the group in bytes"
+        with open(os.path.join(self.path, 'memory.current')) as f:
+            return int(f.read())
+
+
+    def set_memory_high(self, limit):
+        """Throttles the processes of the group and reclaims from them when
+        the group uses more than limit bytes, without a limit for None"""
+        self.__write('memory.high', limit is None and 'max' or str(limit))
+
+
+    def stat(self):
+        """Returns the counters of cpu.stat and memory.stat, and memory.peak
+        if the kernel provides it"""
+        stats = {}
+        for fname in ('cpu.stat', 'memory.stat'):
+            try:
+                with open(os.path.join(self.path, fname)) as f:
+                    for line in f:
+                        (key, val) = line.split()
+                        stats[key] = int(val)
+            except (OSError, ValueError):
+                pass
+        try:
+            with open(os.path.join(self.path, 'memory.peak')) as f:
+                stats['memory.peak'] = int(f.read())
+        except (OSError, ValueError):
+            pass
+        return stats
+
+
+    def remove(self, timeout=5.0):
+        """Kills the processes in the group and removes it with its children.
+        The group of the run is removed as well once it is empty"""
+        if not os.path.isdir(self.path):
+            return
+        self.kill()
+        deadline = time.time() + timeout
+        while self.populated() and time.time() < deadline:
+            time.sleep(0.01)
+        for (dirpath, dirnames, filenames) in os.walk(self.path, topdown=False):
+            try:
+                os.rmdir(dirpath)
+            except OSError as err:
+                self.__log(Log.WARN, "could not remove %s: %s" % (dirpath, err))
+        with _toplock:
+            try:
+                os.rmdir(self.top())
+            except OSError:
+                # other loads are still running in it
+                pass
+
+
+def unit_test(rootdir):
+    import subprocess
+
+    if not LoadCgroup.supported() or os.geteuid() != 0:
+        print("cgroup v2 is not available, skipping")
+        return 0
+
+    try:
+        grp = LoadCgroup.create('unittest', cpus=[0], mems=[0])
+        if grp is None:
+            print("cgroup v2 is not usable, skipping")
+            return 0
+        node = grp.child('node0')
+        proc = node.popen(['sleep', '60'])
+        print("pids in the group: %s" % grp.pids())
+        if grp.pids() != [proc.pid]:
+            return 1
+        grp.kill()
+        proc.wait()
+        print("returncode after kill: %d" % proc.returncode)
+        if proc.returncode != -signal.SIGKILL:
+            return 1
+        if 'usage_usec' not in grp.stat():
+            return 1
+        grp.remove()
+        if os.path.exists(grp.path):
+            return 1
+        return 0
+    except Exception as e:
+        print("** EXCEPTION %s" % str(e))
+        return 1
+
+
+if __name__ == '__main__':
+    sys.exit(unit_test('..'))
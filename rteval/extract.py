@@ -0,0 +1,216 @@
+#
+#   extract.py - streaming extraction of compressed tarballs
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with this program; if not, write to the Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+#   For the avoidance of doubt the "preferred form" of this code is one which
+#   is in an open unpatent encumbered format. Where cryptographic key signing
+#   forms part of the process of creating an executable the information
+#   including keys needed to generate an equivalently functional executable
+#   are deemed to be part of the source code.
+#
+
+import os
+import sys
+import time
+import queue
+import shutil
+import signal
+import tarfile
+import threading
+import subprocess
+from rteval.Log import Log
+
+BLOCKSIZE = 1024 * 1024
+
+# Decompressors per compression, the multi-threaded ones first
+DECOMPRESSORS = {
+    'xz':  [['xz', '-d', '-c', '-T0'], ['xz', '-d', '-c']],
+    'zst': [['zstd', '-d', '-c', '-T0'], ['zstd', '-d', '-c']],
+    'gz':  [['pigz', '-d', '-c'], ['gzip', '-d', '-c']],
+    'bz2': [['lbzip2', '-d', '-c'], ['pbzip2', '-d', '-c'], ['bzip2', '-d', '-c']],
+}
+
+SUFFIXES = (('.xz', 'xz'), ('.txz', 'xz'),
+            ('.zst', 'zst'), ('.tzst', 'zst'),
+            ('.gz', 'gz'), ('.tgz', 'gz'),
+            ('.bz2', 'bz2'), ('.tbz2', 'bz2'), ('.tbz', 'bz2'))
+
+
+def compression(path):
+    "Returns the compression of a tarball from its name, or None"
+    for (suffix, comp) in SUFFIXES:
+        if path.endswith(suffix):
+            return comp
+    return None
+
+
+def _python_decompressor(comp, path):
+    "Returns a file object reading the decompressed data with the python modules"
+    if comp == 'xz':
+        import lzma
+        return lzma.open(path)
+    if comp == 'gz':
+        import gzip
+        return gzip.open(path)
+    if comp == 'bz2':
+        import bz2
+        return bz2.open(path)
+    if comp == 'zst':
+        try:
+            import zstandard
+        except ImportError:
+            raise RuntimeError("no zstd decompressor found for %s" % path)
+        return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True)
+    return open(path, 'rb')
+
+
+class _QueueReader:
+    """File object reading the blocks a decompressor thread puts in a
+    queue, so decompressing and writing out the files overlap"""
+
+    def __init__(self, fileobj):
+        self.__queue = queue.Queue(maxsize=16)
+        self.__buf = bytearray()
+        self.__eof = False
+        self.__error = None
+        self.size = 0
+        self.__thread = threading.Thread(target=self.__decompress, args=(fileobj,),
+                                         name="decompressor", daemon=True)
+        self.__thread.start()
+
+
+    def __decompress(self, fileobj):
+        try:
+            with fileobj:
+                for block in iter(lambda: fileobj.read(BLOCKSIZE), b''):
+                    self.__queue.put(block)
+        except Exception as err:
+            self.__error = err
+        self.__queue.put(None)
+
+
+    def read(self, size=-1):
+        while not self.__eof and (size < 0 or len(self.__buf) < size):
+            block = self.__queue.get()
+            if block is None:
+                self.__eof = True
+                if self.__error:
+                    raise self.__error
+            else:
+                self.__buf += block
+                self.size += len(block)
+        if size < 0:
+            size = len(self.__buf)
+        # deleting from the front of a bytearray does not copy the rest
+        data = bytes(self.__buf[:size])
+        del self.__buf[:size]
+        return data
+
+
+def extract_tarball(path, destdir, logger=None, usepython=False):
+    """Extracts a tarball into destdir.  The output of a multi-threaded
+    decompressor, when one is installed (xz -T0, zstd, pigz, lbzip2 or
+    pbzip2), is piped straight into tar.  Otherwise, or with usepython, the
+    tarfile module extracts it while a thread decompresses it.  Logs the
+    throughput and returns the number of decompressed bytes, None when the
+    decompressed stream bypasses rteval"""
+    def log(logtype, msg):
+        if logger:
+            logger.log(logtype, "[extract] %s" % msg)
+
+    comp = compression(path)
+    cmd = None
+    if comp and not usepython:
+        for c in DECOMPRESSORS[comp]:
+            if shutil.which(c[0]):
+                cmd = c
+                break
+
+    start = time.time()
+    if cmd:
+        decomp = subprocess.Popen(cmd + [path], stdout=subprocess.PIPE)
+        try:
+            tar = subprocess.Popen(['tar', '-C', destdir, '-x', '-f', '-'], stdin=decomp.stdout)
+        finally:
+            # only tar holds the pipe, so the decompressor gets SIGPIPE if
+            # tar exits early
+            decomp.stdout.close()
+        ret = tar.wait()
+        if decomp.wait() and decomp.returncode != -signal.SIGPIPE:
+            raise RuntimeError("'%s' failed (ret=%d)" % (" ".join(cmd), decomp.returncode))
+        size = None
+        method = " ".join(cmd[:1] + cmd[3:])
+    elif not comp and not usepython:
+        ret = subprocess.call(['tar', '-C', destdir, '-x', '-f', path])
+        size = os.path.getsize(path)
+        method = "tar"
+    else:
+        reader = _QueueReader(_python_decompressor(comp, path))
+        with tarfile.open(fileobj=reader, mode='r|') as tar:
+            if hasattr(tarfile, 'data_filter'):
+                tar.extractall(destdir, filter='data')
+            else:
+                tar.extractall(destdir)
+        ret = 0
+        size = reader.size
+        method = "python %s" % (comp or "tarfile")
+    if ret:
+        raise RuntimeError("extracting %s failed (ret=%d)" % (path, ret))
+
+    secs = max(time.time() - start, 1e-6)
+    compressed = os.path.getsize(path) / 1e6 / secs
+    if size is None:
+        log(Log.DEBUG, "extracted %s with %s in %.2f seconds, %.1f MB/s compressed"
+            % (os.path.basename(path), method, secs, compressed))
+    else:
+        log(Log.DEBUG, "extracted %s with %s: %.1f MB in %.2f seconds, %.1f MB/s (%.1f MB/s compressed)"
+            % (os.path.basename(path), method, size / 1e6, secs, size / 1e6 / secs, compressed))
+    return size
+
+
+def unit_test(rootdir):
+    import tempfile
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        srcdir = os.path.join(tmpdir, 'src')
+        os.makedirs(os.path.join(srcdir, 'tree', 'sub'))
+        with open(os.path.join(srcdir, 'tree', 'sub', 'file'), 'w') as f:
+            f.write("x" * 100000)
+        os.symlink('sub/file', os.path.join(srcdir, 'tree', 'link'))
+
+        modes = {'tree.tar': 'w', 'tree.tar.gz': 'w:gz', 'tree.tar.bz2': 'w:bz2', 'tree.tar.xz': 'w:xz'}
+        for (name, mode) in modes.items():
+            with tarfile.open(os.path.join(tmpdir, name), mode) as tar:
+                tar.add(os.path.join(srcdir, 'tree'), arcname='tree')
+            for usepython in (False, True):
+                dest = tempfile.mkdtemp(dir=tmpdir)
+                size = extract_tarball(os.path.join(tmpdir, name), dest, usepython=usepython)
+                with open(os.path.join(dest, 'tree', 'link')) as f:
+                    ok = len(f.read()) == 100000
+                print("%s (python: %s): %s bytes, %s" % (name, usepython, size, ok and "ok" or "FAILED"))
+                if not ok or size is not None and size < 100000:
+                    return 1
+        return 0
+    except Exception as e:
+        print("** EXCEPTION %s" % str(e))
+        return 1
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    sys.exit(unit_test('..'))
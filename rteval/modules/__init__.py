@@ -22,9 +22,10 @@
 #   are deemed to be part of the source code.
 #
 
-import time
+import os
 from datetime import datetime
 import threading
+import selectors
 import optparse
 import libxml2
 from rteval.Log import Log
@@ -54,12 +55,26 @@ class rtevalModulePrototype(threading.Thread):
         self.__logger = logger
         self.__ready = False
         self.__runtimeError = False
+        self.__converged = None
         self.__events = {"start": threading.Event(),
                          "stop": threading.Event(),
-                         "finished": threading.Event()}
+                         "finished": threading.Event(),
+                         "ready": threading.Event(),
+                         "released": threading.Event()}
         self._donotrun = False
         self.__timestamps = {}
         self.__sleeptime = 2.0
+        # set when something the main loop should look at happens
+        self.__notify = None
+        # written to by setStop() and _Wakeup(), wakes up the workload loop.
+        # The lock keeps the pipe from being closed during a write
+        self.__stoppipe = None
+        self.__pipelock = threading.Lock()
+        # the selector of the workload loop, the pidfds of the children it
+        # watches and the children whose exit was already reported
+        self.__selector = None
+        self.__watched = {}
+        self.__reported = set()
 
 
     def _log(self, logtype, msg):
@@ -78,6 +93,18 @@ class rtevalModulePrototype(threading.Thread):
     def _setReady(self, state=True):
         """ Sets the ready flag for the module """
         self.__ready = state
+        if state:
+            self.__events["ready"].set()
+        else:
+            self.__events["ready"].clear()
+
+
+    def WaitForReady(self, wtime=None):
+        """ Blocks until the module is ready to run or had a RuntimeError.
+        Returns False if it is still not ready after wtime seconds """
+        if self._donotrun:
+            return True
+        return self.__events["ready"].wait(wtime)
 
 
     def hadRuntimeError(self):
@@ -88,11 +115,49 @@ class rtevalModulePrototype(threading.Thread):
     def _setRuntimeError(self, state=True):
         """ Sets the runtimeError flag for the module """
         self.__runtimeError = state
+        if state:
+            # don't leave anyone waiting for the module to get ready
+            self.__events["ready"].set()
+            self._notify()
+
+
+    def isConverged(self):
+        """ Returns True if the results of the module will not improve by
+        running longer, None if the module does not track this """
+        return self.__converged
+
+
+    def _setConverged(self, state=True):
+        """ Sets the converged flag for the module """
+        self.__converged = state
+        if state:
+            self._notify()
+
+
+    def SetNotifyEvent(self, event):
+        """ Sets an event, like a threading.Event, the module sets when the
+        main loop should check on it: it failed, converged, stopped running
+        or a child process of its workload exited """
+        self.__notify = event
+
+
+    def _notify(self):
+        """ Wakes up the main loop, if it waits for this module """
+        if self.__notify is not None:
+            self.__notify.set()
+
+
+    def _setTaskInterval(self, interval):
+        """ Sets the seconds between the _WorkloadTask() calls of the running
+        workload.  With None, _WorkloadTask() is only called again when a
+        process returned by _WorkloadChildren() exits """
+        self.__sleeptime = interval
 
 
     def setStart(self):
         """ Sets the start event state """
         self.__events["start"].set()
+        self.__events["released"].set()
         self.__timestamps["start_set"] = datetime.now()
 
 
@@ -104,7 +169,20 @@ class rtevalModulePrototype(threading.Thread):
     def setStop(self):
         """ Sets the stop event state """
         self.__events["stop"].set()
+        self.__events["released"].set()
         self.__timestamps["stop_set"] = datetime.now()
+        self._Wakeup()
+
+
+    def _Wakeup(self):
+        """ Makes the running workload loop call _WorkloadTask() right away """
+        with self.__pipelock:
+            if self.__stoppipe is not None:
+                try:
+                    os.write(self.__stoppipe[1], b'x')
+                except BlockingIOError:
+                    # plenty of wakeups pending already
+                    pass
 
 
     def shouldStop(self):
@@ -160,6 +238,13 @@ class rtevalModulePrototype(threading.Thread):
         raise NotImplementedError("WorkloadAlive() method must be implemented in the %s module" % self._name)
 
 
+    def _WorkloadChildren(self):
+        """ Optional module method, returns the subprocess.Popen objects of the
+        running workload.  _WorkloadTask() is called as soon as one of them exits
+        """
+        return []
+
+
     def _WorkloadCleanup(self):
         """ Required module method, which will be run after the _WorkloadTask()
         has completed or been aborted by the 'stop event flag'
@@ -167,13 +252,90 @@ class rtevalModulePrototype(threading.Thread):
         raise NotImplementedError("_WorkloadCleanup() method must be implemented in the %s module" % self._name)
 
 
+    def Calibrate(self, duration):
+        """ Optional module method, called with the loads running just before
+        the module is unleashed.  duration is the configured run duration,
+        returns the run duration in seconds the module needs or None
+        """
+        return None
+
+
     def WorkloadWillRun(self):
         "Returns True if this workload will be run"
         return self._donotrun is False
 
 
+    def __unwatch(self, proc):
+        "Stops watching a child process"
+        pidfd = self.__watched.pop(proc)
+        if pidfd is not None:
+            self.__selector.unregister(pidfd)
+            os.close(pidfd)
+
+
+    def __wait_for_events(self):
+        """ Waits until the next _WorkloadTask() call is due: the task interval
+        passed, a child process of the workload exited or the module was
+        stopped.  Returns True if a child process exited.  The exit of each
+        child is only reported once, and the pidfds of the children are kept
+        in the selector for as long as they are returned by _WorkloadChildren() """
+        timeout = self.__sleeptime
+        children = self._WorkloadChildren()
+        for proc in [p for p in self.__watched if p not in children]:
+            self.__unwatch(proc)
+        self.__reported.intersection_update(children)
+
+        exited = False
+        for proc in children:
+            if proc in self.__reported:
+                continue
+            # Not using proc.poll() here, the process must be left for
+            # the module to reap
+            if proc.returncode is not None:
+                if proc in self.__watched:
+                    self.__unwatch(proc)
+                self.__reported.add(proc)
+                exited = True
+                continue
+            if proc in self.__watched:
+                continue
+            try:
+                pidfd = os.pidfd_open(proc.pid)
+            except ProcessLookupError:
+                self.__reported.add(proc)
+                exited = True
+                continue
+            except (AttributeError, OSError):
+                # No pidfd support, notice exits by polling
+                pidfd = None
+            self.__watched[proc] = pidfd
+            if pidfd is not None:
+                self.__selector.register(pidfd, selectors.EVENT_READ, proc)
+        if exited:
+            return True
+
+        if None in self.__watched.values():
+            timeout = timeout or 2.0
+        for (key, mask) in self.__selector.select(timeout):
+            if key.data is None:
+                os.read(self.__stoppipe[0], 512)
+            else:
+                self.__unwatch(key.data)
+                self.__reported.add(key.data)
+                exited = True
+        return exited
+
+
     def run(self):
         "Workload thread runner - takes care of keeping the workload running as long as needed"
+        try:
+            self.__run()
+        finally:
+            # the main loop notices dead threads at once
+            self._notify()
+
+
+    def __run(self):
         if self.shouldStop():
             return
 
@@ -188,22 +350,39 @@ class rtevalModulePrototype(threading.Thread):
             self._WorkloadPrepare()
 
             # Wait until we're released
-            while True:
-                if self.shouldStop():
-                    return
-                self.__events["start"].wait(1.0)
-                if self.shouldStart():
-                    break
+            self.__events["released"].wait()
+            if self.shouldStop():
+                return
 
             self._log(Log.DEBUG, "Starting %s workload" % self._module_type)
             self.__timestamps["runloop_start"] = datetime.now()
-            while not self.shouldStop():
-                # Run the workload
-                self._WorkloadTask()
-
-                if self.shouldStop():
-                    break
-                time.sleep(self.__sleeptime)
+            self.__stoppipe = os.pipe()
+            os.set_blocking(self.__stoppipe[1], False)
+            self.__selector = selectors.DefaultSelector()
+            self.__selector.register(self.__stoppipe[0], selectors.EVENT_READ, None)
+            try:
+                exited = False
+                while not self.shouldStop():
+                    # Run the workload
+                    self._WorkloadTask()
+
+                    if exited and not self.WorkloadAlive():
+                        self._notify()
+
+                    if self.shouldStop():
+                        break
+                    exited = self.__wait_for_events()
+            finally:
+                for proc in list(self.__watched):
+                    self.__unwatch(proc)
+                self.__reported.clear()
+                self.__selector.close()
+                self.__selector = None
+                with self.__pipelock:
+                    stoppipe = self.__stoppipe
+                    self.__stoppipe = None
+                os.close(stoppipe[0])
+                os.close(stoppipe[1])
 
             self.__timestamps["runloop_stop"] = datetime.now()
             self._log(Log.DEBUG, "stopping %s workload" % self._module_type)
@@ -465,19 +644,14 @@ class RtEvalModules:
                 self._logger.log(Log.DEBUG, "\t - Started %s preparations" % modname)
 
         self._logger.log(Log.DEBUG, "Waiting for all %s modules to get ready" % self._module_type)
-        busy = True
-        while busy:
-            busy = False
-            for (modname, mod) in self.__modules:
-                if not mod.isReady():
-                    if not mod.hadRuntimeError():
-                        busy = True
-                        self._logger.log(Log.DEBUG, "Waiting for %s" % modname)
-                    else:
-                        raise RuntimeError("Runtime error starting the %s %s module" % (modname, self._module_type))
-
-            if busy:
-                time.sleep(1)
+        for (modname, mod) in self.__modules:
+            while not mod.WaitForReady(30.0):
+                if not mod.is_alive():
+                    raise RuntimeError("The %s %s module stopped before it got ready"
+                                       % (modname, self._module_type))
+                self._logger.log(Log.DEBUG, "Waiting for %s" % modname)
+            if mod.hadRuntimeError():
+                raise RuntimeError("Runtime error starting the %s %s module" % (modname, self._module_type))
 
         self._logger.log(Log.DEBUG, "All %s modules are ready" % self._module_type)
 
@@ -487,6 +661,13 @@ class RtEvalModules:
         return self.__runtimeError
 
 
+    def SetNotifyEvent(self, event):
+        """Makes all the loaded modules set event when the main loop should
+        check on them, see rtevalModulePrototype.SetNotifyEvent()"""
+        for (modname, mod) in self.__modules:
+            mod.SetNotifyEvent(event)
+
+
     def Unleash(self):
         """Unleashes all the loaded modules workloads"""
 
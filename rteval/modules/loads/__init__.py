@@ -24,13 +24,735 @@
 #
 
 import os
+import re
 import time
+import hashlib
 import threading
+import signal
+import subprocess
 import libxml2
 from rteval.Log import Log
+from rteval.misc import expand_cpulist, compress_cpulist, online_cpus
 from rteval.rtevalConfig import rtevalCfgSection
+from rteval.cgroup import LoadCgroup
+from rteval.settle import SettleDetector
 from rteval.modules import RtEvalModules, rtevalModulePrototype
 
+# Seconds between the samples of the resource usage of the loads
+ACCOUNTING_INTERVAL = 10.0
+
+# Seconds between the steps of the load controller
+CONTROL_INTERVAL = 10.0
+
+# Fraction of the time tasks stall on memory (the 'some avg10' value of
+# /proc/pressure/memory) above which the loads are shrunk
+MEMORY_PRESSURE_THRESHOLD = 0.10
+
+# Fraction of the available memory of a node the loads are sized to fill
+MEMORY_HEADROOM = 0.8
+
+# memory.high of a throttled load relative to the memory it used when it
+# was throttled.  A limit at the current use would make the kernel reclaim
+# from the load at once, above it the load only stops growing
+MEMORY_THROTTLE_HEADROOM = 1.25
+
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+
+USAGE_FIELDS = ('utime', 'stime', 'iowait', 'nvcsw', 'nivcsw')
+
+# Written into a build directory once the build in it succeeded
+BUILD_STAMP = '.rteval-built'
+
+# A child failing this many times in a row, each time within
+# QUICK_FAILURE_SECS of being started, is not restarted anymore
+QUICK_FAILURE_LIMIT = 5
+QUICK_FAILURE_SECS = 2.0
+
+# Hex digits of the cache key in the name of a build directory
+BUILD_KEY_LEN = 16
+
+
+def file_checksum(path, stampdir=None):
+    """Returns the sha256 hex digest of a file.  With stampdir it is kept in
+    a stamp file there, and used again while the size and the modification
+    time of the file are unchanged"""
+    st = os.stat(path)
+    fileid = "%d %d" % (st.st_size, st.st_mtime_ns)
+    stamp = stampdir and os.path.join(stampdir, ".%s.sha256" % os.path.basename(path))
+    if stamp and os.path.exists(stamp):
+        with open(stamp) as f:
+            (stampid, checksum) = f.read().rsplit(' ', 1)
+        if stampid == fileid:
+            return checksum.strip()
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    if stamp:
+        with open(stamp, 'w') as f:
+            f.write("%s %s\n" % (fileid, digest.hexdigest()))
+    return digest.hexdigest()
+
+
+def build_cache_key(source, *settings, stampdir=None):
+    """Returns the key of a cached build: the sha256 hex digest of the source
+    file, when given, and of the settings the build depends on.  The
+    checksum of the source is kept in stampdir, see file_checksum()"""
+    digest = hashlib.sha256()
+    if source:
+        digest.update(file_checksum(source, stampdir).encode())
+    for setting in settings:
+        digest.update(b'\0' + str(setting).encode())
+    return digest.hexdigest()
+
+
+def build_dir(basedir, name, key):
+    "Returns the build directory of a load for the cache key"
+    return os.path.join(basedir, "%s-%s" % (name, key[:BUILD_KEY_LEN]))
+
+
+def cached_build_dirs(basedir, name):
+    """Returns the build directories of a load in basedir, whatever their
+    cache key.  Directories of other loads sharing the name as prefix, like
+    dbench-4.0 for dbench, do not match"""
+    pattern = re.compile(r"%s-[0-9a-f]{%d}$" % (re.escape(name), BUILD_KEY_LEN))
+    if not os.path.isdir(basedir):
+        return []
+    return [os.path.join(basedir, d) for d in sorted(os.listdir(basedir))
+            if pattern.match(d) and os.path.isdir(os.path.join(basedir, d))]
+
+
+def process_tree_usage(rootpids):
+    """Sums up the resource usage of the running processes in the trees below
+    rootpids, from /proc.  The CPU times include the children the processes
+    have waited for, the context switches only the running processes.
+    Returns a dictionary with the USAGE_FIELDS and a set with the CPUs the
+    processes last ran on"""
+    stats = {}
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % entry) as f:
+                data = f.read()
+        except OSError:
+            continue
+        # the command name may contain spaces and parentheses
+        fields = data[data.rindex(')') + 2:].split()
+        stats[int(entry)] = fields
+        children.setdefault(int(fields[1]), []).append(int(entry))
+
+    usage = dict([(f, 0) for f in USAGE_FIELDS])
+    usage['cpus'] = set()
+    todo = [pid for pid in rootpids if pid in stats]
+    while todo:
+        pid = todo.pop()
+        todo.extend(children.get(pid, []))
+        fields = stats[pid]
+        # utime, stime, cutime, cstime, ..., processor, ..., blkio delay
+        usage['utime'] += float(int(fields[11]) + int(fields[13])) / CLOCK_TICKS
+        usage['stime'] += float(int(fields[12]) + int(fields[14])) / CLOCK_TICKS
+        usage['iowait'] += float(int(fields[39])) / CLOCK_TICKS
+        usage['cpus'].add(int(fields[36]))
+        try:
+            with open('/proc/%d/status' % pid) as f:
+                for line in f:
+                    if line.startswith('voluntary_ctxt_switches'):
+                        usage['nvcsw'] += int(line.split()[1])
+                    elif line.startswith('nonvoluntary_ctxt_switches'):
+                        usage['nivcsw'] += int(line.split()[1])
+        except OSError:
+            pass
+    return usage
+
+
+class ChildSupervisor:
+    """Owns the child processes of a load module.  Each child is started by
+    a function returning a subprocess.Popen object, and reap() restarts the
+    children which exited according to the restart policy:
+
+        always      restart the child whenever it exits
+        on-success  restart the child if it exited with status 0
+        never       leave the child stopped
+
+    A child which keeps failing right after it was started, QUICK_FAILURE_LIMIT
+    times in a row, is not restarted whatever the policy, as it would only
+    be restarted in a tight loop.
+
+    The module thread is woken up as soon as a child exits when it returns
+    processes() from _WorkloadChildren(), so reap() restarts it right away.
+    The number of restarts and the fraction of the time each child was
+    running (the duty cycle) are recorded for the report.
+
+    The children are reaped with wait4(), which returns the resource usage
+    of each child and the descendants it waited for.  Together with samples
+    of the running process trees this gives the resource usage of the load.
+    When the load runs in a cgroup, the CPU times and the memory use are
+    taken from its cpu.stat and memory.stat instead, which also cover
+    processes nobody waited for, and the children are stopped at once
+    by killing the cgroup"""
+
+    POLICIES = ('always', 'on-success', 'never')
+
+    def __init__(self, policy='always', logfnc=None, cgroup=None):
+        if policy not in self.POLICIES:
+            raise ValueError("unknown restart policy '%s'" % policy)
+        self.__policy = policy
+        self.__logfnc = logfnc
+        self.__cgroup = cgroup
+        self.__cgstat = None
+        self.__children = {}
+        self.__first = None
+        self.__stopped = None
+        # protects the usage of the reaped children against the sampler
+        self.__lock = threading.Lock()
+        self.__usage = dict([(f, 0) for f in USAGE_FIELDS])
+        self.__cpus = set()
+        self.__samples = 0
+
+
+    def __log(self, logtype, msg):
+        if self.__logfnc:
+            self.__logfnc(logtype, msg)
+
+
+    def __runtime(self, child, now):
+        if child['process'] is None:
+            return child['runtime']
+        return child['runtime'] + now - child['started']
+
+
+    def __collect(self, proc):
+        """Reaps proc if it exited, adding its resource usage to the totals.
+        Returns True if it exited"""
+        if proc.returncode is not None:
+            return True
+        with self.__lock:
+            try:
+                (pid, status, rusage) = os.wait4(proc.pid, os.WNOHANG)
+            except ChildProcessError:
+                # somebody else reaped it, the usage is lost
+                proc.returncode = proc.poll()
+                return proc.returncode is not None
+            if pid == 0:
+                return False
+            proc.returncode = os.waitstatus_to_exitcode(status)
+            self.__usage['utime'] += rusage.ru_utime
+            self.__usage['stime'] += rusage.ru_stime
+            self.__usage['nvcsw'] += rusage.ru_nvcsw
+            self.__usage['nivcsw'] += rusage.ru_nivcsw
+        return True
+
+
+    def __wait(self, proc, timeout):
+        "Waits up to timeout seconds for proc to exit, returns True if it did"
+        deadline = timeout is not None and time.time() + timeout
+        while not self.__collect(proc):
+            if deadline and time.time() >= deadline:
+                return False
+            time.sleep(0.05)
+        return True
+
+
+    def __terminate(self, key, proc, sig, timeout):
+        "Sends sig to proc and waits for it to exit, it is killed after timeout seconds"
+        if self.__collect(proc):
+            return
+        self.__log(Log.DEBUG, "stopping %s" % key)
+        proc.send_signal(sig)
+        if not self.__wait(proc, timeout):
+            self.__log(Log.DEBUG, "killing %s" % key)
+            proc.kill()
+            self.__wait(proc, None)
+
+
+    def spawn(self, key, startfnc):
+        """Starts a new child by calling startfnc, which is called again each
+        time the child is restarted"""
+        now = time.time()
+        proc = startfnc()
+        if self.__first is None:
+            self.__first = now
+        self.__children[key] = {'start': startfnc,
+                                'process': proc,
+                                'started': now,
+                                'runtime': 0.0,
+                                'restarts': 0,
+                                'quickfailures': 0,
+                                'returncode': None}
+
+
+    def processes(self):
+        "Returns the subprocess.Popen objects of the running children"
+        return [c['process'] for c in list(self.__children.values()) if c['process'] is not None]
+
+
+    def reap(self):
+        """Restarts the children which exited, if the restart policy allows it.
+        Returns a list of (key, returncode) tuples of the children which
+        were not restarted"""
+        stopped = []
+        for key, child in self.__children.items():
+            proc = child['process']
+            if proc is None or not self.__collect(proc):
+                continue
+
+            ran = time.time() - child['started']
+            child['runtime'] += ran
+            child['returncode'] = proc.returncode
+            child['process'] = None
+            if proc.returncode != 0 and ran < QUICK_FAILURE_SECS:
+                child['quickfailures'] += 1
+            else:
+                child['quickfailures'] = 0
+            if child['quickfailures'] >= QUICK_FAILURE_LIMIT:
+                self.__log(Log.WARN, "%s failed %d times in a row right after it was started "
+                           "(last exit status %d), not restarting it"
+                           % (key, child['quickfailures'], proc.returncode))
+                stopped.append((key, proc.returncode))
+            elif self.__policy == 'always' or \
+               (self.__policy == 'on-success' and proc.returncode == 0):
+                child['process'] = child['start']()
+                child['started'] = time.time()
+                child['restarts'] += 1
+            else:
+                self.__log(Log.DEBUG, "%s exited with %d, not restarting it"
+                           % (key, proc.returncode))
+                stopped.append((key, proc.returncode))
+        return stopped
+
+
+    def restart(self, key, sig=signal.SIGTERM, timeout=2.0):
+        """Stops the child with sig and starts it again right away, whatever
+        the restart policy, so a changed command line takes effect.  This is
+        not counted as a restart"""
+        child = self.__children[key]
+        proc = child['process']
+        if proc is not None:
+            self.__terminate(key, proc, sig, timeout)
+            child['runtime'] += time.time() - child['started']
+        child['process'] = child['start']()
+        child['started'] = time.time()
+
+
+    def running(self):
+        "Returns True if all the children are running"
+        if not self.__children:
+            return False
+        for child in self.__children.values():
+            if child['process'] is None or self.__collect(child['process']):
+                return False
+        return True
+
+
+    def stop(self, sig=signal.SIGTERM, timeout=2.0):
+        """Sends sig to all the children and waits for them to exit.  Children
+        still running after timeout seconds are killed.  In a cgroup all the
+        processes are killed right away"""
+        if self.__cgroup:
+            self.__log(Log.DEBUG, "killing all processes in %s" % self.__cgroup.path)
+            self.__cgroup.kill()
+        for key, child in self.__children.items():
+            proc = child['process']
+            if proc is None:
+                continue
+            if self.__cgroup:
+                self.__wait(proc, None)
+            else:
+                self.__terminate(key, proc, sig, timeout)
+            child['runtime'] = self.__runtime(child, time.time())
+            child['returncode'] = proc.returncode
+            child['process'] = None
+        self.__stopped = time.time()
+        if self.__cgroup:
+            # the accounting is gone with the cgroup
+            self.__cgstat = self.__cgroup.stat()
+
+
+    def usage(self):
+        """Returns the resource usage of all the children so far, as the
+        process_tree_usage() dictionary"""
+        # The pids and the totals of the reaped children are taken together,
+        # a child reaped during the /proc scan is then counted once at most.
+        # The scan is done without the lock, so reap() is not held up by it
+        with self.__lock:
+            pids = [p.pid for p in self.processes() if p.returncode is None]
+            reaped = dict(self.__usage)
+        usage = process_tree_usage(pids)
+        for f in USAGE_FIELDS:
+            usage[f] += reaped[f]
+
+        if self.__cgroup:
+            stat = self.__cgstat or self.__cgroup.stat()
+            if 'user_usec' in stat:
+                usage['utime'] = stat['user_usec'] / 1000000.0
+                usage['stime'] = stat['system_usec'] / 1000000.0
+            for key in ('memory.peak', 'anon', 'file', 'pgmajfault', 'throttled_usec'):
+                if key in stat:
+                    usage[key] = stat[key]
+        return usage
+
+
+    def sample(self):
+        "Records which CPUs the children run on, called at a low rate"
+        self.__cpus |= self.usage()['cpus']
+        self.__samples += 1
+
+
+    def MakeReport(self):
+        if self.__first is None:
+            return None
+
+        now = self.__stopped or time.time()
+        elapsed = max(now - self.__first, 1e-6)
+        restarts = 0
+        runtime = 0.0
+        rep_n = libxml2.newNode("supervisor")
+        rep_n.newProp("policy", self.__policy)
+        for key, child in self.__children.items():
+            child_rt = min(self.__runtime(child, now), elapsed)
+            child_n = rep_n.newChild(None, "child", None)
+            child_n.newProp("name", str(key))
+            child_n.newProp("restarts", str(child['restarts']))
+            child_n.newProp("runtime", "%.3f" % child_rt)
+            child_n.newProp("dutycycle", "%.4f" % (child_rt / elapsed))
+            restarts += child['restarts']
+            runtime += child_rt
+        rep_n.newProp("restarts", str(restarts))
+        rep_n.newProp("dutycycle", "%.4f" % (runtime / (elapsed * len(self.__children))))
+        return rep_n
+
+
+    def UsageReport(self, ncpus):
+        """Returns a <usage/> node with the resource usage of the children.
+        The CPU utilization is relative to ncpus CPUs"""
+        if self.__first is None:
+            return None
+
+        elapsed = max((self.__stopped or time.time()) - self.__first, 1e-6)
+        usage = self.usage()
+        rep_n = libxml2.newNode("usage")
+        rep_n.newProp("utime", "%.2f" % usage['utime'])
+        rep_n.newProp("stime", "%.2f" % usage['stime'])
+        rep_n.newProp("iowait", "%.2f" % usage['iowait'])
+        rep_n.newProp("cpu_utilization",
+                      "%.4f" % ((usage['utime'] + usage['stime']) / (elapsed * max(ncpus, 1))))
+        rep_n.newProp("voluntary_ctxt_switches", str(usage['nvcsw']))
+        rep_n.newProp("involuntary_ctxt_switches", str(usage['nivcsw']))
+        cpus = sorted(self.__cpus | usage['cpus'])
+        rep_n.newProp("cpus", cpus and compress_cpulist(cpus) or "")
+        rep_n.newProp("samples", str(self.__samples))
+        if self.__cgroup:
+            rep_n.newProp("cgroup", self.__cgroup.path)
+            if 'memory.peak' in usage:
+                rep_n.newProp("memory_peak", str(usage['memory.peak']))
+            for key in ('anon', 'file', 'pgmajfault', 'throttled_usec'):
+                if key in usage:
+                    rep_n.newProp(key, str(usage[key]))
+        return rep_n
+
+
+def _housekeeping_thread(housekeeping, logger):
+    "Moves the calling thread to the housekeeping CPUs at the lowest priority"
+    # Keep out of the way of the measurement threads
+    try:
+        if housekeeping:
+            os.sched_setaffinity(0, housekeeping)
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 19)
+    except (AttributeError, OSError) as err:
+        logger.log(Log.DEBUG, "could not move the %s thread: %s"
+                   % (threading.current_thread().name, err))
+
+
+class LoadSizer:
+    """Sizes the loads to the memory of the NUMA nodes they run on.  The
+    loads ask instances() how many of their instances fit into the memory
+    available on a node, and get fewer when the system is already under
+    memory pressure, so they load the CPUs without making the system
+    reclaim or swap"""
+
+    def __init__(self, logfnc=None, threshold=MEMORY_PRESSURE_THRESHOLD):
+        self.__logfnc = logfnc
+        self.__threshold = threshold
+
+
+    def __log(self, logtype, msg):
+        if self.__logfnc:
+            self.__logfnc(logtype, msg)
+
+
+    @staticmethod
+    def node_available(node):
+        """Returns the memory available on a systopology NumaNode in bytes.
+        The node meminfo has no MemAvailable, so it is estimated like the
+        kernel does: the free memory plus the half of the page cache and of
+        the reclaimable slab"""
+        node.getmeminfo()
+        meminfo = node.meminfo
+        if 'MemAvailable' in meminfo:
+            return meminfo['MemAvailable']
+        return meminfo.get('MemFree', 0) \
+            + (meminfo.get('Active(file)', 0) + meminfo.get('Inactive(file)', 0)) // 2 \
+            + meminfo.get('SReclaimable', 0) // 2
+
+
+    @staticmethod
+    def pressure():
+        """Returns the fraction of the last 10 seconds some tasks stalled on
+        memory, or None without PSI support"""
+        try:
+            with open('/proc/pressure/memory') as f:
+                for line in f:
+                    if line.startswith('some'):
+                        return float(line.split()[1].split('=')[1]) / 100.0
+        except OSError:
+            pass
+        return None
+
+
+    def instances(self, node, memsize, wanted, what="instances"):
+        """Returns how many of wanted instances of memsize bytes each fit into
+        the memory available on node, half of that under memory pressure"""
+        avail = self.node_available(node)
+        fits = int(avail * MEMORY_HEADROOM // memsize)
+        count = min(wanted, fits)
+        pressure = self.pressure()
+        if pressure is not None and pressure > self.__threshold:
+            count = count // 2
+            self.__log(Log.INFO, "memory pressure is %.1f%%, halving the %s on node %d"
+                       % (pressure * 100, what, int(node)))
+        if count < wanted:
+            self.__log(Log.INFO, "node %d: %d MB available, running %d of %d %s"
+                       % (int(node), avail // 2**20, count, wanted, what))
+        else:
+            self.__log(Log.DEBUG, "node %d: %d MB available, running %d %s"
+                       % (int(node), avail // 2**20, count, what))
+        return count
+
+
+class LoadAccounting(threading.Thread):
+    """Samples the resource usage of the load modules every interval
+    seconds, from a niced thread on the housekeeping CPUs"""
+
+    def __init__(self, modules, housekeeping, logger, interval=ACCOUNTING_INTERVAL):
+        threading.Thread.__init__(self, name="load accounting")
+        self.daemon = True
+        self.__modules = modules
+        self.__housekeeping = housekeeping
+        self.__logger = logger
+        self.__interval = interval
+        self.__stopevent = threading.Event()
+
+
+    def run(self):
+        _housekeeping_thread(self.__housekeeping, self.__logger)
+        while not self.__stopevent.wait(self.__interval):
+            for mod in self.__modules:
+                try:
+                    mod.SampleUsage()
+                except (OSError, ValueError) as err:
+                    self.__logger.log(Log.DEBUG, "load accounting failed: %s" % err)
+
+
+    def stop(self):
+        self.__stopevent.set()
+        self.join()
+
+
+class MemoryGuard(threading.Thread):
+    """Keeps the loads from pushing the system into reclaim.  Every interval
+    seconds the memory pressure is read, and above threshold the loads the
+    load controller can scale are shrunk to half their size, down to a
+    quarter.  The others, and the scalable loads which only change their
+    size later, are kept from growing much beyond the memory their cgroup
+    uses at that time.  Below half the threshold this is undone step by
+    step.  Each decision is logged and recorded for the report"""
+
+    MIN_LIMIT = 0.25
+
+    def __init__(self, modules, threshold, housekeeping, logger, interval=ACCOUNTING_INTERVAL):
+        threading.Thread.__init__(self, name="memory guard")
+        self.daemon = True
+        self.__modules = modules
+        self.__threshold = threshold
+        self.__housekeeping = housekeeping
+        self.__logger = logger
+        self.__interval = interval
+        self.__limit = 1.0
+        self.__throttled = False
+        self.__decisions = []
+        self.__start = time.time()
+        self.__stopevent = threading.Event()
+
+
+    def __decide(self, pressure, action):
+        self.__logger.log(Log.INFO, "[memory guard] memory pressure %.1f%%: %s" % (pressure * 100, action))
+        self.__decisions.append((time.time() - self.__start, pressure, action))
+
+
+    def step(self, pressure):
+        "Shrinks, throttles or releases the loads for the memory pressure"
+        scalable = [m for m in self.__modules if m.Scalable()]
+        # a smaller size which only applies later does not help now
+        unshrinkable = [m for m in self.__modules
+                        if not m.Scalable() or not m.ResizesImmediately()]
+        if pressure > self.__threshold:
+            if scalable and self.__limit > self.MIN_LIMIT:
+                self.__limit = max(self.__limit / 2, self.MIN_LIMIT)
+                for mod in scalable:
+                    mod.LimitMemory(self.__limit)
+                self.__decide(pressure, "shrinking the loads to %.2f" % self.__limit)
+            if not self.__throttled:
+                throttled = [m for m in unshrinkable if m.ThrottleMemory(True)]
+                self.__throttled = True
+                if throttled:
+                    self.__decide(pressure, "throttling the memory of %d loads" % len(throttled))
+        elif pressure < self.__threshold / 2:
+            if self.__throttled:
+                for mod in unshrinkable:
+                    mod.ThrottleMemory(False)
+                self.__throttled = False
+                self.__decide(pressure, "releasing the memory throttle")
+            if self.__limit < 1.0:
+                self.__limit = min(self.__limit * 2, 1.0)
+                for mod in scalable:
+                    mod.LimitMemory(self.__limit)
+                self.__decide(pressure, "growing the loads to %.2f" % self.__limit)
+
+
+    def run(self):
+        _housekeeping_thread(self.__housekeeping, self.__logger)
+        self.__start = time.time()
+        while not self.__stopevent.wait(self.__interval):
+            pressure = LoadSizer.pressure()
+            if pressure is not None:
+                self.step(pressure)
+
+
+    def stop(self):
+        self.__stopevent.set()
+        self.join()
+
+
+    def MakeReport(self):
+        rep_n = libxml2.newNode("memory_guard")
+        rep_n.newProp("threshold", "%.4f" % self.__threshold)
+        rep_n.newProp("limit", "%.4f" % self.__limit)
+        rep_n.newProp("decisions", str(len(self.__decisions)))
+        for (elapsed, pressure, action) in self.__decisions:
+            dec_n = rep_n.newChild(None, "decision", None)
+            dec_n.newProp("time", "%.1f" % elapsed)
+            dec_n.newProp("pressure", "%.4f" % pressure)
+            dec_n.addContent(action)
+        return rep_n
+
+
+class LoadController(threading.Thread):
+    """Holds the utilization of the load CPUs at a target by scaling the
+    load modules.  Every interval seconds the busy fraction of the load CPUs
+    is measured, and unless it is within deadband of the target the
+    intensity is corrected by gain times the relative error, at most halving
+    or doubling it per step.  The intensity multiplies the hackbench groups,
+    the make jobs and the stress-ng workers, within MIN_INTENSITY and
+    MAX_INTENSITY.  The loads restart at a new intensity, so the hold
+    intervals after a change are not used for control: they measure the
+    restart and not the new intensity.  Each step is recorded for the report"""
+
+    MIN_INTENSITY = 0.25
+    MAX_INTENSITY = 8.0
+
+    def __init__(self, modules, target, cpulist, housekeeping, logger,
+                 interval=CONTROL_INTERVAL, gain=0.8, deadband=0.02, hold=2):
+        threading.Thread.__init__(self, name="load controller")
+        self.daemon = True
+        self.__modules = modules
+        self.__target = target
+        self.__cpulist = cpulist
+        self.__housekeeping = housekeeping
+        self.__logger = logger
+        self.__interval = interval
+        self.__gain = gain
+        self.__deadband = deadband
+        self.__hold = hold
+        self.__settling = 0
+        self.__intensity = 1.0
+        self.__steps = []
+        self.__start = None
+        self.__stopevent = threading.Event()
+
+
+    def step(self, utilization):
+        """Returns the intensity which brings the load from utilization to
+        the target"""
+        error = self.__target - utilization
+        if abs(error) <= self.__deadband:
+            return self.__intensity
+        ratio = 1.0 + self.__gain * error / max(utilization, 0.05)
+        ratio = min(max(ratio, 0.5), 2.0)
+        return min(max(self.__intensity * ratio, self.MIN_INTENSITY), self.MAX_INTENSITY)
+
+
+    def control(self, utilization):
+        """Takes the utilization of one interval and returns the intensity to
+        run at.  The utilization is ignored within hold intervals of the
+        last change"""
+        if self.__settling:
+            self.__settling -= 1
+            return self.__intensity
+        intensity = self.step(utilization)
+        if intensity != self.__intensity:
+            self.__intensity = intensity
+            self.__settling = self.__hold
+        return intensity
+
+
+    def run(self):
+        _housekeeping_thread(self.__housekeeping, self.__logger)
+        detector = SettleDetector(self.__cpulist, metrics=('utilization',))
+        self.__start = time.time()
+        detector.sample()
+        while not self.__stopevent.wait(self.__interval):
+            try:
+                utilization = detector.sample()['utilization']
+            except (OSError, ValueError) as err:
+                self.__logger.log(Log.DEBUG, "load controller failed: %s" % err)
+                continue
+
+            previous = self.__intensity
+            intensity = self.control(utilization)
+            self.__steps.append((time.time() - self.__start, utilization, intensity))
+            if intensity != previous:
+                self.__logger.log(Log.DEBUG, "[load controller] utilization %.3f, "
+                                  "intensity %.3f -> %.3f" % (utilization, previous, intensity))
+                for mod in self.__modules:
+                    mod.SetIntensity(intensity)
+
+
+    def stop(self):
+        self.__stopevent.set()
+        self.join()
+
+
+    def MakeReport(self):
+        rep_n = libxml2.newNode("controller")
+        rep_n.newProp("target", "%.4f" % self.__target)
+        rep_n.newProp("interval", "%.1f" % self.__interval)
+        rep_n.newProp("intensity", "%.4f" % self.__intensity)
+        rep_n.newProp("steps", str(len(self.__steps)))
+        if self.__steps:
+            # the mean after the first half of the run, when it is settled
+            tail = [s[1] for s in self.__steps[len(self.__steps) // 2:]]
+            rep_n.newProp("utilization", "%.4f" % (sum(tail) / len(tail)))
+        for (elapsed, utilization, intensity) in self.__steps:
+            step_n = rep_n.newChild(None, "step", None)
+            step_n.newProp("time", "%.1f" % elapsed)
+            step_n.newProp("utilization", "%.4f" % utilization)
+            step_n.newProp("intensity", "%.4f" % intensity)
+        return rep_n
+
+
 class LoadThread(rtevalModulePrototype):
     def __init__(self, name, config, logger=None):
 
@@ -60,6 +782,14 @@ class LoadThread(rtevalModulePrototype):
         self.mydir = None
         self.jobs = 0
         self.args = None
+        self._supervisor = None
+        self._cgroup = None
+        # set once the group of the run was created for the load
+        self.__cgroupcreated = False
+        # scale of the load, set by the load controller and the memory guard
+        self._intensity = 1.0
+        self.__newintensity = 1.0
+        self.__memlimit = 1.0
 
         if not os.path.exists(self.builddir):
             os.makedirs(self.builddir)
@@ -69,6 +799,143 @@ class LoadThread(rtevalModulePrototype):
         return os.open(os.path.join(self.reportdir, "logs", name), os.O_CREAT|os.O_WRONLY)
 
 
+    def _WorkloadChildren(self):
+        if self._supervisor:
+            return self._supervisor.processes()
+        return []
+
+
+    def SampleUsage(self):
+        "Samples the resource usage of the load"
+        if self._supervisor:
+            self._supervisor.sample()
+
+
+    def Scalable(self):
+        "Returns True if the load controller can change the size of the load"
+        return False
+
+
+    def ResizesImmediately(self):
+        """Returns True if a new size of a scalable load takes effect at once,
+        False if it only applies to the next run of the load"""
+        return True
+
+
+    def SetIntensity(self, intensity):
+        """Scales the load to intensity times its configured size.  The module
+        thread is woken up and takes it over with _UpdateIntensity()"""
+        self.__newintensity = intensity
+        self._Wakeup()
+
+
+    def LimitMemory(self, limit):
+        """Scales the load down to limit times the intensity set by the load
+        controller, while the system is short of memory"""
+        self.__memlimit = limit
+        self._Wakeup()
+
+
+    def ThrottleMemory(self, throttle):
+        """Limits the memory of the load to MEMORY_THROTTLE_HEADROOM times what
+        its cgroup uses now, or lifts the limit again.  Returns False if the
+        load does not run in a cgroup"""
+        if not self._cgroup:
+            return False
+        try:
+            limit = None
+            if throttle:
+                limit = int(self._cgroup.memory_current() * MEMORY_THROTTLE_HEADROOM)
+            self._cgroup.set_memory_high(limit)
+        except OSError as err:
+            self._log(Log.DEBUG, "could not throttle the memory: %s" % err)
+            return False
+        return True
+
+
+    def _UpdateIntensity(self):
+        """Returns True if the intensity was changed since the last call, the
+        new intensity is then in self._intensity"""
+        intensity = self.__newintensity * self.__memlimit
+        if intensity == self._intensity:
+            return False
+        self._intensity = intensity
+        return True
+
+
+    def _Scaled(self, count):
+        "Returns count scaled by the intensity, at least 1"
+        return max(1, int(round(count * self._intensity)))
+
+
+    def _CreateCgroups(self, nodecpus, pernode=True):
+        """Creates a cgroup v2 group for the load, bound to the cpus and NUMA
+        nodes in nodecpus (node -> list of cpus).  With pernode, each node
+        gets a child group bound to its own cpus and memory.  Returns False
+        if cgroup v2 cannot be used, the load must then bind its processes
+        with taskset or numactl itself"""
+        cpus = []
+        for node in nodecpus:
+            cpus.extend(nodecpus[node])
+        self._cgroup = LoadCgroup.create(self._name, sorted(cpus), sorted(nodecpus.keys()), self._log)
+        if self._cgroup is None:
+            return False
+        self.__cgroupcreated = True
+
+        self.__nodegroups = {}
+        if pernode:
+            try:
+                for node in nodecpus:
+                    self.__nodegroups[node] = self._cgroup.child('node%d' % int(node),
+                                                                 nodecpus[node], [node])
+            except OSError as err:
+                self._log(Log.DEBUG, "not using cgroup v2: %s" % err)
+                self._cgroup.remove()
+                self._cgroup = None
+                return False
+        self._log(Log.DEBUG, "running in cgroup %s" % self._cgroup.path)
+        return True
+
+
+    def _CgroupOf(self, node=None):
+        """Returns the cgroup of node, or of the load without a node, None
+        when the load does not run in a cgroup"""
+        if not self._cgroup or node is None:
+            return self._cgroup
+        return self.__nodegroups[node]
+
+
+    def _Popen(self, node, args, **kwargs):
+        """Starts a process of the load like subprocess.Popen, in the cgroup
+        of node (or of the load without a node) when the load has one"""
+        cgroup = self._CgroupOf(node)
+        if cgroup:
+            return cgroup.popen(args, **kwargs)
+        return subprocess.Popen(args, **kwargs)
+
+
+    def CreatedCgroups(self):
+        "Returns True if cgroups were created for the load"
+        return self.__cgroupcreated
+
+
+    def _RemoveCgroups(self):
+        "Kills any process left in the cgroup of the load and removes it"
+        if self._cgroup:
+            self._cgroup.remove()
+
+
+    def _UsageReport(self):
+        "Returns the <usage/> report node of the load, or None"
+        if not self._supervisor:
+            return None
+        if self.cpulist:
+            ncpus = len(expand_cpulist(self.cpulist))
+        else:
+            ncpus = len(online_cpus())
+        return self._supervisor.UsageReport(ncpus)
+
+
 class CommandLineLoad(LoadThread):
     def __init__(self, name, config, logger):
         LoadThread.__init__(self, name, config, logger)
@@ -86,6 +953,14 @@ class CommandLineLoad(LoadThread):
             if self.args:
                 rep_n.addContent(" ".join(self.args))
 
+        if self._supervisor:
+            sup_n = self._supervisor.MakeReport()
+            if sup_n is not None:
+                rep_n.addChild(sup_n)
+            usage_n = self._UsageReport()
+            if usage_n is not None:
+                rep_n.addChild(usage_n)
+
         return rep_n
 
 
@@ -98,6 +973,9 @@ class LoadModules(RtEvalModules):
         self._report_tag = "loads"
         self.__loadavg_accum = 0.0
         self.__loadavg_samples = 0
+        self.__accounting = None
+        self.__controller = None
+        self.__memguard = None
         RtEvalModules.__init__(self, config, "modules.loads", logger)
         self.__LoadModules(self._cfg.GetSection(self._module_config))
 
@@ -106,10 +984,25 @@ class LoadModules(RtEvalModules):
         "Loads and imports all the configured modules"
 
         for m in modcfg:
-            # hope to eventually have different kinds but module is only on
-            # for now (jcw)
+            # a module of its own, or a command run by the external module
             if m[1].lower() == 'module':
                 self._LoadModule(m[0])
+            elif m[1].lower() == 'external':
+                self._LoadModule('external')
+
+
+    def SetupModuleOptions(self, parser):
+        RtEvalModules.SetupModuleOptions(self, parser)
+        grparser = parser.get_option_group('--loads-cpulist')
+        grparser.add_option('--loads-target', dest='loads___target',
+                            action='store', default="", metavar='PCT',
+                            help='utilization of the load CPUs in percent which the '
+                            'load controller holds by scaling the loads (default: off)')
+        grparser.add_option('--loads-mempressure', dest='loads___mempressure',
+                            action='store', default=str(MEMORY_PRESSURE_THRESHOLD * 100),
+                            metavar='PCT',
+                            help='memory pressure in percent above which the loads are '
+                            'shrunk, 0 to never shrink them (default: %default)')
 
 
     def Setup(self, modparams):
@@ -119,18 +1012,90 @@ class LoadModules(RtEvalModules):
         modcfg = self._cfg.GetSection(self._module_config)
         cpulist = modcfg.cpulist
         for m in modcfg:
-            # hope to eventually have different kinds but module is only on
-            # for now (jcw)
+            if m[1].lower() not in ('module', 'external'):
+                continue
+            self._cfg.AppendConfig(m[0], modparams)
+            self._cfg.AppendConfig(m[0], {'cpulist': cpulist})
             if m[1].lower() == 'module':
-                self._cfg.AppendConfig(m[0], modparams)
-                self._cfg.AppendConfig(m[0], {'cpulist': cpulist})
                 modobj = self._InstantiateModule(m[0], self._cfg.GetSection(m[0]))
-                self._RegisterModuleObject(m[0], modobj)
+            else:
+                # the section of the load has the commands to run
+                modobj = self._LoadModule('external').create(self._cfg.GetSection(m[0]),
+                                                             self._logger, m[0])
+            self._RegisterModuleObject(m[0], modobj)
+
+
+    def Unleash(self):
+        nthreads = RtEvalModules.Unleash(self)
+
+        # sample the resource usage of the loads outside the measured CPUs
+        measure_cpulist = None
+        if self._cfg.HasSection('measurement'):
+            measure_cpulist = self._cfg.GetSection('measurement').cpulist
+        if measure_cpulist:
+            measured = expand_cpulist(measure_cpulist)
+            housekeeping = [int(c) for c in online_cpus() if c not in measured]
+        else:
+            housekeeping = None
+        mods = [self.GetNamedModuleObject(m) for m in self.GetModulesList()]
+        self.__accounting = LoadAccounting(mods, housekeeping, self._logger)
+        self.__accounting.start()
+
+        target = self._cfg.GetSection(self._module_config).target
+        if target:
+            self.__StartController(float(target) / 100.0, housekeeping)
+
+        mempressure = self._cfg.GetSection(self._module_config).mempressure
+        if mempressure and float(mempressure) > 0:
+            if LoadSizer.pressure() is None:
+                self._logger.log(Log.DEBUG, "no memory PSI support, not guarding the memory")
+            else:
+                self.__memguard = MemoryGuard([m for m in mods if m.WorkloadWillRun()],
+                                              float(mempressure) / 100.0, housekeeping, self._logger)
+                self.__memguard.start()
+        return nthreads
+
+
+    def __StartController(self, target, housekeeping):
+        if not 0.0 < target <= 1.0:
+            raise ValueError("load target must be above 0 and at most 100 percent")
+        names = [m for m in self.GetModulesList()
+                 if self.GetNamedModuleObject(m).WorkloadWillRun()
+                 and self.GetNamedModuleObject(m).Scalable()]
+        if not names:
+            self._logger.log(Log.WARN, "no load can be scaled, not controlling the load")
+            return
+        cpulist = self._cfg.GetSection(self._module_config).cpulist
+        self._logger.log(Log.INFO, "holding the load CPUs at %.1f%% utilization with %s"
+                         % (target * 100, ", ".join(names)))
+        self.__controller = LoadController([self.GetNamedModuleObject(m) for m in names], target,
+                                           cpulist and expand_cpulist(cpulist) or housekeeping,
+                                           housekeeping, self._logger)
+        self.__controller.start()
+
+
+    def Stop(self):
+        if self.__memguard:
+            self.__memguard.stop()
+        if self.__controller:
+            self.__controller.stop()
+        if self.__accounting:
+            self.__accounting.stop()
+            self.__accounting = None
+        RtEvalModules.Stop(self)
+
+        # nothing of the loads may survive the run
+        if [m for m in self.GetModulesList() if self.GetNamedModuleObject(m).CreatedCgroups()]:
+            LoadCgroup(LoadCgroup.top(), self._logger.log).remove()
 
 
     def MakeReport(self):
         rep_n = RtEvalModules.MakeReport(self)
         rep_n.newProp("load_average", str(self.GetLoadAvg()))
+        if self.__controller:
+            rep_n.addChild(self.__controller.MakeReport())
+        if self.__memguard:
+            rep_n.addChild(self.__memguard.MakeReport())
 
         return rep_n
 
@@ -148,3 +1113,162 @@ class LoadModules(RtEvalModules):
         if self.__loadavg_samples == 0:
             self.SaveLoadAvg()
         return float(self.__loadavg_accum / self.__loadavg_samples)
+
+
+def unit_test(rootdir):
+    import shutil
+    import tempfile
+
+    try:
+        sup = ChildSupervisor('on-success')
+        sup.spawn('ok', lambda: subprocess.Popen(['true']))
+        sup.spawn('fail', lambda: subprocess.Popen(['false']))
+        sup.spawn('sleep', lambda: subprocess.Popen(['sleep', '10']))
+        for proc in sup.processes()[:2]:
+            proc.wait()
+        stopped = sup.reap()
+        print("not restarted: %s" % stopped)
+        if stopped != [('fail', 1)] or len(sup.processes()) != 2 or sup.running():
+            return 1
+        sup.stop()
+        if sup.processes():
+            return 1
+
+        usage = sup.usage()
+        print("usage: %s" % usage)
+        if usage['utime'] + usage['stime'] < 0 or usage['nvcsw'] < 2:
+            return 1
+
+        usage = process_tree_usage([os.getpid()])
+        if not usage['cpus']:
+            return 1
+
+        rep_n = sup.MakeReport()
+        restarts = rep_n.prop('restarts')
+        dutycycle = float(rep_n.prop('dutycycle'))
+        print("restarts: %s, duty cycle: %.4f" % (restarts, dutycycle))
+        if restarts != '1' or not 0.0 < dutycycle <= 1.0:
+            return 1
+
+        sup = ChildSupervisor('never')
+        sup.spawn('sleep', lambda: subprocess.Popen(['sleep', '10']))
+        first = sup.processes()[0]
+        sup.restart('sleep')
+        print("restarted: %d -> %d" % (first.returncode, sup.processes()[0].pid))
+        if first.returncode != -signal.SIGTERM or not sup.running():
+            return 1
+        sup.stop()
+        if sup.MakeReport().prop('restarts') != '0':
+            return 1
+
+        sup = ChildSupervisor('always')
+        sup.spawn('bad', lambda: subprocess.Popen(['sh', '-c', 'exit 2']))
+        stopped = []
+        for i in range(QUICK_FAILURE_LIMIT):
+            if sup.processes():
+                sup.processes()[0].wait()
+            stopped = sup.reap()
+        print("given up: %s" % stopped)
+        if stopped != [('bad', 2)] or sup.processes() or sup.running():
+            return 1
+
+        key =build_cache_key(None, 'setup', 'build')
+        if key == build_cache_key(None, 'setup', 'make') or len(key) != 64:
+            return 1
+        stampdir = tempfile.mkdtemp()
+        try:
+            source = os.path.join(stampdir, 'source.tar')
+            with open(source, 'w') as f:
+                f.write('source')
+            checksum = file_checksum(source, stampdir)
+            if file_checksum(source, stampdir) != checksum or \
+               not os.path.exists(os.path.join(stampdir, '.source.tar.sha256')):
+                return 1
+            builddir = build_dir(stampdir, 'dbench', key)
+            for d in (builddir, build_dir(stampdir, 'dbench', '0' * 64),
+                      os.path.join(stampdir, 'dbench-4.0'), build_dir(stampdir, 'dbench-4.0', key)):
+                os.mkdir(d)
+            cached = [os.path.basename(d) for d in cached_build_dirs(stampdir, 'dbench')]
+            print("cached builds: %s" % cached)
+            if cached != ['dbench-0000000000000000', os.path.basename(builddir)]:
+                return 1
+        finally:
+            shutil.rmtree(stampdir)
+
+        ctrl = LoadController([], 0.95, None, None, None)
+        steps = [ctrl.step(u) for u in (0.5, 0.96, 1.0, 0.1)]
+        print("controller steps: %s" % ", ".join(["%.3f" % s for s in steps]))
+        if not (1.5 < steps[0] <= 2.0 and steps[1] == 1.0 and steps[2] < 1.0 and steps[3] == 2.0):
+            return 1
+
+        # step response of a load which saturates at intensity 2 and runs at
+        # half its utilization in the interval after a restart
+        ctrl = LoadController([], 0.95, None, None, None)
+        (intensity, restarted, trace) = (1.0, False, [])
+        for i in range(30):
+            utilization = min(1.0, 0.5 * intensity) * (restarted and 0.5 or 1.0)
+            new = ctrl.control(utilization)
+            (restarted, intensity) = (new != intensity, new)
+            trace.append(intensity)
+        changes = [b - a for (a, b) in zip(trace, trace[1:]) if b != a]
+        reversals = len([1 for (a, b) in zip(changes, changes[1:]) if a * b < 0])
+        print("controller step response: %s" % ", ".join(["%.3f" % s for s in trace[:10]]))
+        if reversals or len(set(trace[10:])) != 1 or abs(0.5 * trace[-1] - 0.95) > 0.02:
+            return 1
+
+        class FakeNode:
+            meminfo = {'MemFree': 2 * 2**30, 'Active(file)': 2**30, 'Inactive(file)': 2**30}
+            def getmeminfo(self):
+                pass
+            def __int__(self):
+                return 0
+        avail = LoadSizer.node_available(FakeNode())
+        count = LoadSizer(threshold=1.0).instances(FakeNode(), 2**28, 100)
+        print("available: %d MB, instances: %d" % (avail // 2**20, count))
+        if avail != 3 * 2**30 or count != 9:
+            return 1
+
+        class FakeLoad:
+            def __init__(self, scalable, immediately=True):
+                self.scalable = scalable
+                self.immediately = immediately
+                self.limit = 1.0
+                self.throttled = False
+            def Scalable(self):
+                return self.scalable
+            def ResizesImmediately(self):
+                return self.immediately
+            def LimitMemory(self, limit):
+                self.limit = limit
+            def ThrottleMemory(self, throttle):
+                self.throttled = throttle
+                return True
+        loads = [FakeLoad(True), FakeLoad(False), FakeLoad(True, False)]
+        guard = MemoryGuard(loads, 0.1, None, Log())
+        trace = []
+        for pressure in (0.2, 0.3, 0.3, 0.07, 0.01, 0.01):
+            guard.step(pressure)
+            trace.append((loads[0].limit, loads[1].throttled, loads[2].throttled))
+        print("memory guard: %s" % trace)
+        if trace != [(0.5, True, True), (0.25, True, True), (0.25, True, True),
+                     (0.25, True, True), (0.5, False, False), (1.0, False, False)]:
+            return 1
+        if loads[0].throttled:
+            return 1
+        if guard.MakeReport().prop('decisions') != '6':
+            return 1
+
+        try:
+            ChildSupervisor('sometimes')
+            return 1
+        except ValueError:
+            pass
+        return 0
+    except Exception as e:
+        print("** EXCEPTION %s" % str(e))
+        return 1
+
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(unit_test('..'))
@@ -0,0 +1,231 @@
+#
+#   external.py - class to run a command given in the configuration as load
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with this program; if not, write to the Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+#   For the avoidance of doubt the "preferred form" of this code is one which
+#   is in an open unpatent encumbered format. Where cryptographic key signing
+#   forms part of the process of creating an executable the information
+#   including keys needed to generate an equivalently functional executable
+#   are deemed to be part of the source code.
+#
+
+import os
+import os.path
+import shutil
+import signal
+import subprocess
+from rteval.modules import rtevalRuntimeError
+from rteval.modules.loads import CommandLineLoad, ChildSupervisor, build_cache_key, build_dir, \
+    cached_build_dirs, BUILD_STAMP
+from rteval.Log import Log
+from rteval.misc import expand_cpulist
+from rteval.systopology import SysTopology
+
+
+class External(CommandLineLoad):
+    """Runs the command given by the configuration section of the load as
+    load, for a load declared as 'external' in the [loads] section:
+
+        [dbench]
+        source:    dbench.tar.gz
+        setup:     tar -xvf dbench.tar.gz
+        build:     ./configure && make
+        runload:   dbench -c ./client.txt 10
+        instances: 1
+
+    The setup and build commands are run once in a build directory keyed by
+    the checksum of the source tarball, the commands and the optional version
+    setting, and the result is used again by later runs.  Without a source
+    nothing the commands fetch is part of the key: a setup cloning or
+    downloading the load is not run again until its commands or the version
+    setting change.  runload is started instances times per NUMA node, bound
+    to the load CPUs of the node, and restarted as soon as it exits, unless
+    it keeps failing right after each start"""
+
+    def __init__(self, config, logger, name):
+        CommandLineLoad.__init__(self, name, config, logger)
+        self.__tarball = None
+        self.__workdir = None
+
+
+    def __run_cmd(self, cmd, cwd, out, err):
+        self._log(Log.DEBUG, "running '%s' in %s" % (cmd, cwd))
+        ret = subprocess.call(cmd, shell=True, cwd=cwd,
+                              stdin=self.__nullfd, stdout=out, stderr=err)
+        if ret:
+            raise rtevalRuntimeError(self, "'%s' failed (ret=%d), please check logs for more detail"
+                                     % (cmd, ret))
+
+
+    def _WorkloadSetup(self):
+        self.runcmd = self._cfg.runload
+        if not self.runcmd:
+            raise rtevalRuntimeError(self, " no runload command configured")
+
+        if self.source:
+            self.__tarball = os.path.join(self.srcdir, self.source)
+            if not os.path.exists(self.__tarball):
+                self._log(Log.WARN, "source %s does not exist, not running" % self.__tarball)
+                self._donotrun = True
+                return
+
+        settings = [self._cfg.setup, self._cfg.build]
+        if self._cfg.version:
+            # builds cached before the version was set are not thrown away
+            settings.append(self._cfg.version)
+        key = build_cache_key(self.__tarball, *settings, stampdir=self.builddir)
+        self.mydir = build_dir(self.builddir, self._name, key)
+
+        sysTop = SysTopology()
+        self.nodes = sysTop.getnodes()
+        self.cpus = {}
+        for n in sysTop.getnodes():
+            self.cpus[n] = sysTop.getcpus(int(n))
+            # if a cpulist was specified, only allow cpus in that list on the node
+            if self.cpulist:
+                self.cpus[n] = [c for c in self.cpus[n] if str(c) in expand_cpulist(self.cpulist)]
+            if not self.cpus[n]:
+                self.nodes.remove(n)
+                self._log(Log.DEBUG, "node %s has no available cpus, removing" % n)
+
+        self.instances = int(self._cfg.setdefault('instances', 1))
+        self.jobs = self.instances * len(self.nodes)
+        self.args = [self.runcmd]
+
+        # without a cgroup per node the instances are bound by numactl or taskset
+        self.__usenumactl = False
+        if not self._CreateCgroups(dict([(n, self.cpus[n]) for n in self.nodes])):
+            self.__usenumactl = len(self.nodes) > 1 and not self.cpulist \
+                and os.path.exists('/usr/bin/numactl')
+
+
+    def _WorkloadBuild(self):
+        self.__nullfd = os.open("/dev/null", os.O_RDWR)
+        stamp = os.path.join(self.mydir, BUILD_STAMP)
+        if os.path.exists(stamp):
+            self._log(Log.INFO, "using the cached build in %s" % self.mydir)
+        else:
+            # builds of other sources or commands are not used anymore
+            for d in cached_build_dirs(self.builddir, self._name):
+                self._log(Log.DEBUG, "removing %s" % d)
+                shutil.rmtree(d, ignore_errors=True)
+            os.makedirs(self.mydir)
+            if self.__tarball:
+                os.symlink(self.__tarball, os.path.join(self.mydir, os.path.basename(self.__tarball)))
+
+            if self._logging:
+                out = self.open_logfile("%s-build.stdout" % self._name)
+                err = self.open_logfile("%s-build.stderr" % self._name)
+            else:
+                out = err = self.__nullfd
+            try:
+                if self._cfg.setup:
+                    self.__run_cmd(self._cfg.setup, self.mydir, out, err)
+                # build in the directory the setup created, if it created one
+                dirs = [d for d in os.listdir(self.mydir) if os.path.isdir(os.path.join(self.mydir, d))]
+                workdir = len(dirs) == 1 and dirs[0] or '.'
+                if self._cfg.build:
+                    self.__run_cmd(self._cfg.build, os.path.join(self.mydir, workdir), out, err)
+            finally:
+                if self._logging:
+                    os.close(out)
+                    os.close(err)
+            with open(stamp, 'w') as f:
+                f.write(workdir)
+
+        with open(stamp) as f:
+            self.__workdir = os.path.normpath(os.path.join(self.mydir, f.read().strip()))
+        self._setReady()
+
+
+    def _WorkloadPrepare(self):
+        # the instances are restarted as soon as they exit
+        self._setTaskInterval(None)
+        if self._logging:
+            self.__out = self.open_logfile("%s.stdout" % self._name)
+            self.__err = self.open_logfile("%s.stderr" % self._name)
+        else:
+            self.__out = self.__err = self.__nullfd
+        self._supervisor = ChildSupervisor('always', self._log, self._cgroup)
+        self.started = False
+
+
+    def __starton(self, node, instance):
+        # the cgroup of the node binds the instance, if there is one
+        args = ['/bin/sh', '-c', self.runcmd]
+        if not self._cgroup and self.__usenumactl:
+            args = ['numactl', '--cpunodebind', str(node)] + args
+        elif not self._cgroup and (len(self.nodes) > 1 or self.cpulist):
+            args = ['taskset', '-c', ",".join([str(c) for c in self.cpus[node]])] + args
+
+        # the programs built by the load are found in its build directory
+        env = dict(os.environ)
+        env['PATH'] = "%s:%s" % (self.__workdir, env.get('PATH', ''))
+        env['RTEVAL_NODE'] = str(node)
+        env['RTEVAL_INSTANCE'] = str(instance)
+        self._log(Log.DEBUG, "starting instance %d on node %s: args = %s" % (instance, node, args))
+        return self._Popen(node, args, cwd=self.__workdir, env=env,
+                           stdin=self.__nullfd,
+                           stdout=self.__out,
+                           stderr=self.__err)
+
+
+    def _WorkloadTask(self):
+        if self.shouldStop():
+            return
+
+        if not self.started:
+            for n in self.nodes:
+                for i in range(self.instances):
+                    self._supervisor.spawn("node%s-%d" % (n, i),
+                                           lambda node=n, inst=i: self.__starton(node, inst))
+            self.started = True
+            return
+
+        for (key, returncode) in self._supervisor.reap():
+            # the instance failed right after each start
+            raise rtevalRuntimeError(self, "'%s' keeps failing (instance %s, ret=%d), please "
+                                     "check logs for more detail" % (self.runcmd, key, returncode))
+
+
+    def WorkloadAlive(self):
+        # the instances are restarted whenever they exit, unless they keep
+        # failing right away
+        return self._supervisor.running()
+
+
+    def _WorkloadCleanup(self):
+        if self._donotrun:
+            return
+
+        self._log(Log.INFO, "cleaning up %s" % self._name)
+        self._supervisor.stop(signal.SIGTERM)
+        self._RemoveCgroups()
+        if self._logging:
+            os.close(self.__out)
+            os.close(self.__err)
+        os.close(self.__nullfd)
+
+
+
+def ModuleParameters():
+    # configured through the section of each external load
+    return {}
+
+
+
+def create(config, logger, name="external"):
+    return External(config, logger, name)
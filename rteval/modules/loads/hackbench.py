@@ -28,15 +28,17 @@
 import sys
 import os
 import os.path
-import time
-import subprocess
 import errno
 from signal import SIGKILL
-from rteval.modules.loads import CommandLineLoad
+from rteval.modules.loads import CommandLineLoad, ChildSupervisor, LoadSizer
 from rteval.Log import Log
 from rteval.misc import expand_cpulist
 from rteval.systopology import SysTopology
 
+# Memory used by a hackbench group of 20 sender and 20 receiver processes,
+# in MB, unless the groupmem option gives it
+GROUP_MEMSIZE = 64
+
 class Hackbench(CommandLineLoad):
     def __init__(self, config, logger):
         CommandLineLoad.__init__(self, "hackbench", config, logger)
@@ -44,21 +46,6 @@ class Hackbench(CommandLineLoad):
 
     def _WorkloadSetup(self):
         'calculate arguments based on input parameters'
-        (mem, units) = self.memsize
-        if units == 'KB':
-            mem = mem / (1024.0 * 1024.0)
-        elif units == 'MB':
-            mem = mem / 1024.0
-        elif units == 'TB':
-            mem = mem * 1024
-        ratio = float(mem) / float(self.num_cpus)
-        if ratio >= 0.75:
-            mult = float(self._cfg.setdefault('jobspercore', 2))
-        else:
-            self._log(Log.INFO, "Low memory system (%f GB/core)! Not running" % ratio)
-            mult = 0
-            self._donotrun = True
-
         sysTop = SysTopology()
         # get the number of nodes
         self.nodes = sysTop.getnodes()
@@ -83,16 +70,27 @@ class Hackbench(CommandLineLoad):
                 self.nodes.remove(node)
                 self._log(Log.DEBUG, "node %s has no available cpus, removing" % node)
 
-        # setup jobs based on the number of cores available per node
+        # setup jobs based on the number of cores available per node, as
+        # far as the available memory of every node allows
+        sizer = LoadSizer(self._log)
         self.jobs = biggest * 3
+        groupmem = int(self._cfg.setdefault('groupmem', GROUP_MEMSIZE)) * 1024 * 1024
+        for n in self.nodes:
+            self.jobs = sizer.instances(sysTop[n], groupmem, self.jobs, "hackbench groups")
+        if self.jobs == 0:
+            self._log(Log.INFO, "Low memory system! Not running")
+            self._donotrun = True
 
-        # figure out if we can use numactl or have to use taskset
+        # figure out if we can use numactl or have to use taskset, a cgroup
+        # per node makes both unnecessary
         self.__usenumactl = False
         self.__multinodes = False
+        if not self._donotrun:
+            self._CreateCgroups(dict([(n, self.cpus[n]) for n in self.nodes]))
         if len(self.nodes) > 1:
             self.__multinodes = True
             self._log(Log.INFO, "running with multiple nodes (%d)" % len(self.nodes))
-            if os.path.exists('/usr/bin/numactl') and not self.cpulist:
+            if os.path.exists('/usr/bin/numactl') and not self.cpulist and not self._cgroup:
                 self.__usenumactl = True
                 self._log(Log.INFO, "using numactl for thread affinity")
 
@@ -109,6 +107,8 @@ class Hackbench(CommandLineLoad):
 
 
     def _WorkloadPrepare(self):
+        # hackbench is restarted as soon as it exits
+        self._setTaskInterval(None)
         self.__nullfp = os.open("/dev/null", os.O_RDWR)
         if self._logging:
             self.__out = self.open_logfile("hackbench.stdout")
@@ -116,14 +116,17 @@ class Hackbench(CommandLineLoad):
         else:
             self.__out = self.__err = self.__nullfp
 
-        self.tasks = {}
+        # hackbench runs for a short while, restart it as soon as it exits
+        self._supervisor = ChildSupervisor('always', self._log, self._cgroup)
 
         self._log(Log.DEBUG, "starting loop (jobs: %d)" % self.jobs)
 
         self.started = False
 
     def __starton(self, node):
-        if self.__multinodes or self.cpulist:
+        if self._cgroup:
+            args = self.args
+        elif self.__multinodes or self.cpulist:
             if self.__usenumactl:
                 args = ['numactl', '--cpunodebind', str(node)] + self.args
             else:
@@ -133,10 +136,10 @@ class Hackbench(CommandLineLoad):
             args = self.args
 
         self._log(Log.DEBUG, "starting on node %s: args = %s" % (node, args))
-        p = subprocess.Popen(args,
-                             stdin=self.__nullfp,
-                             stdout=self.__out,
-                             stderr=self.__err)
+        p = self._Popen(node, args,
+                        stdin=self.__nullfp,
+                        stdout=self.__out,
+                        stderr=self.__err)
         if not p:
             self._log(Log.DEBUG, "hackbench failed to start on node %s" % node)
             raise RuntimeError("hackbench failed to start on node %s" % node)
@@ -146,25 +149,26 @@ class Hackbench(CommandLineLoad):
         if self.shouldStop():
             return
 
-        # just do this once
-        if not self.started:
-            for n in self.nodes:
-                self.tasks[n] = self.__starton(n)
-            self.started = True
-            return
-
-        for n in self.nodes:
-            try:
-                if self.tasks[n].poll() is not None:
-                    self.tasks[n].wait()
-                    self.tasks[n] = self.__starton(n)
-            except OSError as e:
-                if e.errno != errno.ENOMEM:
-                    raise e
-                # Exit gracefully without a traceback for out-of-memory errors
-                self._log(Log.DEBUG, "ERROR, ENOMEM while trying to launch hackbench")
-                print("out-of-memory trying to launch hackbench, exiting")
-                sys.exit(-1)
+        try:
+            # just do this once
+            if not self.started:
+                for n in self.nodes:
+                    self._supervisor.spawn(n, lambda node=n: self.__starton(node))
+                self.started = True
+                return
+
+            if self._UpdateIntensity():
+                # hackbench runs for a short while, the next start has the new size
+                self.args[self.args.index('-g') + 1] = str(self._Scaled(self.jobs))
+                self._log(Log.DEBUG, "scaled to %s groups" % self.args[self.args.index('-g') + 1])
+            self._supervisor.reap()
+        except OSError as e:
+            if e.errno != errno.ENOMEM:
+                raise e
+            # Exit gracefully without a traceback for out-of-memory errors
+            self._log(Log.DEBUG, "ERROR, ENOMEM while trying to launch hackbench")
+            print("out-of-memory trying to launch hackbench, exiting")
+            sys.exit(-1)
 
 
     def WorkloadAlive(self):
@@ -172,18 +176,17 @@ class Hackbench(CommandLineLoad):
         return True
 
 
+    def Scalable(self):
+        return True
+
+
     def _WorkloadCleanup(self):
         if self._donotrun:
             return
 
-        for node in self.nodes:
-            if node in self.tasks and self.tasks[node].poll() is None:
-                self._log(Log.INFO, "cleaning up hackbench on node %s" % node)
-                self.tasks[node].send_signal(SIGKILL)
-                if self.tasks[node].poll() is None:
-                    time.sleep(2)
-            self.tasks[node].wait()
-            del self.tasks[node]
+        self._log(Log.INFO, "cleaning up hackbench")
+        self._supervisor.stop(SIGKILL)
+        self._RemoveCgroups()
 
         os.close(self.__nullfp)
         if self._logging:
@@ -200,6 +203,9 @@ def ModuleParameters():
     return {"jobspercore": {"descr": "Number of working threads per CPU core",
                             "default": 5,
                             "metavar": "NUM"},
+            "groupmem": {"descr": "Memory used by a hackbench group in MB",
+                         "default": GROUP_MEMSIZE,
+                         "metavar": "MB"},
             }
 
 
@@ -28,42 +28,80 @@ import sys
 import os
 import os.path
 import glob
+import shutil
 import subprocess
 from rteval.modules import rtevalRuntimeError
-from rteval.modules.loads import CommandLineLoad
+from rteval.extract import extract_tarball
+from rteval.modules.loads import CommandLineLoad, ChildSupervisor, LoadSizer, \
+    build_cache_key, build_dir, cached_build_dirs, BUILD_STAMP
 from rteval.Log import Log
 from rteval.misc import expand_cpulist, compress_cpulist
 from rteval.systopology import SysTopology
 
 kernel_prefix = "linux-5.7"
 
+# Kernel configuration built by the load
+kernel_config = "allmodconfig"
+
+# Written into an object directory once it is configured
+CONFIG_STAMP = '.rteval-configured'
+
+# Memory used by a compile job in MB, unless the jobmem option gives it
+JOB_MEMSIZE = 512
+
+# Estimates of the space used on tmpfs: the extracted tree relative to the
+# size of the tarball, and an object dir in bytes
+TMPFS_TREE_RATIO = 10
+TMPFS_OBJDIR_SIZE = 4 * 1024 * 1024 * 1024
+
+
+def mem_available():
+    "Returns MemAvailable from /proc/meminfo in bytes"
+    with open('/proc/meminfo') as f:
+        for line in f:
+            if line.startswith('MemAvailable:'):
+                return int(line.split()[1]) * 1024
+    return 0
+
 class KBuildJob:
     '''Class to manage a build job bound to a particular node'''
 
-    def __init__(self, node, kdir, logger=None, cpulist=None):
+    def __init__(self, node, kdir, logger=None, cpulist=None, cgroup=None,
+                 jobspercore=2, sizer=None, jobmem=JOB_MEMSIZE):
         self.kdir = kdir
         self.jobid = None
         self.node = node
         self.logger = logger
         self.builddir = os.path.dirname(kdir)
         self.objdir = "%s/node%d" % (self.builddir, int(node))
+        # the build processes are started in the cgroup of the node, if any
+        self.popen = cgroup and cgroup.popen or subprocess.Popen
         if not os.path.isdir(self.objdir):
             os.mkdir(self.objdir)
-        if os.path.exists('/usr/bin/numactl') and not cpulist:
+        if cgroup:
+            # the cgroup of the node binds the build to it
+            self.binder = ''
+        elif os.path.exists('/usr/bin/numactl') and not cpulist:
             self.binder = 'numactl --cpunodebind %d' % int(self.node)
         else:
             self.binder = 'taskset -c %s' % compress_cpulist(cpulist)
-        if cpulist:
-            self.jobs = self.calc_jobs_per_cpu() * len(cpulist)
-        else:
-            self.jobs = self.calc_jobs_per_cpu() * len(self.node)
-        self.log(Log.DEBUG, "node %d: jobs == %d" % (int(node), self.jobs))
-        self.runcmd = "%s make O=%s -C %s -j%d bzImage modules" \
-                % (self.binder, self.objdir, self.kdir, self.jobs)
-        self.cleancmd = "%s make O=%s -C %s clean allmodconfig" \
-                % (self.binder, self.objdir, self.kdir)
+        ncpus = cpulist and len(cpulist) or len(self.node)
+        self.basejobs = self.calc_jobs(ncpus, jobspercore, sizer or LoadSizer(), jobmem)
+        self.log(Log.DEBUG, "node %d: jobs == %d" % (int(node), self.basejobs))
+        self.setjobs(self.basejobs)
+        self.cleancmd = ("%s make O=%s -C %s clean %s" \
+                % (self.binder, self.objdir, self.kdir, kernel_config)).strip()
+        # a configured object dir only needs the build outputs removed
+        self.resetcmd = ("%s make O=%s -C %s clean" \
+                % (self.binder, self.objdir, self.kdir)).strip()
+
+    def setjobs(self, jobs):
+        '''Sets the number of make jobs, used by the next run()'''
+        self.jobs = jobs
+        self.runcmd = ("%s make O=%s -C %s -j%d bzImage modules" \
+                % (self.binder, self.objdir, self.kdir, self.jobs)).strip()
         self.log(Log.DEBUG, "node%d kcompile command: %s" \
-                % (int(node), self.runcmd))
+                % (int(self.node), self.runcmd))
 
     def __str__(self):
         return self.runcmd
@@ -72,31 +110,40 @@ class KBuildJob:
         if self.logger:
             self.logger.log(logtype, "[kcompile node%d] %s" % (int(self.node), msg))
 
-    def calc_jobs_per_cpu(self):
-        mult = 2
-        self.log(Log.DEBUG, "calulating jobs for node %d" % int(self.node))
-        # get memory total in gigabytes
-        mem = int(self.node.meminfo['MemTotal']) / 1024.0 / 1024.0 / 1024.0
-        # ratio of gigabytes to #cores
-        ratio = float(mem) / float(len(self.node))
-        if ratio < 1.0:
-            ratio = 1.0
-        if ratio < 1.0 or ratio > 2.0:
-            mult = 1
-        self.log(Log.DEBUG, "memory/cores ratio on node %d: %f" % (int(self.node), ratio))
-        self.log(Log.DEBUG, "returning jobs/core value of: %d" % int(ratio) * mult)
-        return int(int(ratio) * int(mult))
+    def calc_jobs(self, ncpus, jobspercore, sizer, jobmem=JOB_MEMSIZE):
+        '''Returns jobspercore jobs for each of ncpus cpus, as far as the
+        memory available on the node allows for jobs of jobmem MB, but at
+        least one'''
+        self.log(Log.DEBUG, "calculating jobs for node %d" % int(self.node))
+        return max(1, sizer.instances(self.node, int(jobmem) * 1024 * 1024,
+                                      int(jobspercore) * ncpus, "make jobs"))
 
     def clean(self, sin=None, sout=None, serr=None):
-        self.log(Log.DEBUG, "cleaning objdir %s" % self.objdir)
-        subprocess.call(self.cleancmd, shell=True,
-                        stdin=sin, stdout=sout, stderr=serr)
+        stamp = os.path.join(self.objdir, CONFIG_STAMP)
+        configured = os.path.exists(os.path.join(self.objdir, '.config'))
+        if configured and os.path.exists(stamp):
+            with open(stamp) as f:
+                configured = f.read().strip() == kernel_config
+        else:
+            configured = False
+        if configured:
+            self.log(Log.DEBUG, "removing the build outputs in %s" % self.objdir)
+            cmd = self.resetcmd
+        else:
+            self.log(Log.DEBUG, "cleaning objdir %s" % self.objdir)
+            cmd = self.cleancmd
+        ret = self.popen(cmd, shell=True, stdin=sin, stdout=sout, stderr=serr).wait()
+        if ret == 0 and not configured:
+            with open(stamp, 'w') as f:
+                f.write(kernel_config)
 
     def run(self, sin=None, sout=None, serr=None):
         self.log(Log.INFO, "starting workload on node %d" % int(self.node))
         self.log(Log.DEBUG, "running on node %d: %s" % (int(self.node), self.runcmd))
-        self.jobid = subprocess.Popen(self.runcmd, shell=True,
-                                      stdin=sin, stdout=sout, stderr=serr)
+        # exec, so signals reach make and not just the shell
+        self.jobid = self.popen("exec %s" % self.runcmd, shell=True,
+                                stdin=sin, stdout=sout, stderr=serr)
+        return self.jobid
 
     def isrunning(self):
         if self.jobid is None:
@@ -122,27 +169,51 @@ class Kcompile(CommandLineLoad):
         if self.source is None:
             raise rtevalRuntimeError(self, " no source tarball specified!")
         self._log(Log.DEBUG, "unpacking kernel tarball")
-        tarargs = ['tar', '-C', self.builddir, '-x']
-        if self.source.endswith(".bz2"):
-            tarargs.append("-j")
-        elif self.source.endswith(".gz"):
-            tarargs.append("-z")
-        tarargs.append("-f")
-        tarargs.append(self.source)
         try:
-            subprocess.call(tarargs)
-        except:
-            self._log(Log.DEBUG, "untar'ing kernel self.source failed!")
-            sys.exit(-1)
+            extract_tarball(self.source, self.cachedir, self.logger)
+        except (OSError, RuntimeError) as err:
+            raise rtevalRuntimeError(self, "untar'ing kernel %s failed: %s" % (self.source, err))
+
+    def _tree_base(self):
+        '''Returns the directory to keep the kernel tree in, the tmpfs given by
+        the tmpfs option when the memory allows it or else the build dir'''
+        tmpfs = self._cfg.tmpfs
+        if not tmpfs:
+            return self.builddir
+        if not os.path.isdir(tmpfs):
+            self._log(Log.WARN, "tmpfs directory %s does not exist, not using it" % tmpfs)
+            return self.builddir
+        base = os.path.join(tmpfs, "rteval-build")
+        need = TMPFS_TREE_RATIO * os.path.getsize(self.source) \
+            + TMPFS_OBJDIR_SIZE * len(self.topology.getnodes())
+        avail = mem_available()
+        if avail < 2 * need:
+            self._log(Log.INFO, "not building on tmpfs, %d MB of memory available, "
+                      "twice the estimated %d MB are needed" % (avail // 2**20, need // 2**20))
+            # a tree cached there by an earlier run would keep holding memory
+            for d in cached_build_dirs(base, "kcompile"):
+                self._log(Log.INFO, "removing the unused kernel tree %s from tmpfs" % d)
+                shutil.rmtree(d, ignore_errors=True)
+            return self.builddir
+        self._log(Log.DEBUG, "building on tmpfs in %s" % tmpfs)
+        if not os.path.isdir(base):
+            os.mkdir(base)
+        return base
 
     def _remove_build_dirs(self):
-        if not os.path.isdir(self.builddir):
+        # the cached trees, on tmpfs as well, and the trees of rteval
+        # versions without the cache
+        dirs = []
+        for base in set([self.builddir, self.treebase]):
+            dirs.extend(cached_build_dirs(base, "kcompile"))
+            for pattern in ("%s*" % kernel_prefix, "node*"):
+                dirs.extend(glob.glob(os.path.join(base, pattern)))
+        if not dirs:
             return
         self._log(Log.DEBUG, "removing kcompile directories in %s" % self.builddir)
         null = os.open("/dev/null", os.O_RDWR)
-        cmd = ["rm", "-rf", os.path.join(self.builddir, "kernel*"),
-               os.path.join(self.builddir, "node*")]
-        ret = subprocess.call(cmd, stdin=null, stdout=null, stderr=null)
+        ret = subprocess.call(["rm", "-rf"] + dirs, stdin=null, stdout=null, stderr=null)
+        os.close(null)
         if ret:
             raise rtevalRuntimeError(self, \
                 "error removing builddir (%s) (ret=%d)" % (self.builddir, ret))
@@ -161,24 +232,11 @@ class Kcompile(CommandLineLoad):
             else:
                 raise rtevalRuntimeError(self, " no kernel tarballs found in %s" % self.srcdir)
 
-        # check for existing directory
-        kdir = None
-        names = os.listdir(self.builddir)
-        for d in names:
-            if d.startswith(kernel_prefix):
-                kdir = d
-                break
-        if kdir is None:
-            self._extract_tarball()
-            names = os.listdir(self.builddir)
-            for d in names:
-                self._log(Log.DEBUG, "checking %s" % d)
-                if d.startswith(kernel_prefix):
-                    kdir = d
-                    break
-        if kdir is None:
-            raise rtevalRuntimeError(self, "Can't find kernel directory!")
-        self.mydir = os.path.join(self.builddir, kdir)
+        # the extracted tree and the object dirs are kept for later runs
+        key = build_cache_key(self.source, kernel_config, stampdir=self.builddir)
+        self.treebase = self._tree_base()
+        self.cachedir = build_dir(self.treebase, "kcompile", key)
+        self.__setup_tree()
         self._log(Log.DEBUG, "mydir = %s" % self.mydir)
         self._log(Log.DEBUG, "systopology: %s" % self.topology)
         self.jobs = len(self.topology)
@@ -201,13 +259,40 @@ class Kcompile(CommandLineLoad):
                 self.nodes.remove(node)
                 self._log(Log.DEBUG, "node %s has no available cpus, removing" % node)
 
+        use_cgroup = self._CreateCgroups(dict([(n, self.cpus[n]) for n in self.nodes]))
+        sizer = LoadSizer(self._log)
         for n in self.nodes:
             self._log(Log.DEBUG, "Configuring build job for node %d" % int(n))
             self.buildjobs[n] = KBuildJob(self.topology[n], self.mydir, \
-                self.logger, self.cpus[n] if self.cpulist else None)
+                self.logger, self.cpus[n] if self.cpulist else None,
+                use_cgroup and self._CgroupOf(n) or None,
+                self._cfg.setdefault('jobspercore', 2), sizer,
+                self._cfg.setdefault('jobmem', JOB_MEMSIZE))
             self.args.append(str(self.buildjobs[n])+";")
 
 
+    def __setup_tree(self):
+        """Finds the kernel tree in the cache directory, after extracting the
+        tarball into it if the cache does not have it yet"""
+        stamp = os.path.join(self.cachedir, BUILD_STAMP)
+        if not os.path.exists(stamp):
+            self._remove_build_dirs()
+            os.mkdir(self.cachedir)
+            self._extract_tarball()
+            kdirs = [d for d in os.listdir(self.cachedir) if d.startswith(kernel_prefix)]
+            if not kdirs:
+                raise rtevalRuntimeError(self, "Can't find kernel directory!")
+            with open(stamp, 'w') as f:
+                f.write(kdirs[0])
+        else:
+            self._log(Log.INFO, "using the cached kernel tree in %s" % self.cachedir)
+
+        with open(stamp) as f:
+            self.mydir = os.path.join(self.cachedir, f.read().strip())
+        if not os.path.isdir(self.mydir):
+            raise rtevalRuntimeError(self, "Can't find kernel directory!")
+
+
     def _WorkloadBuild(self):
         null = os.open("/dev/null", os.O_RDWR)
         if self._logging:
@@ -216,15 +301,21 @@ class Kcompile(CommandLineLoad):
         else:
             out = err = null
 
-        # clean up any damage from previous runs
+        # the builds are done in the object dirs, the source tree only needs
+        # cleaning up when something was built in it
         try:
             cmd = ["make", "-C", self.mydir, "mrproper"]
-            ret = subprocess.call(cmd, stdin=null, stdout=out, stderr=err)
+            if os.path.exists(os.path.join(self.mydir, ".config")):
+                ret = subprocess.call(cmd, stdin=null, stdout=out, stderr=err)
+            else:
+                ret = 0
             if ret:
                 # if the above make failed, remove and reinstall the source tree
                 self._log(Log.DEBUG, "Invalid state in kernel build tree, reloading")
-                self._remove_build_dirs()
-                self._extract_tarball()
+                os.remove(os.path.join(self.cachedir, BUILD_STAMP))
+                self.__setup_tree()
+                for n in self.nodes:
+                    os.mkdir(self.buildjobs[n].objdir)
                 ret = subprocess.call(cmd, stdin=null, stdout=out, stderr=err)
                 if ret:
                     # give up
@@ -243,6 +334,10 @@ class Kcompile(CommandLineLoad):
         self._setReady()
 
     def _WorkloadPrepare(self):
+        # a finished build is restarted at once, a failed one is an error
+        self._setTaskInterval(None)
+        self._supervisor = ChildSupervisor('on-success', self._log, self._cgroup)
+        self.__started = False
         self.__nullfd = os.open("/dev/null", os.O_RDWR)
         if self._logging:
             self.__outfd = self.open_logfile("kcompile.stdout")
@@ -257,39 +352,48 @@ class Kcompile(CommandLineLoad):
             cpulist = ""
 
     def _WorkloadTask(self):
-        for n in self.nodes:
-            if not self.buildjobs[n]:
-                raise RuntimeError("Build job not set up for node %d" % int(n))
-            if self.buildjobs[n].jobid is None or self.buildjobs[n].jobid.poll() is not None:
-                # A jobs was started, but now it finished. Check return code.
-                # -2 is returned when user forced stop of execution (CTRL-C).
-                if self.buildjobs[n].jobid is not None:
-                    if self.buildjobs[n].jobid.returncode != 0 and self.buildjobs[n].jobid.returncode != -2:
-                        raise RuntimeError("kcompile module failed to run (returned %d), please check logs for more detail" \
-                            % self.buildjobs[n].jobid.returncode)
+        if not self.__started:
+            self.__started = True
+            for n in self.nodes:
+                if not self.buildjobs[n]:
+                    raise RuntimeError("Build job not set up for node %d" % int(n))
                 self._log(Log.INFO, "Starting load on node %d" % n)
-                self.buildjobs[n].run(self.__nullfd, self.__outfd, self.__errfd)
+                self._supervisor.spawn(n, lambda job=self.buildjobs[n]:
+                                       job.run(self.__nullfd, self.__outfd, self.__errfd))
+            return
+
+        for (n, returncode) in self._supervisor.reap():
+            # A job failed, as it was not restarted.
+            # -2 is returned when user forced stop of execution (CTRL-C).
+            if returncode != -2:
+                raise RuntimeError("kcompile module failed to run (returned %d), please check logs for more detail" \
+                    % returncode)
 
     def WorkloadAlive(self):
-        # if any of the jobs has stopped, return False
+        # if any of the jobs has stopped, return False.  The jobs are
+        # reaped by the supervisor, which keeps their resource usage
         for n in self.nodes:
-            if self.buildjobs[n].jobid.poll() is not None:
-                # Check return code (see above).
-                if self.buildjobs[n].jobid.returncode != 0 and self.buildjobs[n].jobid.returncode != -2:
-                    raise RuntimeError("kcompile module failed to run (returned %d), please check logs for more detail" % self.buildjobs[n].jobid.returncode)
+            jobid = self.buildjobs[n].jobid
+            if jobid is None or jobid.returncode is not None:
+                # Check return code (see _WorkloadTask()).
+                if jobid is not None and jobid.returncode != 0 and jobid.returncode != -2:
+                    raise RuntimeError("kcompile module failed to run (returned %d), please check logs for more detail" % jobid.returncode)
                 return False
 
-        return True
+        return self._supervisor.running()
+
+
+    def Scalable(self):
+        # a new number of jobs would only apply to the next build, which
+        # usually comes after the end of the run, so the load controller
+        # would get no feedback
+        return False
 
 
     def _WorkloadCleanup(self):
         self._log(Log.DEBUG, "out of stopevent loop")
-        for n in self.buildjobs:
-            if self.buildjobs[n].jobid.poll() is None:
-                self._log(Log.DEBUG, "stopping job on node %d" % int(n))
-                self.buildjobs[n].jobid.terminate()
-                self.buildjobs[n].jobid.wait()
-                del self.buildjobs[n].jobid
+        self._supervisor.stop(timeout=None)
+        self._RemoveCgroups()
         os.close(self.__nullfd)
         del self.__nullfd
         if self._logging:
@@ -307,6 +411,11 @@ def ModuleParameters():
             "jobspercore": {"descr": "Number of working threads per core",
                             "default": 2,
                             "metavar": "NUM"},
+            "jobmem": {"descr": "Memory used by a make job in MB",
+                       "default": JOB_MEMSIZE,
+                       "metavar": "MB"},
+            "tmpfs": {"descr": "tmpfs directory to build in when the memory allows",
+                      "metavar": "DIR"},
             }
 
 
@@ -1,10 +1,8 @@
 """ Module containing class Stressng to manage stress-ng as an rteval load """
 import os
 import os.path
-import time
-import subprocess
 import signal
-from rteval.modules.loads import CommandLineLoad
+from rteval.modules.loads import CommandLineLoad, ChildSupervisor
 from rteval.Log import Log
 from rteval.misc import expand_cpulist
 from rteval.systopology import SysTopology
@@ -38,6 +36,8 @@ class Stressng(CommandLineLoad):
 
     def _WorkloadPrepare(self):
         " Set-up logging "
+        # stress-ng runs for the whole measurement, it is not restarted
+        self._setTaskInterval(None)
         self.__nullfp = os.open("/dev/null", os.O_RDWR)
         self.__in = self.__nullfp
         if self._logging:
@@ -71,23 +71,35 @@ class Stressng(CommandLineLoad):
             if not cpu:
                 nodes.remove(node)
                 self._log(Log.DEBUG, "node %s has no available cpus, removing" % node)
-        if self.cpulist:
+        # stress-ng binds itself unless it runs in a cgroup
+        if not self._CreateCgroups(dict([(n, cpus[n]) for n in nodes]), pernode=False) \
+           and self.cpulist:
             for node in nodes:
                 cpulist = ",".join([str(n) for n in cpus[node]])
                 self.args.append('--taskset %s' % cpulist)
+        self._supervisor = ChildSupervisor('never', self._log, self._cgroup)
 
     def _WorkloadTask(self):
         """ Kick of the workload here """
         if self.started:
-            # Only start the task once
+            if self._UpdateIntensity():
+                # the number of workers is the argument of the stressor
+                self.args[2] = str(self._Scaled(int(self.cfg.arg)))
+                self._log(Log.DEBUG, "restarting with %s" % " ".join(self.args))
+                self._supervisor.restart('stress-ng', signal.SIGINT)
+                self.process = self._supervisor.processes()[0]
+            # Only start the task once, just note when it exited
+            self._supervisor.reap()
             return
 
         self._log(Log.DEBUG, "starting with %s" % " ".join(self.args))
         try:
-            self.process = subprocess.Popen(self.args,
-                                            stdout=self.__out,
-                                            stderr=self.__err,
-                                            stdin=self.__in)
+            self._supervisor.spawn('stress-ng',
+                                   lambda: self._Popen(None, self.args,
+                                                       stdout=self.__out,
+                                                       stderr=self.__err,
+                                                       stdin=self.__in))
+            self.process = self._supervisor.processes()[0]
             self.started = True
             self.jobs = 1
             self._log(Log.DEBUG, "running")
@@ -99,18 +111,20 @@ class Stressng(CommandLineLoad):
     def WorkloadAlive(self):
         " Return true if stress-ng workload is alive "
         if self.started:
-            return self.process.poll() is None
+            return self._supervisor.running()
         return False
 
+    def Scalable(self):
+        " The load can be scaled when the stressor argument is a number of workers "
+        return self.cfg.arg is not None and str(self.cfg.arg).isdigit() and int(self.cfg.arg) > 0
+
     def _WorkloadCleanup(self):
         " Makesure to kill stress-ng before rteval ends "
         if not self.started:
+            self._RemoveCgroups()
             return
-        # poll() returns None if the process is still running
-        while self.process.poll() is None:
-            self._log(Log.DEBUG, "Sending SIGINT")
-            self.process.send_signal(signal.SIGINT)
-            time.sleep(2)
+        self._supervisor.stop(signal.SIGINT)
+        self._RemoveCgroups()
         return
 
 
@@ -107,6 +107,24 @@ class MeasurementProfile(RtEvalModules):
         return False
 
 
+    def Calibrate(self, duration):
+        """Lets all the modules calibrate themselves under load.  Returns the
+        longest run duration the modules need, or None if no module knows"""
+
+        needed = [self.GetNamedModuleObject(m).Calibrate(duration) for m in self.GetModulesList()]
+        needed = [n for n in needed if n is not None]
+        return needed and max(needed) or None
+
+
+    def isConverged(self):
+        """Returns True if all the modules tracking the convergence of their
+        results have converged, and at least one module does this"""
+
+        states = [self.GetNamedModuleObject(m).isConverged() for m in self.GetModulesList()]
+        tracked = [s for s in states if s is not None]
+        return len(tracked) > 0 and all(tracked)
+
+
 class MeasurementModules:
     """Class which takes care of all measurement modules and groups them into
 measurement profiles, based on their characteristics"""
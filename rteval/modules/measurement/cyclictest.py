@@ -29,23 +29,226 @@ import os
 import subprocess
 import signal
 import time
-import tempfile
+import threading
 import math
+from datetime import datetime
+import bisect
+import itertools
+import bz2
+import base64
+import shutil
+from array import array
 import libxml2
+import lxml.etree
 from rteval.Log import Log
 from rteval.modules import rtevalModulePrototype
-from rteval.misc import expand_cpulist, online_cpus, cpuinfo
+from rteval.misc import expand_cpulist, online_cpus, cpuinfo, compress_cpulist
+from rteval.systopology import SysTopology
+from rteval import rawsamples
+
+# NumPy is optional, it is only used to speed up the histogram math
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+class LinearBuckets:
+    "Histogram layout with one bucket per microsecond, as used by cyclictest -h"
+
+    kind = 'linear'
+
+    def __init__(self, nbuckets):
+        self.nbuckets = int(nbuckets)
+
+    def __eq__(self, other):
+        return isinstance(other, LinearBuckets) and self.nbuckets == other.nbuckets
+
+    def index(self, value):
+        "Returns the bucket index for a latency value, or -1 if it is out of range"
+        if value < 0 or value >= self.nbuckets:
+            return -1
+        return value
+
+    def indices(self, values):
+        "Returns the bucket indices of a NumPy array of latencies, -1 when out of range"
+        return numpy.where((values >= 0) & (values < self.nbuckets), values, -1)
+
+    def lower(self, idx):
+        return idx
+
+    def upper(self, idx):
+        return idx
+
+    def midpoints(self, start, stop):
+        "Returns the representative values for the buckets in [start, stop)"
+        if numpy is not None:
+            return numpy.arange(start, stop, dtype=numpy.float64)
+        return list(range(start, stop))
+
+    def properties(self):
+        return {'nbuckets': self.nbuckets}
+
+
+class LogBuckets:
+    """HDR style histogram layout.  Values below 2^precision get one bucket
+    each, every power of two range above that is split into 2^(precision-1)
+    equally sized buckets, which keeps the relative error below
+    1/2^(precision-1) all the way up to maxvalue"""
+
+    kind = 'log'
+
+    def __init__(self, precision=7, maxvalue=(1 << 24)):
+        self.precision = int(precision)
+        self.maxvalue = int(maxvalue)
+        self.__sub = 1 << self.precision
+        self.__half = self.__sub >> 1
+        self.nbuckets = self.index(self.maxvalue - 1) + 1
+        self.__lowers = [self.__lower(i) for i in range(self.nbuckets)]
+        self.__uppers = [self.__lower(i+1) - 1 for i in range(self.nbuckets)]
+
+    def __eq__(self, other):
+        return isinstance(other, LogBuckets) and self.precision == other.precision \
+            and self.maxvalue == other.maxvalue
+
+    def index(self, value):
+        "Returns the bucket index for a latency value, or -1 if it is out of range"
+        if value < 0 or value >= self.maxvalue:
+            return -1
+        if value < self.__sub:
+            return value
+        shift = value.bit_length() - self.precision
+        return self.__sub + (shift - 1) * self.__half + (value >> shift) - self.__half
+
+    def indices(self, values):
+        "Returns the bucket indices of a NumPy array of latencies, -1 when out of range"
+        # frexp() gives the bit length, exact for values below 2^53
+        shift = numpy.maximum(numpy.frexp(values.astype(numpy.float64))[1] - self.precision, 1)
+        idx = numpy.where(values < self.__sub, values,
+                          self.__sub + (shift - 1) * self.__half + (values >> shift) - self.__half)
+        return numpy.where((values >= 0) & (values < self.maxvalue), idx, -1)
+
+    def __lower(self, idx):
+        if idx < self.__sub:
+            return idx
+        (shift, sub) = divmod(idx - self.__sub, self.__half)
+        return (self.__half + sub) << (shift + 1)
+
+    def lower(self, idx):
+        return self.__lowers[idx]
+
+    def upper(self, idx):
+        return self.__uppers[idx]
+
+    def midpoints(self, start, stop):
+        "Returns the representative values for the buckets in [start, stop)"
+        mids = [(self.__lowers[i] + self.__uppers[i]) / 2.0 for i in range(start, stop)]
+        if numpy is not None:
+            return numpy.array(mids, dtype=numpy.float64)
+        return mids
+
+    def properties(self):
+        return {'nbuckets': self.nbuckets,
+                'precision': self.precision,
+                'maxvalue': self.maxvalue}
+
+
+# Tail percentiles recorded for each time window, unless others are given
+WINDOW_PERCENTILES = (('99', 99.0), ('99.9', 99.9))
+
+# Compact histogram encoding, used in place of the <bucket/> elements:
+# (index delta, count) pairs of all non-empty buckets as unsigned LEB128
+# varints, base64 encoded.  The index is the lowest value of the bucket,
+# as in the index attribute of <bucket/>
+HIST_ENCODING = 'delta-varint-base64'
+HIST_SCHEMA = '1'
+
+def encode_histogram(buckets):
+    "Encodes (index, count) pairs, sorted by index, into the compact format"
+    out = bytearray()
+    last = 0
+    for (index, count) in buckets:
+        for v in (index - last, count):
+            while v >= 0x80:
+                out.append((v & 0x7f) | 0x80)
+                v >>= 7
+            out.append(v)
+        last = index
+    return bytes.decode(base64.b64encode(bytes(out)))
+
+
+def decode_histogram(data, encoding=HIST_ENCODING, schema=HIST_SCHEMA):
+    "Decodes a compact histogram into a list of (index, count) pairs"
+    if encoding != HIST_ENCODING or schema != HIST_SCHEMA:
+        raise ValueError("unsupported histogram encoding: %s (schema %s)" % (encoding, schema))
+    vals = []
+    v = 0
+    shift = 0
+    for b in base64.b64decode(data or ''):
+        v |= (b & 0x7f) << shift
+        if b & 0x80:
+            shift += 7
+        else:
+            vals.append(v)
+            v = 0
+            shift = 0
+    if shift or len(vals) % 2:
+        raise ValueError("truncated histogram data")
+    ret = []
+    index = 0
+    for i in range(0, len(vals), 2):
+        index += vals[i]
+        ret.append((index, vals[i+1]))
+    return ret
+
+
+def expand_histograms(xmldoc):
+    """Replaces the compact histograms in a report parsed by lxml with
+    <bucket/> elements, as expected by the XSLT templates"""
+    for hist in xmldoc.xpath('//cyclictest/*/histogram[@encoding]'):
+        layout = None
+        if hist.get('type') == 'log':
+            layout = LogBuckets(precision=int(hist.get('precision')),
+                                maxvalue=int(hist.get('maxvalue', 1 << 24)))
+        buckets = decode_histogram(hist.text, hist.get('encoding'), hist.get('schema'))
+        hist.text = None
+        del hist.attrib['encoding']
+        del hist.attrib['schema']
+        for (index, value) in buckets:
+            b = lxml.etree.SubElement(hist, 'bucket')
+            b.set('index', str(index))
+            if layout:
+                idx = layout.index(index)
+                b.set('width', str(layout.upper(idx) - layout.lower(idx) + 1))
+            b.set('value', str(value))
+
 
 class RunData:
     '''class to keep instance data from a cyclictest run'''
-    def __init__(self, coreid, datatype, priority, logfnc):
+    def __init__(self, coreid, datatype, priority, logfnc, nbuckets=2000, percentiles=None,
+                 layout=None, unit='us', windows=False, windowpcts=None):
         self.__id = coreid
         self.__type = datatype
         self.__priority = int(priority)
+        # all latencies are in this unit, 'us' or 'ns'
+        self.__unit = unit
         self.__description = ''
-        # histogram of data
-        self.__samples = {}
+        # percentiles to report, as a list of (label, percentage) tuples
+        self.__pctdefs = percentiles or []
+        self.__percentiles = []
+        # labels of the percentiles which fall among the overflows
+        self.__pctoverflows = set()
+        # histogram of data, one counter per bucket in the layout
+        self.__layout = layout or LinearBuckets(nbuckets)
+        self.__samples = self.__new_counts(self.__layout.nbuckets)
         self.__numsamples = 0
+        self.__overflows = 0
+        # per-sample output: samples known to be lost, and the largest
+        # number of samples the reader was behind cyclictest
+        self.__lost = 0
+        self.__backlog = 0
+        # exact extremes, when known from the per-sample data or cyclictest itself
+        self.__seen_min = None
+        self.__seen_max = None
         self.__min = 100000000
         self.__max = 0
         self.__stddev = 0.0
@@ -54,12 +257,25 @@ class RunData:
         self.__median = 0.0
         self.__range = 0.0
         self.__mad = 0.0
+        # per time window statistics, as (samples, mean, max, percentiles...)
+        # tuples.  The counts of the current window are kept apart, with
+        # the range of buckets touched, so closing a window only has to
+        # look at those
+        self.__windows = []
+        self.__winpctdefs = windowpcts or WINDOW_PERCENTILES
+        self.__wincounts = None
+        if windows:
+            self.__wincounts = self.__new_counts(self.__layout.nbuckets)
+        self.__winlow = self.__layout.nbuckets
+        self.__winhigh = -1
+        self.__winlock = threading.Lock()
         self._log = logfnc
 
     def __str__(self):
         retval = "id:         %s\n" % self.__id
         retval += "type:       %s\n" % self.__type
         retval += "numsamples: %d\n" % self.__numsamples
+        retval += "overflows:  %d\n" % self.__overflows
         retval += "min:        %d\n" % self.__min
         retval += "max:        %d\n" % self.__max
         retval += "stddev:     %f\n" % self.__stddev
@@ -67,76 +283,336 @@ class RunData:
         retval += "mean:       %f\n" % self.__mean
         return retval
 
+    def __iadd__(self, other):
+        "Adds the histogram of another RunData object into this one"
+        if other.__layout != self.__layout:
+            raise ValueError("can't add histograms with different layouts (%s/%d != %s/%d)"
+                             % (self.__layout.kind, self.__layout.nbuckets,
+                                other.__layout.kind, other.__layout.nbuckets))
+        if other.__unit != self.__unit:
+            raise ValueError("can't add histograms with different units (%s != %s)"
+                             % (self.__unit, other.__unit))
+        if numpy is not None:
+            self.__samples += other.__samples
+        else:
+            for i, v in enumerate(other.__samples):
+                if v:
+                    self.__samples[i] += v
+        self.__numsamples += other.__numsamples
+        self.__overflows += other.__overflows
+        self.__lost += other.__lost
+        self.__backlog = max(self.__backlog, other.__backlog)
+        if other.__seen_min is not None:
+            self.limits(other.__seen_min, other.__seen_max)
+        return self
+
+    def __add__(self, other):
+        "Returns a new RunData object with the histograms of both objects"
+        ret = RunData(self.__id, self.__type, self.__priority, self._log,
+                      percentiles=self.__pctdefs, layout=self.__layout, unit=self.__unit)
+        ret += self
+        ret += other
+        return ret
+
+    @staticmethod
+    def __new_counts(nbuckets):
+        "Returns a zeroed, fixed size array of bucket counters"
+        if numpy is not None:
+            return numpy.zeros(nbuckets, dtype=numpy.uint64)
+        return array('Q', bytes(8 * nbuckets))
+
     def sample(self, value):
-        self.__samples[value] += self.__samples.setdefault(value, 0) + 1
-        if value > self.__max:
-            self.__max = value
-        if value < self.__min:
-            self.__min = value
-        self.__numsamples += 1
+        self.limits(value, value)
+        self.bucket(value, 1)
+
+    def samples(self, values):
+        "Adds a NumPy array of latencies"
+        if not len(values):
+            return
+        self.limits(int(values.min()), int(values.max()))
+        idx = self.__layout.indices(values)
+        idx = idx[idx >= 0]
+        if len(idx) < len(values):
+            self.overflow(len(values) - len(idx))
+        if not len(idx):
+            return
+        counts = numpy.bincount(idx).astype(numpy.uint64)
+        self.__samples[:len(counts)] += counts
+        self.__numsamples += len(idx)
+        if self.__wincounts is not None:
+            low = int(idx.min())
+            with self.__winlock:
+                self.__wincounts[low:len(counts)] += counts[low:]
+                self.__winlow = min(self.__winlow, low)
+                self.__winhigh = max(self.__winhigh, len(counts) - 1)
 
     def bucket(self, index, value):
-        self.__samples[index] = self.__samples.setdefault(index, 0) + value
-        if value and index > self.__max:
-            self.__max = index
-        if value and index < self.__min:
-            self.__min = index
+        if not value:
+            return
+        idx = self.__layout.index(index)
+        if idx < 0:
+            self.overflow(value)
+            return
+        self.__samples[idx] += value
         self.__numsamples += value
+        if self.__wincounts is not None:
+            with self.__winlock:
+                self.__wincounts[idx] += value
+                self.__winlow = min(self.__winlow, idx)
+                self.__winhigh = max(self.__winhigh, idx)
+
+    def overflow(self, count):
+        "Registers samples which did not fit into the histogram"
+        self.__overflows += count
+
+    def lost(self, count, backlog=0):
+        """Registers samples missing from the per-sample output and the
+        number of samples the reader is behind cyclictest"""
+        self.__lost += count
+        self.__backlog = max(self.__backlog, backlog)
+
+    def limits(self, minval=None, maxval=None):
+        "Registers exact minimum and maximum latencies seen"
+        if minval is not None and (self.__seen_min is None or minval < self.__seen_min):
+            self.__seen_min = minval
+        if maxval is not None and (self.__seen_max is None or maxval > self.__seen_max):
+            self.__seen_max = maxval
+
+    def window(self):
+        """Closes a time window and records the statistics of the samples
+        added since the previous one.  Returns the first bucket index and
+        the counts of the closed window, for merge_window()"""
+        with self.__winlock:
+            (low, high) = (self.__winlow, self.__winhigh)
+            if high < low:
+                (low, counts) = (0, self.__wincounts[0:0])
+            elif numpy is not None:
+                counts = self.__wincounts[low:high+1].copy()
+                self.__wincounts[low:high+1] = 0
+            else:
+                counts = self.__wincounts[low:high+1]
+                self.__wincounts[low:high+1] = array('Q', bytes(8 * len(counts)))
+            self.__winlow = self.__layout.nbuckets
+            self.__winhigh = -1
+        self.__window_stats(low, counts)
+        return (low, counts)
+
+    def merge_window(self, low, counts):
+        "Adds the counts of a window closed by another RunData object to the current window"
+        if not len(counts):
+            return
+        with self.__winlock:
+            if numpy is not None:
+                self.__wincounts[low:low+len(counts)] += counts
+            else:
+                for i, v in enumerate(counts):
+                    self.__wincounts[low+i] += v
+            self.__winlow = min(self.__winlow, low)
+            self.__winhigh = max(self.__winhigh, low + len(counts) - 1)
+
+    def __window_stats(self, low, counts):
+        "Records the statistics of a window from its counts, starting at bucket low"
+        if numpy is not None:
+            count = int(counts.sum())
+        else:
+            count = sum(counts)
+        if not count:
+            self.__windows.append((0, 0.0, 0) + (0,) * len(self.__winpctdefs))
+            return
+
+        # the last bucket of the window is never empty
+        high = low + len(counts) - 1
+        values = self.__layout.midpoints(low, high+1)
+        if numpy is not None:
+            total = float(numpy.dot(values, counts.astype(numpy.float64)))
+            cumulative = numpy.cumsum(counts)
+        else:
+            total = sum([v * c for (v, c) in zip(values, counts)])
+            cumulative = list(itertools.accumulate(counts))
+        ranks = [max(1, int(math.ceil(pct * count / 100.0))) for (label, pct) in self.__winpctdefs]
+        self.__windows.append((count, total / count, self.__layout.upper(high))
+                              + tuple(self.__values_at(cumulative, low, ranks)))
 
     def reduce(self):
 
-        # check to see if we have any samples and if we
-        # only have 1 (or none) set the calculated values
-        # to zero and return
-        if self.__numsamples <= 1:
+        # check to see if we have any samples, if not
+        # set the calculated values to zero and return
+        if self.__numsamples == 0:
             self._log(Log.DEBUG, "skipping %s (%d samples)" % (self.__id, self.__numsamples))
             self.__mad = 0
             self.__stddev = 0
             return
 
-        self._log(Log.INFO, "reducing %s" % self.__id)
-        total = 0
-        keys = list(self.__samples.keys())
-        keys.sort()
+        if self.__overflows:
+            self._log(Log.WARN, "%s: %d samples did not fit into the histogram"
+                      % (self.__id, self.__overflows))
+        if self.__lost:
+            self._log(Log.WARN, "%s: about %d samples were lost, the reader fell %d samples "
+                      "behind cyclictest" % (self.__id, self.__lost, self.__backlog))
 
-        mid = self.__numsamples / 2
+        self._log(Log.INFO, "reducing %s" % self.__id)
+        if numpy is not None:
+            self.__reduce_numpy()
+        else:
+            self.__reduce_array()
+
+        # exact extremes are better than the bucket boundaries
+        if self.__seen_min is not None:
+            self.__min = self.__seen_min
+            self.__max = self.__seen_max
+            self.__median = min(self.__median, self.__max)
+            self.__percentiles = [(label, min(value, self.__max))
+                                  for (label, value) in self.__percentiles]
+        self.__range = self.__max - self.__min
+
+    def __reduce_numpy(self):
+        "Calculates all statistics on the histogram in a single vectorised pass"
+        nonzero = numpy.flatnonzero(self.__samples)
+        low = int(nonzero[0])
+        high = int(nonzero[-1])
+
+        # Only look at the populated part of the histogram
+        counts = self.__samples[low:high+1]
+        fcounts = counts.astype(numpy.float64)
+        values = self.__layout.midpoints(low, high+1)
+        cumulative = numpy.cumsum(counts)
+        nsamples = float(self.__numsamples)
+
+        mean = float(numpy.dot(values, fcounts)) / nsamples
+        deviation = values - mean
+        self.__min = self.__layout.lower(low)
+        self.__max = self.__layout.upper(high)
+        self.__mean = mean
+        self.__mode = self.__layout.lower(low + int(numpy.argmax(counts)))
+        self.__median = self.__median_from(cumulative, low)
+        self.__percentiles = self.__percentiles_from(cumulative, low)
+        self.__mad = float(numpy.dot(numpy.abs(deviation), fcounts)) / nsamples
+        if nsamples > 1:
+            self.__stddev = math.sqrt(float(numpy.dot(deviation * deviation, fcounts))
+                                      / (nsamples - 1))
+        else:
+            self.__stddev = 0.0
 
-        # mean, mode, and median
+    def __reduce_array(self):
+        "Calculates all statistics on the histogram without NumPy"
+        low = None
+        high = 0
+        total = 0
+        sqtotal = 0
         occurances = 0
-        lastkey = -1
-        for i in keys:
-            if mid > total and mid <= (total + self.__samples[i]):
-                if self.__numsamples & 1 and mid == total+1:
-                    self.__median = (lastkey + i) / 2
-                else:
-                    self.__median = i
-            total += (i * self.__samples[i])
-            if self.__samples[i] > occurances:
-                occurances = self.__samples[i]
-                self.__mode = i
-        self.__mean = float(total) / float(self.__numsamples)
-
-        # range
-        for i in keys:
-            if self.__samples[i]:
+        cumulative = []
+        seen = 0
+        for i, count in enumerate(self.__samples):
+            if not count:
+                if low is not None and seen < self.__numsamples:
+                    cumulative.append(seen)
+                continue
+            if low is None:
                 low = i
-                break
-        high = keys[-1]
-        while high and self.__samples[high] == 0:
-            high -= 1
-        self.__range = high - low
-
-        # Mean Absolute Deviation and standard deviation
-        madsum = 0
-        varsum = 0
-        for i in keys:
-            madsum += float(abs(float(i) - self.__mean) * self.__samples[i])
-            varsum += float(((float(i) - self.__mean) ** 2) * self.__samples[i])
-        self.__mad = madsum / self.__numsamples
-        self.__stddev = math.sqrt(varsum / (self.__numsamples - 1))
-
-
-    def MakeReport(self):
+            high = i
+            seen += count
+            cumulative.append(seen)
+            if count > occurances:
+                occurances = count
+                self.__mode = self.__layout.lower(i)
+
+        values = self.__layout.midpoints(low, high+1)
+        for i, v in enumerate(values):
+            count = self.__samples[low+i]
+            total += v * count
+            sqtotal += v * v * count
+
+        nsamples = self.__numsamples
+        mean = float(total) / nsamples
+        self.__min = self.__layout.lower(low)
+        self.__max = self.__layout.upper(high)
+        self.__mean = mean
+        self.__median = self.__median_from(cumulative, low)
+        self.__percentiles = self.__percentiles_from(cumulative, low)
+        self.__mad = sum([abs(v - mean) * self.__samples[low+i]
+                          for i, v in enumerate(values)]) / nsamples
+        if nsamples > 1:
+            variance = (sqtotal - nsamples * mean * mean) / (nsamples - 1)
+            self.__stddev = math.sqrt(max(variance, 0.0))
+        else:
+            self.__stddev = 0.0
+
+    def __values_at(self, cumulative, offset, ranks):
+        """Looks up the values of the samples with the given 1-based ranks in a
+        cumulative histogram, where the first element represents the bucket
+        index given by offset.  For buckets wider than 1us the highest value
+        the bucket can hold is returned"""
+        if numpy is not None and isinstance(cumulative, numpy.ndarray):
+            idx = [int(i) for i in numpy.searchsorted(cumulative, ranks, side='left')]
+        else:
+            idx = [bisect.bisect_left(cumulative, r) for r in ranks]
+        return [self.__layout.upper(offset + i) for i in idx]
+
+    def __median_from(self, cumulative, offset):
+        "Looks up the median in a cumulative histogram"
+        nsamples = self.__numsamples
+        (lower, upper) = self.__values_at(cumulative, offset,
+                                          [(nsamples + 1) // 2, nsamples // 2 + 1])
+        if lower == upper:
+            return lower
+        return (lower + upper) / 2
+
+    def __percentiles_from(self, cumulative, offset):
+        """Looks up all the configured percentiles in a cumulative histogram,
+        using the nearest-rank method.  The ranks count the overflows as
+        samples above the histogram.  A percentile which falls among them is
+        beyond the histogram, it is given as the highest latency seen or else
+        as the upper limit of the histogram, and its label is kept in
+        __pctoverflows"""
+        self.__pctoverflows = set()
+        if not self.__pctdefs:
+            return []
+        total = self.__numsamples + self.__overflows
+        ranks = [max(1, int(math.ceil(pct * total / 100.0)))
+                 for (label, pct) in self.__pctdefs]
+        values = self.__values_at(cumulative, offset,
+                                  [min(r, self.__numsamples) for r in ranks])
+        if self.__seen_max is not None:
+            beyond = self.__seen_max
+        else:
+            beyond = self.__layout.upper(self.__layout.nbuckets - 1)
+        for i, (label, pct) in enumerate(self.__pctdefs):
+            if ranks[i] > self.__numsamples:
+                self.__pctoverflows.add(label)
+                values[i] = beyond
+        return [(label, values[i]) for i, (label, pct) in enumerate(self.__pctdefs)]
+
+    def confidence(self, pct, z=1.96):
+        """Returns (lower, estimate, upper) for a percentile of the live
+        histogram.  The bounds are the values of the order statistics around
+        the percentile rank which cover it with the confidence given by z
+        (1.96 gives 95%), no assumptions about the distribution are made.
+        Returns None while there are too few samples to bound the percentile"""
+        if numpy is not None:
+            cumulative = numpy.cumsum(self.__samples)
+        else:
+            cumulative = list(itertools.accumulate(self.__samples))
+        nsamples = len(cumulative) and int(cumulative[-1]) or 0
+        p = pct / 100.0
+        spread = z * math.sqrt(nsamples * p * (1.0 - p))
+        ranks = [int(math.floor(nsamples * p - spread)),
+                 max(1, int(math.ceil(nsamples * p))),
+                 int(math.ceil(nsamples * p + spread)) + 1]
+        if ranks[0] < 1 or ranks[2] > nsamples:
+            return None
+        return tuple(self.__values_at(cumulative, 0, ranks))
+
+    def statistics(self):
+        """Returns the number of samples, the overflows, the maximum and the
+        percentiles (as a dictionary keyed by label) found by reduce()"""
+        return {'samples': self.__numsamples,
+                'overflows': self.__overflows,
+                'lost': self.__lost,
+                'max': self.__max,
+                'percentiles': dict(self.__percentiles)}
+
+
+    def MakeReport(self, compact=False):
         rep_n = libxml2.newNode(self.__type)
         if self.__type == 'system':
             rep_n.newProp('description', self.__description)
@@ -150,44 +626,458 @@ class RunData:
 
         if self.__numsamples > 0:
             n = stat_n.newTextChild(None, 'minimum', str(self.__min))
-            n.newProp('unit', 'us')
+            n.newProp('unit', self.__unit)
 
             n = stat_n.newTextChild(None, 'maximum', str(self.__max))
-            n.newProp('unit', 'us')
+            n.newProp('unit', self.__unit)
 
             n = stat_n.newTextChild(None, 'median', str(self.__median))
-            n.newProp('unit', 'us')
+            n.newProp('unit', self.__unit)
 
             n = stat_n.newTextChild(None, 'mode', str(self.__mode))
-            n.newProp('unit', 'us')
+            n.newProp('unit', self.__unit)
 
             n = stat_n.newTextChild(None, 'range', str(self.__range))
-            n.newProp('unit', 'us')
+            n.newProp('unit', self.__unit)
 
             n = stat_n.newTextChild(None, 'mean', str(self.__mean))
-            n.newProp('unit', 'us')
+            n.newProp('unit', self.__unit)
 
             n = stat_n.newTextChild(None, 'mean_absolute_deviation', str(self.__mad))
-            n.newProp('unit', 'us')
+            n.newProp('unit', self.__unit)
 
             n = stat_n.newTextChild(None, 'standard_deviation', str(self.__stddev))
-            n.newProp('unit', 'us')
+            n.newProp('unit', self.__unit)
+
+            if self.__overflows:
+                stat_n.newTextChild(None, 'overflows', str(self.__overflows))
+
+            if self.__lost:
+                n = stat_n.newTextChild(None, 'lost_samples', str(self.__lost))
+                n.newProp('backlog', str(self.__backlog))
+
+            if self.__percentiles:
+                pct_n = stat_n.newChild(None, 'percentiles', None)
+                for (label, value) in self.__percentiles:
+                    n = pct_n.newTextChild(None, 'percentile', str(value))
+                    n.newProp('p', label)
+                    n.newProp('unit', self.__unit)
+                    if label in self.__pctoverflows:
+                        n.newProp('overflow', 'yes')
+
+            if self.__windows:
+                ts_n = rep_n.newChild(None, 'timeseries', None)
+                ts_n.newProp('windows', str(len(self.__windows)))
+                ts_n.newTextChild(None, 'samples',
+                                  " ".join([str(w[0]) for w in self.__windows]))
+                n = ts_n.newTextChild(None, 'mean',
+                                      " ".join(["%.2f" % w[1] for w in self.__windows]))
+                n.newProp('unit', self.__unit)
+                n = ts_n.newTextChild(None, 'maximum',
+                                      " ".join([str(min(w[2], self.__max))
+                                                for w in self.__windows]))
+                n.newProp('unit', self.__unit)
+                for i, (label, pct) in enumerate(self.__winpctdefs):
+                    n = ts_n.newTextChild(None, 'percentile',
+                                          " ".join([str(min(w[3+i], self.__max))
+                                                    for w in self.__windows]))
+                    n.newProp('p', label)
+                    n.newProp('unit', self.__unit)
 
             hist_n = rep_n.newChild(None, 'histogram', None)
-            hist_n.newProp('nbuckets', str(len(self.__samples)))
-            keys = list(self.__samples.keys())
-            keys.sort()
-            for k in keys:
-                if self.__samples[k] == 0:
-                    # Don't report buckets without any samples
-                    continue
+            hist_n.newProp('unit', self.__unit)
+            if self.__layout.kind != 'linear':
+                hist_n.newProp('type', self.__layout.kind)
+            for (k, v) in list(self.__layout.properties().items()):
+                hist_n.newProp(k, str(v))
+            if numpy is not None:
+                buckets = numpy.flatnonzero(self.__samples)
+            else:
+                # Don't report buckets without any samples
+                buckets = [i for i, v in enumerate(self.__samples) if v]
+            if compact:
+                hist_n.newProp('encoding', HIST_ENCODING)
+                hist_n.newProp('schema', HIST_SCHEMA)
+                hist_n.addContent(encode_histogram([(self.__layout.lower(k), int(self.__samples[k]))
+                                                    for k in buckets]))
+                buckets = []
+            for k in buckets:
                 b_n = hist_n.newChild(None, 'bucket', None)
-                b_n.newProp('index', str(k))
+                b_n.newProp('index', str(self.__layout.lower(k)))
+                if self.__layout.kind != 'linear':
+                    b_n.newProp('width', str(self.__layout.upper(k) - self.__layout.lower(k) + 1))
                 b_n.newProp('value', str(self.__samples[k]))
 
         return rep_n
 
 
+class OutlierLog:
+    """Ring buffer keeping the most recent samples above a latency threshold,
+    its size does not depend on the length of the run"""
+
+    def __init__(self, threshold, capacity=1000, unit='us'):
+        self.threshold = int(threshold)
+        self.unit = unit
+        self.__capacity = int(capacity)
+        self.__stamps = array('d', [0.0]) * self.__capacity
+        self.__cpus = array('I', [0]) * self.__capacity
+        self.__latencies = array('I', [0]) * self.__capacity
+        self.__count = 0
+        # to convert the monotonic timestamps to wall clock time
+        self.__walloffset = time.time() - time.monotonic()
+
+
+    def __len__(self):
+        return min(self.__count, self.__capacity)
+
+
+    def add(self, cpu, latency, stamp=None):
+        "Records an outlier, overwriting the oldest one when the log is full"
+        i = self.__count % self.__capacity
+        self.__stamps[i] = time.monotonic() if stamp is None else stamp
+        self.__cpus[i] = cpu
+        self.__latencies[i] = latency
+        self.__count += 1
+
+
+    def events(self):
+        "Returns the logged (monotonic timestamp, cpu, latency) tuples, oldest first"
+        n = len(self)
+        first = self.__count - n
+        return [(self.__stamps[i % self.__capacity],
+                 self.__cpus[i % self.__capacity],
+                 self.__latencies[i % self.__capacity]) for i in range(first, first + n)]
+
+
+    def MakeReport(self):
+        rep_n = libxml2.newNode('outliers')
+        rep_n.newProp('threshold', str(self.threshold))
+        rep_n.newProp('unit', self.unit)
+        rep_n.newProp('count', str(self.__count))
+        rep_n.newProp('dropped', str(self.__count - len(self)))
+        for (stamp, cpu, latency) in self.events():
+            o_n = rep_n.newChild(None, 'outlier', None)
+            o_n.newProp('monotonic', "%.6f" % stamp)
+            o_n.newProp('time', str(datetime.fromtimestamp(stamp + self.__walloffset)))
+            o_n.newProp('cpu', str(cpu))
+            o_n.newProp('latency', str(latency))
+        return rep_n
+
+
+class SnapshotTracer:
+    """Saves the ftrace snapshot buffer each time a latency threshold is
+    exceeded, without stopping cyclictest.  The configured tracer and
+    events are set up while it runs.  When the kernel has synthetic events
+    the snapshot is taken by the kernel itself, by a snapshot trigger on
+    the wakeup latency of the cyclictest threads, so the trace buffer holds
+    the moment of the spike however far behind the reader is.  Otherwise
+    the snapshot is taken when the reader sees the sample.  The snapshots
+    are copied and compressed by a niced thread on the housekeeping CPUs"""
+
+    SYNTH_EVENT = 'rteval_latency'
+    POLL_INTERVAL = 1.0
+
+    def __init__(self, tracedir, outdir, threshold, housekeeping, logfnc,
+                 maxcaptures=20, holdoff=1.0, unit='us', tracer=None, events=None):
+        self.threshold = int(threshold)
+        self.unit = unit
+        self.__tracedir = tracedir
+        self.__snapshot = os.path.join(tracedir, 'snapshot')
+        self.__outdir = outdir
+        self.__housekeeping = housekeeping
+        self.__maxcaptures = int(maxcaptures)
+        self.__holdoff = holdoff
+        self.__tracer = tracer
+        self.__events = events or []
+        self._log = logfnc
+        self.__saved = {}
+        # (file, command) of the triggers set up in the kernel, in setup order
+        self.__triggers = []
+        self.__armcmd = None
+        self.__marker = None
+        self.__crossings = 0
+        self.__pending = None
+        self.__captures = []
+        self.__lock = threading.Lock()
+        self.__wakeup = threading.Event()
+        self.__stop = threading.Event()
+        self.__thread = None
+
+
+    def __path(self, *names):
+        return os.path.join(self.__tracedir, *names)
+
+
+    def __write(self, value, fname=None, mode='w'):
+        fp = open(fname or self.__snapshot, mode)
+        fp.write(value)
+        fp.close()
+
+
+    def __read(self, fname):
+        fp = open(fname)
+        ret = fp.read()
+        fp.close()
+        return ret
+
+
+    def __setup_tracing(self):
+        "Selects the configured tracer and events, the previous ones are restored by stop()"
+        if self.__tracer:
+            self.__saved['current_tracer'] = self.__read(self.__path('current_tracer')).strip()
+            self.__write(self.__tracer, self.__path('current_tracer'))
+        if self.__events:
+            self.__saved['set_event'] = ' '.join(self.__read(self.__path('set_event')).split())
+            self.__write(' '.join(self.__events), self.__path('set_event'))
+
+
+    def __setup_trigger(self):
+        """Sets up a synthetic event with the wakeup latency of the cyclictest
+        threads and a snapshot trigger on it.  Returns False when the kernel
+        can't do that"""
+        if not os.path.exists(self.__path('synthetic_events')) \
+           or not os.path.isdir(self.__path('events', 'sched', 'sched_waking')):
+            return False
+        stamp = self.unit == 'ns' and 'common_timestamp' or 'common_timestamp.usecs'
+        triggers = [
+            (self.__path('synthetic_events'), '%s u64 lat; pid_t pid' % self.SYNTH_EVENT),
+            (self.__path('events', 'sched', 'sched_waking', 'trigger'),
+             'hist:keys=pid:rteval_ts0=%s if comm=="cyclictest"' % stamp),
+            (self.__path('events', 'sched', 'sched_switch', 'trigger'),
+             'hist:keys=next_pid:rteval_lat=%s-$rteval_ts0:onmatch(sched.sched_waking).%s'
+             '($rteval_lat,next_pid) if next_comm=="cyclictest"' % (stamp, self.SYNTH_EVENT))]
+        try:
+            for (fname, cmd) in triggers:
+                self.__write(cmd, fname, 'a')
+                self.__triggers.append((fname, cmd))
+            self.__armcmd = 'snapshot:1 if lat >= %d' % self.threshold
+            self.__arm()
+        except (IOError, OSError) as err:
+            self._log(Log.INFO, "no in-kernel trace snapshots (%s), taking them from "
+                      "the reader" % err)
+            self.__armcmd = None
+            self.__remove_triggers()
+            return False
+        return True
+
+
+    def __arm(self):
+        "(Re)arms the snapshot trigger, truncating the trigger file drops the fired one"
+        self.__write(self.__armcmd, self.__path('events', 'synthetic', self.SYNTH_EVENT, 'trigger'))
+
+
+    def __fired(self):
+        "Checks if the snapshot trigger has used up its count"
+        fname = self.__path('events', 'synthetic', self.SYNTH_EVENT, 'trigger')
+        return 'count=0' in self.__read(fname)
+
+
+    def __remove_triggers(self):
+        for (fname, cmd) in reversed(self.__triggers):
+            try:
+                self.__write('!' + cmd, fname, 'a')
+            except (IOError, OSError) as err:
+                self._log(Log.WARN, "failed to remove trace trigger '%s': %s" % (cmd, err))
+        self.__triggers = []
+
+
+    def start(self):
+        if not os.path.isdir(self.__outdir):
+            os.mkdir(self.__outdir)
+        self.__setup_tracing()
+        # Allocate the snapshot buffer now, so the first capture is fast
+        self.__write('1')
+        self.__write('2')
+        if self.__setup_trigger():
+            self._log(Log.DEBUG, "trace snapshots are taken by the kernel")
+        try:
+            # spikes seen by the reader are marked in the trace
+            self.__marker = open(self.__path('trace_marker'), 'w')
+        except (IOError, OSError):
+            self.__marker = None
+        self.__thread = threading.Thread(target=self.__task, name="cyclictest-tracer")
+        self.__thread.daemon = True
+        self.__thread.start()
+
+
+    def stop(self):
+        if self.__thread is None:
+            return
+        self.__stop.set()
+        self.__wakeup.set()
+        self.__thread.join()
+        self.__thread = None
+        if self.__armcmd:
+            try:
+                self.__write('', self.__path('events', 'synthetic', self.SYNTH_EVENT, 'trigger'))
+            except (IOError, OSError):
+                pass
+        self.__remove_triggers()
+        if self.__marker:
+            self.__marker.close()
+            self.__marker = None
+        for (fname, value) in list(self.__saved.items()):
+            try:
+                self.__write(value, self.__path(fname))
+            except (IOError, OSError) as err:
+                self._log(Log.WARN, "failed to restore %s: %s" % (fname, err))
+        try:
+            # free the snapshot buffer
+            self.__write('0')
+        except (IOError, OSError):
+            pass
+
+
+    def trigger(self, cpu, sampleseq, latency):
+        """Called from the reader thread for each sample above the threshold.
+        Crossings arriving while a capture is pending are merged into it"""
+        if self.__marker:
+            try:
+                self.__marker.write("rteval: cpu %d cycle %d latency %d%s\n"
+                                    % (cpu, sampleseq, latency, self.unit))
+                self.__marker.flush()
+            except (IOError, OSError):
+                pass
+        with self.__lock:
+            self.__crossings += 1
+            if self.__pending is None or latency > self.__pending[2]:
+                self.__pending = (cpu, sampleseq, latency, time.time())
+        self.__wakeup.set()
+
+
+    def __task(self):
+        # Keep out of the way of the measurement threads
+        try:
+            if self.__housekeeping:
+                os.sched_setaffinity(0, self.__housekeeping)
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 19)
+        except (AttributeError, OSError) as err:
+            self._log(Log.DEBUG, "could not move the tracer thread: %s" % err)
+
+        while True:
+            # the kernel trigger is polled, the reader wakes us up earlier
+            self.__wakeup.wait(self.__armcmd and self.POLL_INTERVAL or None)
+            self.__wakeup.clear()
+            if len(self.__captures) < self.__maxcaptures:
+                if self.__armcmd:
+                    self.__kernel_capture()
+                else:
+                    with self.__lock:
+                        event = self.__pending
+                        self.__pending = None
+                    if event is not None:
+                        self.__capture(event, swap=True)
+                        # rate limit the captures, spikes tend to come in bursts
+                        self.__stop.wait(self.__holdoff)
+            if self.__stop.is_set() and (self.__armcmd or self.__pending is None):
+                break
+
+
+    def __kernel_capture(self):
+        "Saves the snapshot the kernel took, if it took one, and rearms the trigger"
+        try:
+            if not self.__fired():
+                return
+        except (IOError, OSError) as err:
+            self._log(Log.WARN, "failed to check the trace snapshot trigger: %s" % err)
+            return
+        # the largest sample the reader saw since the last capture, if any
+        with self.__lock:
+            event = self.__pending or (-1, -1, -1, time.time())
+            self.__pending = None
+        self.__capture(event, swap=False)
+        self.__stop.wait(self.__holdoff)
+        try:
+            self.__arm()
+        except (IOError, OSError) as err:
+            self._log(Log.WARN, "failed to rearm the trace snapshot trigger: %s" % err)
+
+
+    def __capture(self, event, swap):
+        (cpu, sampleseq, latency, when) = event
+        fname = 'trace-%03d.txt.bz2' % (len(self.__captures) + 1)
+        try:
+            if swap:
+                # swap the live trace buffer into the snapshot buffer
+                self.__write('1')
+            src = open(self.__snapshot, 'rb')
+            dst = bz2.open(os.path.join(self.__outdir, fname), 'wb')
+            shutil.copyfileobj(src, dst)
+            dst.close()
+            src.close()
+            if swap:
+                self.__write('2')
+        except (IOError, OSError) as err:
+            self._log(Log.WARN, "failed to capture trace snapshot: %s" % err)
+            return
+        self._log(Log.DEBUG, "saved trace snapshot %s (cpu %d: %d%s)"
+                  % (fname, cpu, latency, self.unit))
+        self.__captures.append((fname, cpu, sampleseq, latency, when,
+                                swap and 'reader' or 'kernel'))
+
+
+    def MakeReport(self):
+        rep_n = libxml2.newNode('tracecaptures')
+        rep_n.newProp('threshold', str(self.threshold))
+        rep_n.newProp('unit', self.unit)
+        rep_n.newProp('crossings', str(self.__crossings))
+        rep_n.newProp('directory', os.path.basename(self.__outdir))
+        if self.__tracer:
+            rep_n.newProp('tracer', self.__tracer)
+        if self.__events:
+            rep_n.newProp('events', ','.join(self.__events))
+        for (fname, cpu, sampleseq, latency, when, trigger) in self.__captures:
+            c_n = rep_n.newChild(None, 'capture', None)
+            c_n.newProp('file', fname)
+            c_n.newProp('trigger', trigger)
+            if cpu >= 0:
+                # the largest sample read since the previous capture
+                c_n.newProp('cpu', str(cpu))
+                c_n.newProp('sampleseq', str(sampleseq))
+                c_n.newProp('latency', str(latency))
+            c_n.newProp('time', str(datetime.fromtimestamp(when)))
+        return rep_n
+
+
+# Latency units cyclictest can report in, as the number of units per
+# microsecond.  Nanoseconds always use log scaled buckets, up to about 17s
+UNIT_SCALE = {'us': 1, 'ns': 1000}
+NSECS_MAXVALUE = 1 << 34
+
+# Calibration run: histogram size, largest linear histogram chosen, samples
+# wanted above the highest percentile and the shortest run suggested
+CALIBRATION_BUCKETS = 100000
+CALIBRATION_MAXLINEAR = 20000
+CALIBRATION_TAIL = 10
+CALIBRATION_MINRUN = 60
+
+# In the per-sample mode cyclictest keeps the last VALBUF_SIZE samples of
+# each thread until they are printed, a reader further behind loses samples.
+# PERSAMPLE_BUDGET is the number of samples/s a reader thread keeps up with
+VALBUF_SIZE = 16384
+PERSAMPLE_BUDGET = numpy is not None and 1000000 or 200000
+READ_BLOCKSIZE = 1 << 20
+
+
+def parse_percentiles(pctlist):
+    "Parses a comma separated list of percentiles into (label, value) tuples"
+    ret = []
+    if not pctlist:
+        return ret
+    for p in str(pctlist).split(','):
+        p = p.strip()
+        if not p:
+            continue
+        try:
+            val = float(p)
+        except ValueError:
+            raise ValueError("invalid cyclictest percentile: '%s'" % p)
+        if val <= 0 or val > 100:
+            raise ValueError("cyclictest percentile out of range (0, 100]: %s" % p)
+        ret.append((p, val))
+    return ret
+
+
 class Cyclictest(rtevalModulePrototype):
     def __init__(self, config, logger=None):
         rtevalModulePrototype.__init__(self, 'measurement', 'cyclictest', logger)
@@ -197,6 +1087,52 @@ class Cyclictest(rtevalModulePrototype):
         self.__numanodes = int(self.__cfg.setdefault('numanodes', 0))
         self.__priority = int(self.__cfg.setdefault('priority', 95))
         self.__buckets = int(self.__cfg.setdefault('buckets', 2000))
+        self.__percentiles = parse_percentiles(self.__cfg.percentiles)
+        self.__histtype = str(self.__cfg.setdefault('histogram', 'linear')).lower()
+        self.__unit = str(self.__cfg.setdefault('resolution', 'us')).lower()
+        if self.__unit not in UNIT_SCALE:
+            raise ValueError("unknown cyclictest resolution: '%s'" % self.__unit)
+        self.__scale = UNIT_SCALE[self.__unit]
+        if self.__unit == 'ns':
+            # A linear histogram with 1ns buckets would need 1000 times
+            # the memory, nanoseconds are only kept in log scaled buckets
+            if self.__histtype != 'log':
+                self._log(Log.INFO, "using the log histogram for nanosecond resolution")
+            self.__histtype = 'log'
+            self.__layout = LogBuckets(maxvalue=NSECS_MAXVALUE)
+        elif self.__histtype == 'log':
+            # shared by all the RunData objects, the layout is never modified
+            self.__layout = LogBuckets()
+        elif self.__histtype == 'linear':
+            self.__layout = None
+        else:
+            raise ValueError("unknown cyclictest histogram type: '%s'" % self.__histtype)
+        encoding = str(self.__cfg.setdefault('histencoding', 'xml')).lower()
+        if encoding not in ('xml', 'compact'):
+            raise ValueError("unknown cyclictest histogram encoding: '%s'" % encoding)
+        self.__compact = encoding == 'compact'
+        self.__convergence = self.__cfg.convergence and float(self.__cfg.convergence) or None
+        if self.__convergence:
+            self.__convergepct = parse_percentiles(self.__cfg.setdefault('convergepct', '99.9,99.99'))
+            self.__convergemin = float(self.__cfg.setdefault('convergemin', 600))
+            self._setConverged(False)
+        self.__window = self.__cfg.window and float(self.__cfg.window) or None
+        self.__windowpcts = parse_percentiles(self.__cfg.setdefault('windowpct', '99,99.9'))
+        self.__rawfile = self.__cfg.rawcapture and \
+            os.path.join(self.__cfg.reportdir or os.getcwd(), self.__cfg.rawcapture) or None
+        self.__rawwriter = None
+        self.__tracethreshold = self.__cfg.tracethreshold and int(self.__cfg.tracethreshold) or None
+        self.__tracer = None
+        self.__outliers = None
+        if self.__cfg.outliers:
+            self.__outliers = OutlierLog(int(self.__cfg.outliers) * self.__scale,
+                                         self.__cfg.setdefault('outliermax', 1000),
+                                         unit=self.__unit)
+        # cyclictest only writes its histogram when it exits, live data
+        # requires it to report each sample
+        self.__persample = self.__histtype == 'log' or self.__window is not None \
+            or self.__rawfile is not None or self.__tracethreshold is not None \
+            or self.__outliers is not None or self.__convergence is not None
         self.__numcores = 0
         self.__cpus = []
         self.__cyclicdata = {}
@@ -210,19 +1146,17 @@ class Cyclictest(rtevalModulePrototype):
             self.__cpus = online_cpus()
 
         self.__numcores = len(self.__cpus)
+        self.__shardgroups = self.__shard_groups()
 
         info = cpuinfo()
 
         # create a RunData object for each core we'll measure
         for core in self.__cpus:
-            self.__cyclicdata[core] = RunData(core, 'core', self.__priority,
-                                              logfnc=self._log)
+            self.__cyclicdata[core] = self.__new_rundata(core, 'core')
             self.__cyclicdata[core].description = info[core]['model name']
 
         # Create a RunData object for the overall system
-        self.__cyclicdata['system'] = RunData('system',
-                                              'system', self.__priority,
-                                              logfnc=self._log)
+        self.__cyclicdata['system'] = self.__new_rundata('system', 'system')
         self.__cyclicdata['system'].description = ("(%d cores) " % self.__numcores) + info['0']['model name']
 
         if self.__sparse:
@@ -230,8 +1164,68 @@ class Cyclictest(rtevalModulePrototype):
         else:
             self._log(Log.DEBUG, "system has %d cpu cores" % self.__numcores)
         self.__started = False
-        self.__cyclicoutput = None
+        self.__shards = []
+        self.__spikelock = threading.Lock()
         self.__breaktraceval = None
+        self.__windowthread = None
+        self.__windowstop = threading.Event()
+        self.__windowstart = None
+        self.__windowcount = 0
+        self.__lastwindow = None
+        self.__convergestart = None
+        self.__convergecheck = None
+        self.__convergetime = None
+        self.__bounds = []
+        self.__calibration = None
+
+
+    def __new_rundata(self, coreid, datatype):
+        "Creates a RunData object using the configured histogram layout"
+        return RunData(coreid, datatype, self.__priority,
+                       logfnc=self._log, nbuckets=self.__buckets,
+                       percentiles=self.__percentiles, layout=self.__layout,
+                       unit=self.__unit, windows=self.__window is not None,
+                       windowpcts=self.__windowpcts)
+
+
+    @staticmethod
+    def __trailer_values(line, cpus):
+        "Returns (cpu, value) tuples from a per thread histogram trailer line"
+        vals = line.split(':', 1)[1].split()
+        return [(cpus[i], int(v)) for i, v in enumerate(vals[:len(cpus)])]
+
+
+    def __shard_groups(self):
+        """Returns the (numa node, cpus) groups to run a cyclictest process
+        for each, or None to run a single process for all cpus"""
+        shards = self.__cfg.shards
+        if not shards:
+            return None
+
+        groups = []
+        if str(shards).lower() == 'numa':
+            topology = SysTopology()
+            if max(self.__numanodes, len(topology)) < 2:
+                self._log(Log.INFO, "single NUMA node system, not sharding")
+                return None
+            for node in sorted(topology.getnodes()):
+                cpus = [c for c in self.__cpus if int(c) in topology.getcpus(node)]
+                if cpus:
+                    groups.append((node, cpus))
+        else:
+            # explicit cpu groups, separated by ':'
+            topology = None
+            for group in str(shards).split(':'):
+                cpus = [c for c in expand_cpulist(group) if c in self.__cpus]
+                if cpus:
+                    groups.append((None, cpus))
+            measured = [c for g in groups for c in g[1]]
+            if len(measured) != len(set(measured)) or len(measured) != len(self.__cpus):
+                raise ValueError("cyclictest shards must cover each measured cpu once: %s"
+                                 % shards)
+        for (node, cpus) in groups:
+            cpus.sort(key=int)
+        return groups
 
 
     @staticmethod
@@ -248,7 +1242,7 @@ class Cyclictest(rtevalModulePrototype):
 
 
     def _WorkloadSetup(self):
-        self.__cyclicprocess = None
+        self.__shards = []
 
 
     def _WorkloadBuild(self):
@@ -256,43 +1250,193 @@ class Cyclictest(rtevalModulePrototype):
 
 
     def _WorkloadPrepare(self):
-        self.__interval = 'interval' in self.__cfg and '-i%d' % int(self.__cfg.interval) or ""
-
-        self.__cmd = ['cyclictest',
-                      self.__interval,
-                      '-qmu',
-                      '-h %d' % self.__buckets,
-                      "-p%d" % int(self.__priority),
-                      ]
-        if self.__sparse:
-            self.__cmd.append('-t%d' % self.__numcores)
-            self.__cmd.append('-a%s' % self.__cpulist)
+        self.__interval = self.__cfg.interval and '-i%d' % int(self.__cfg.interval) or ""
+        if self.__calibration and not self.__cfg.interval:
+            self.__interval = '-i%d' % self.__calibration['interval']
+        # cyclictest runs its threads every 1000us unless told otherwise
+        self.__intervalus = self.__interval and int(self.__interval[2:]) or 1000
+
+        # Nothing to do while cyclictest runs, except for the convergence
+        # checks.  An exiting cyclictest process wakes up the task anyway
+        self._setTaskInterval(self.__convergence and 10.0 or None)
+
+        cmd = ['cyclictest',
+               self.__interval,
+               '-qmu',
+               "-p%d" % int(self.__priority),
+               ]
+        if self.__unit == 'ns':
+            cmd.append('--nsecs')
+        if self.__persample:
+            # Every sample is reported and put into the histogram as it
+            # arrives.  With the log scaled histogram nothing is lost above
+            # the cyclictest histogram limit.  Without -h the thread
+            # intervals are spread apart unless the distance is zero
+            cmd.extend(['-v', '-d0'])
         else:
-            self.__cmd.append('-t')
-            self.__cmd.append('-a')
-
-        if 'threads' in self.__cfg and self.__cfg.threads:
-            self.__cmd.append("-t%d" % int(self.__cfg.threads))
-
-        if 'breaktrace' in self.__cfg and self.__cfg.breaktrace:
-            self.__cmd.append("-b%d" % int(self.__cfg.breaktrace))
-            self.__cmd.append("--tracemark")
-            self.__cmd.append("--notrace")
+            cmd.append('-h %d' % self.__buckets)
+
+        opts = []
+        if self.__cfg.threads:
+            opts.append("-t%d" % int(self.__cfg.threads))
+
+        if self.__cfg.breaktrace:
+            opts.append("-b%d" % int(self.__cfg.breaktrace))
+            opts.append("--tracemark")
+            opts.append("--notrace")
+
+        # Each shard is a cyclictest process measuring a group of cpus
+        groups = self.__shardgroups
+        if groups is None:
+            if self.__sparse:
+                cpuargs = ['-t%d' % self.__numcores, '-a%s' % self.__cpulist]
+            else:
+                cpuargs = ['-t', '-a']
+            self.__shards = [{'node': None, 'cpus': self.__cpus,
+                              'cmd': cmd + cpuargs + opts}]
+            self.__check_budget()
+            return
 
-        # Buffer for cyclictest data written to stdout
-        self.__cyclicoutput = tempfile.SpooledTemporaryFile(mode='w+b')
+        numactl = os.path.exists('/usr/bin/numactl')
+        self.__shards = []
+        for (node, cpus) in groups:
+            shardcmd = cmd + ['-t%d' % len(cpus), '-a%s' % compress_cpulist(cpus)] + opts
+            if node is not None and numactl:
+                # keep the memory of the process local to the cpus it measures
+                shardcmd = ['numactl', '--membind=%d' % node] + shardcmd
+            self.__shards.append({'node': node, 'cpus': cpus, 'cmd': shardcmd})
+        self._log(Log.DEBUG, "running %d cyclictest shards" % len(self.__shards))
+        self.__check_budget()
+
+
+    def __check_budget(self):
+        "Warns when a reader thread can't be expected to keep up with the per-sample output"
+        if not self.__persample:
+            return
+        rate = max([len(s['cpus']) for s in self.__shards]) * 1000000 // self.__intervalus
+        if rate > PERSAMPLE_BUDGET:
+            self._log(Log.WARN, "per-sample output of %d samples/s per cyclictest process "
+                      "exceeds the %d samples/s a reader keeps up with, samples will likely "
+                      "be lost; use --cyclictest-shards or a longer --cyclictest-interval"
+                      % (rate, PERSAMPLE_BUDGET))
+
+
+    def Calibrate(self, duration):
+        """Runs cyclictest for --cyclictest-calibrate seconds under the running
+        loads and sizes the histogram after the latencies seen, and the
+        thread interval unless --cyclictest-interval sets it.  Returns the run
+        duration needed to see enough samples beyond the highest reported
+        percentile"""
+        if not self.__cfg.calibrate:
+            return None
+
+        secs = int(self.__cfg.calibrate)
+        interval = int(self.__cfg.interval or 100)
+        if self.__sparse:
+            cpuargs = ['-t%d' % self.__numcores, '-a%s' % self.__cpulist]
+        else:
+            cpuargs = ['-t', '-a']
+        # The calibration histogram is in microseconds whatever the
+        # resolution of the run, with --nsecs it would only cover 100us.
+        # The interval is in microseconds anyway, the latencies recorded are
+        # converted to the resolution of the run
+        cmd = ['cyclictest', '-i%d' % interval, '-qmu', '-p%d' % self.__priority,
+               '-h %d' % CALIBRATION_BUCKETS, '-D%d' % secs] + cpuargs
+        self._log(Log.INFO, "calibrating for %d seconds: %s" % (secs, ' '.join(cmd)))
+        try:
+            out = subprocess.run(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                 stderr=subprocess.DEVNULL, timeout=secs + 30).stdout
+        except (OSError, subprocess.TimeoutExpired) as err:
+            self._log(Log.WARN, "calibration run failed: %s" % str(err))
+            return None
+
+        pmax = max([pct for (label, pct) in self.__percentiles] or [99.0])
+        calib = RunData('calibration', 'system', self.__priority, self._log,
+                        nbuckets=CALIBRATION_BUCKETS,
+                        percentiles=[('99', 99.0), ('max', pmax)])
+        for line in bytes.decode(out, errors='replace').splitlines():
+            vals = line.split(':', 1)
+            if line.startswith('# Histogram Overflows:'):
+                calib.overflow(sum([int(v) for v in vals[1].split()]))
+            elif line.startswith('# Max Latencies:'):
+                calib.limits(maxval=max([int(v) for v in vals[1].split()] or [0]))
+            elif not line.startswith('#') and line.strip():
+                vals = line.split()
+                calib.bucket(int(vals[0]), sum([int(v) for v in vals[1:]]))
+        calib.reduce()
+        stats = calib.statistics()
+        nsamples = stats['samples'] + stats['overflows']
+        if not nsamples:
+            self._log(Log.WARN, "calibration run gave no samples, keeping the configuration")
+            return None
+        p99 = stats['percentiles']['99']
+        maxlat = stats['max']
+
+        # Leave room for a tail four times longer than the one seen in the
+        # short calibration run.  Beyond the linear limit the log scaled
+        # histogram is used, which costs per-sample output but loses nothing
+        histtype = self.__histtype
+        buckets = self.__buckets
+        if histtype == 'linear':
+            buckets = max(100, int(math.ceil(maxlat * 4 / 100.0)) * 100)
+            if buckets > CALIBRATION_MAXLINEAR:
+                histtype = 'log'
+                self.__layout = LogBuckets()
+                self.__persample = True
+            self.__histtype = histtype
+            self.__buckets = buckets
+
+        # Threads which overrun their period most of the time measure the
+        # backlog, not the latency
+        calibrated = interval
+        while p99 > calibrated / 2:
+            calibrated *= 2
+        if not self.__cfg.interval:
+            interval = calibrated
+        elif calibrated != interval:
+            self._log(Log.INFO, "calibration suggests an interval of %dus, keeping the "
+                      "configured %dus" % (calibrated, interval))
+
+        # The histograms are still empty, recreate them with the new layout
+        for core in list(self.__cpus) + ['system']:
+            description = self.__cyclicdata[core].description
+            self.__cyclicdata[core] = self.__new_rundata(core, core == 'system' and 'system' or 'core')
+            self.__cyclicdata[core].description = description
+
+        # To bound the highest percentile, CALIBRATION_TAIL samples per core
+        # must land above it
+        rate = nsamples / float(self.__numcores * secs)
+        needed = CALIBRATION_TAIL / (1.0 - min(pmax, 99.9999999) / 100.0) / rate
+        needed = int(math.ceil(max(needed, CALIBRATION_MINRUN)))
+        self.__calibration = {'duration': secs, 'samples': nsamples,
+                              'p99': p99 * self.__scale, 'max': maxlat * self.__scale,
+                              'unit': self.__unit, 'histogram': histtype,
+                              'buckets': buckets, 'interval': interval,
+                              'needed': needed, 'runtime': int(duration),
+                              'sufficient': needed <= duration and 'yes' or 'no'}
+        self._log(Log.INFO, "calibration: p99 %dus, max %dus; using %s histogram "
+                  "(%d buckets), interval %dus; %d seconds needed for the %s percentile"
+                  % (p99, maxlat, histtype, buckets, interval, needed, str(pmax)))
+        if needed > duration:
+            self._log(Log.WARN, "the run duration of %d seconds is too short to bound the %s "
+                      "percentile, %d seconds are needed; the reported value is not reliable"
+                      % (duration, str(pmax), needed))
+
+        self._WorkloadPrepare()
+        return needed
 
 
     def _WorkloadTask(self):
         if self.__started:
             # Don't restart cyclictest if it is already runing
+            if self.__convergence and self.__convergetime is None:
+                self.__check_convergence()
             return
 
-        self._log(Log.DEBUG, "starting with cmd: %s" % " ".join(self.__cmd))
         self.__nullfp = os.open('/dev/null', os.O_RDWR)
 
         debugdir = self.__get_debugfs_mount()
-        if 'breaktrace' in self.__cfg and self.__cfg.breaktrace and debugdir:
+        if self.__cfg.breaktrace and debugdir:
             # Ensure that the trace log is clean
             trace = os.path.join(debugdir, 'tracing', 'trace')
             fp = open(os.path.join(trace), "w")
@@ -300,59 +1444,369 @@ class Cyclictest(rtevalModulePrototype):
             fp.flush()
             fp.close()
 
-        self.__cyclicoutput.seek(0)
+        # the tracer and the events are set up before the spikes can come
+        if self.__tracethreshold:
+            self.__start_tracer(debugdir)
+
         try:
-            self.__cyclicprocess = subprocess.Popen(self.__cmd,
-                                                    stdout=self.__cyclicoutput,
+            for shard in self.__shards:
+                self._log(Log.DEBUG, "starting with cmd: %s" % " ".join(shard['cmd']))
+                shard['process'] = subprocess.Popen(shard['cmd'],
+                                                    stdout=subprocess.PIPE,
                                                     stderr=self.__nullfp,
                                                     stdin=self.__nullfp)
             self.__started = True
         except OSError:
+            # don't leave a partial set of shards running
+            for shard in self.__shards:
+                if shard.get('process'):
+                    shard['process'].kill()
+                    shard['process'].wait()
+                    shard['process'] = None
+            if self.__tracer:
+                self.__tracer.stop()
+                self.__tracer = None
             self.__started = False
+            return
+
+        if self.__rawfile:
+            self.__rawwriter = rawsamples.RawSampleWriter(self.__rawfile)
+
+        # the raw sample file is shared by all the shards
+        self.__rawlock = len(self.__shards) > 1 and self.__spikelock or None
+        # the lowest of the tracing and outlier thresholds, any
+        # sample above it is passed on to __spike()
+        thresholds = [t.threshold for t in (self.__tracer, self.__outliers) if t is not None]
+        self.__spikethreshold = thresholds and min(thresholds) or (1 << 62)
+
+        # Drain the output of each shard from a pipe instead of spooling it.
+        # With -h cyclictest writes its histogram only when it exits, so the
+        # data only arrives while it runs in the per-sample (-v) mode
+        for i, shard in enumerate(self.__shards):
+            shard['reader'] = threading.Thread(target=self.__read_output, args=(shard,),
+                                               name="cyclictest-reader-%d" % i)
+            shard['reader'].daemon = True
+            shard['reader'].start()
+
+        self.__convergestart = time.time()
+
+        if self.__window:
+            self.__windowstart = time.time()
+            self.__windowthread = threading.Thread(target=self.__window_task,
+                                                   name="cyclictest-windows")
+            self.__windowthread.daemon = True
+            self.__windowthread.start()
+
+
+    def __start_tracer(self, debugdir):
+        "Sets up the trace snapshots, the run continues without them on failure"
+        tracedir = debugdir and os.path.join(debugdir, 'tracing') or '/sys/kernel/tracing'
+        if not os.path.exists(os.path.join(tracedir, 'snapshot')):
+            self._log(Log.WARN, "no ftrace snapshot support found, not capturing traces")
+            return
+        housekeeping = [int(c) for c in online_cpus() if c not in self.__cpus]
+        tracer = SnapshotTracer(tracedir,
+                                os.path.join(self.__cfg.reportdir or os.getcwd(), 'trace'),
+                                self.__tracethreshold * self.__scale, housekeeping, self._log,
+                                maxcaptures=int(self.__cfg.setdefault('tracemax', 20)),
+                                unit=self.__unit, tracer=self.__cfg.tracer,
+                                events=[e.strip() for e in
+                                        str(self.__cfg.traceevents or '').split(',') if e.strip()])
+        try:
+            tracer.start()
+        except (IOError, OSError) as err:
+            self._log(Log.WARN, "failed to set up ftrace snapshots: %s" % err)
+            return
+        self.__tracer = tracer
+
+
+    def __check_convergence(self):
+        """Checks if the confidence intervals of the tracked percentiles
+        of the system histogram have become narrow enough"""
+        now = time.time()
+        if now - self.__convergestart < self.__convergemin:
+            return
+        if self.__convergecheck and now < self.__convergecheck:
+            return
+        # Summing up the histograms is cheap, but there's no need to do it
+        # every time we're called
+        self.__convergecheck = now + 10
+
+        live = self.__new_rundata('system', 'system')
+        for core in self.__cpus:
+            live += self.__cyclicdata[core]
+
+        bounds = []
+        converged = True
+        for (label, pct) in self.__convergepct:
+            ci = live.confidence(pct)
+            if ci is None:
+                return
+            (lower, estimate, upper) = ci
+            bounds.append((label, lower, estimate, upper))
+            if upper - lower > max(self.__convergence * estimate, self.__scale):
+                converged = False
+        self.__bounds = bounds
+        if converged:
+            self.__convergetime = now - self.__convergestart
+            self._log(Log.INFO, "latency percentiles converged after %d seconds"
+                      % self.__convergetime)
+            self._setConverged()
+
+
+    def __window_task(self):
+        "Closes a time window each time the window length has passed"
+        while not self.__windowstop.wait(self.__window):
+            self.__close_window()
+
+
+    def __close_window(self):
+        "Records per window statistics for all cores and for the system"
+        system = self.__cyclicdata['system']
+        for core in self.__cpus:
+            system.merge_window(*self.__cyclicdata[core].window())
+        system.window()
+        self.__windowcount += 1
+
+
+    def __read_output(self, shard):
+        """Reader thread, feeds the RunData objects of the cpus of a shard
+        from the output pipe of its cyclictest process.  In the histogram
+        mode this only receives the histogram at the end of the run, in the
+        per-sample mode each sample as it is measured.  The output is read
+        in blocks, with NumPy the samples of a block are parsed and put into
+        the histograms in one go"""
+        shard['cores'] = [self.__cyclicdata[c] for c in shard['cpus']]
+        shard['cpuids'] = [int(c) for c in shard['cpus']]
+        # per cyclictest thread: [first cycle, when it was read, last cycle,
+        # samples read since the last backlog check]
+        shard['track'] = {}
+        shard['badlines'] = 0
+        pipe = shard['process'].stdout
+        rest = b''
+        while True:
+            data = pipe.read1(READ_BLOCKSIZE)
+            if not data:
+                break
+            data = rest + data
+            end = data.rfind(b'\n') + 1
+            (block, rest) = (data[:end], data[end:])
+            try:
+                done = numpy is not None and self.__persample and b'#' not in block \
+                    and self.__feed_block(block, shard)
+            except Exception as err:
+                # part of the block may be in the histograms already
+                self._log(Log.WARN, "skipped a block of cyclictest output: %s" % err)
+                done = True
+            if not done:
+                for line in block.splitlines():
+                    self.__feed_line_safely(line, shard)
+            self.__check_backlog(shard)
+        if rest:
+            self.__feed_line_safely(rest, shard)
+        pipe.close()
+        if shard['badlines']:
+            self._log(Log.WARN, "skipped %d lines of cyclictest output which could not be parsed"
+                      % shard['badlines'])
+
+
+    def __feed_block(self, block, shard):
+        """Puts a block of per-sample output lines ("thread:cycle:latency")
+        into the histograms.  Returns False if the block can't be parsed"""
+        try:
+            vals = numpy.fromstring(block.replace(b':', b' '), dtype=numpy.int64, sep=' ')
+        except ValueError:
+            return False
+        if len(vals) % 3:
+            return False
+        vals = vals.reshape(-1, 3)
+        threads = [int(thr) for thr in numpy.unique(vals[:, 0])]
+        if not all([0 <= thr < len(shard['cores']) for thr in threads]):
+            return False
+        for thr in threads:
+            sel = vals[vals[:, 0] == thr]
+            (cycles, latencies) = (sel[:, 1], sel[:, 2])
+            cpu = shard['cpuids'][thr]
+            self.__track(shard, thr, int(cycles[0]), int(cycles[-1]), len(cycles))
+            shard['cores'][thr].samples(latencies)
+            if self.__rawwriter is not None:
+                if self.__rawlock:
+                    with self.__rawlock:
+                        self.__rawwriter.extend(cpu, cycles, latencies)
+                else:
+                    self.__rawwriter.extend(cpu, cycles, latencies)
+            for i in numpy.flatnonzero(latencies > self.__spikethreshold):
+                self.__spike(cpu, int(cycles[i]), int(latencies[i]))
+        return True
+
+
+    def __feed_line(self, line, shard):
+        "Parses a single line of output, a sample or a histogram line"
+        if line[:1] == b' ' and b':' in line:
+            # Per sample output (-v): "thread:cycle:latency"
+            try:
+                (thr, cycle, latency) = line.split(b':')
+                thr = int(thr)
+                cycle = int(cycle)
+                latency = int(latency)
+                cpu = shard['cpuids'][thr]
+                self.__track(shard, thr, cycle, cycle, 1)
+                shard['cores'][thr].sample(latency)
+                if self.__rawwriter is not None:
+                    if self.__rawlock:
+                        with self.__rawlock:
+                            self.__rawwriter.append(cpu, cycle, latency)
+                    else:
+                        self.__rawwriter.append(cpu, cycle, latency)
+                if latency > self.__spikethreshold:
+                    self.__spike(cpu, cycle, latency)
+                return
+            except (ValueError, IndexError):
+                pass
+        self.__parse_line(bytes.decode(line, errors='replace'), shard['cpus'])
+
+
+    def __feed_line_safely(self, line, shard):
+        """Feeds a line, a line which can't be parsed is logged and skipped.
+        The reader must go on, or nothing drains the pipe and cyclictest
+        blocks writing to it"""
+        try:
+            self.__feed_line(line, shard)
+        except Exception as err:
+            if not shard['badlines']:
+                self._log(Log.WARN, "can't parse cyclictest output %r: %s" % (line[:80], err))
+            shard['badlines'] += 1
+
+
+    @staticmethod
+    def __track(shard, thr, first, last, count):
+        """Follows the cycle numbers of a thread, samples missing from the
+        sequence are counted as lost"""
+        t = shard['track'].get(thr)
+        if t is None:
+            shard['track'][thr] = [first, time.monotonic(), last, count]
+            return
+        gap = last - t[2] - count
+        if gap > 0:
+            shard['cores'][thr].lost(gap)
+        t[2] = last
+        t[3] += count
+
+
+    def __check_backlog(self, shard):
+        """cyclictest does not notice when the reader falls so far behind
+        that the samples it has not printed yet are overwritten, the cycle
+        numbers stay contiguous.  The number of cycles a thread has run is
+        known from the time passed, samples read while the reader is more
+        than VALBUF_SIZE cycles behind are counted as lost"""
+        now = time.monotonic()
+        rate = 1000000.0 / self.__intervalus
+        for (thr, t) in list(shard['track'].items()):
+            backlog = int((now - t[1]) * rate) - (t[2] - t[0])
+            lost = backlog > VALBUF_SIZE and t[3] or 0
+            if lost and not shard.get('lagging'):
+                shard['lagging'] = True
+                self._log(Log.WARN, "reader is %d samples behind cyclictest on cpu %d, "
+                          "samples are being lost" % (backlog, shard['cpuids'][thr]))
+            shard['cores'][thr].lost(lost, backlog)
+            t[3] = 0
+
+
+    def __spike(self, cpu, sampleseq, latency):
+        "Handles a sample above the tracing or outlier threshold"
+        if self.__outliers is not None and latency > self.__outliers.threshold:
+            with self.__spikelock:
+                self.__outliers.add(cpu, latency)
+        if self.__tracer and latency > self.__tracer.threshold:
+            self.__tracer.trigger(cpu, sampleseq, latency)
+
+
+    def __parse_line(self, line, cpus):
+        "Parses a single line of the output of the cyclictest measuring cpus"
+        if line.startswith('#'):
+            # Catch if cyclictest stopped due to a breaktrace
+            if line.startswith('# Break value: '):
+                self.__breaktraceval = int(line.split(':')[1])
+            # The histogram trailer has the per thread values which
+            # did not fit into the histogram
+            elif line.startswith('# Histogram Overflows:'):
+                for cpu, val in self.__trailer_values(line, cpus):
+                    self.__cyclicdata[cpu].overflow(val)
+            elif line.startswith('# Min Latencies:'):
+                for cpu, val in self.__trailer_values(line, cpus):
+                    self.__cyclicdata[cpu].limits(minval=val)
+            elif line.startswith('# Max Latencies:'):
+                for cpu, val in self.__trailer_values(line, cpus):
+                    self.__cyclicdata[cpu].limits(maxval=val)
+            return
+
+        vals = line.split()
+        if not vals:
+            # If we don't have any values, don't try parsing
+            return
+
+        try:
+            index = int(vals[0])
+        except ValueError:
+            self._log(Log.DEBUG, "cyclictest: unexpected output: %s" % line)
+            return
+
+        for i, core in enumerate(cpus):
+            self.__cyclicdata[core].bucket(index, int(vals[i+1]))
+
+
+    def _WorkloadChildren(self):
+        if self.__started:
+            return [shard['process'] for shard in self.__shards]
+        return []
 
 
     def WorkloadAlive(self):
         if self.__started:
-            return self.__cyclicprocess.poll() is None
+            for shard in self.__shards:
+                if shard['process'].poll() is not None:
+                    return False
+            return True
         return False
 
 
     def _WorkloadCleanup(self):
         if not self.__started:
             return
-        while self.__cyclicprocess.poll() is None:
-            self._log(Log.DEBUG, "Sending SIGINT")
-            os.kill(self.__cyclicprocess.pid, signal.SIGINT)
-            time.sleep(2)
-
-        # now parse the histogram output
-        self.__cyclicoutput.seek(0)
-        for line in self.__cyclicoutput:
-            line = bytes.decode(line)
-            if line.startswith('#'):
-                # Catch if cyclictest stopped due to a breaktrace
-                if line.startswith('# Break value: '):
-                    self.__breaktraceval = int(line.split(':')[1])
-                continue
-
-            # Skipping blank lines
-            if not line:
-                continue
-
-            vals = line.split()
-            if not vals:
-                # If we don't have any values, don't try parsing
-                continue
-
-            try:
-                index = int(vals[0])
-            except:
-                self._log(Log.DEBUG, "cyclictest: unexpected output: %s" % line)
-                continue
 
-            for i, core in enumerate(self.__cpus):
-                self.__cyclicdata[core].bucket(index, int(vals[i+1]))
-                self.__cyclicdata['system'].bucket(index, int(vals[i+1]))
+        if self.__windowthread:
+            self.__windowstop.set()
+            self.__windowthread.join()
+            self.__windowthread = None
+            # the last window is most likely shorter than the others
+            self.__lastwindow = (time.time() - self.__windowstart) \
+                - self.__windowcount * self.__window
+
+        for shard in self.__shards:
+            while shard['process'].poll() is None:
+                self._log(Log.DEBUG, "Sending SIGINT")
+                os.kill(shard['process'].pid, signal.SIGINT)
+                try:
+                    shard['process'].wait(timeout=2)
+                except subprocess.TimeoutExpired:
+                    pass
+
+        # wait for the readers to consume the rest of the output
+        for shard in self.__shards:
+            shard['reader'].join()
+            shard['reader'] = None
+        if self.__rawwriter:
+            self.__rawwriter.close()
+        if self.__tracer:
+            self.__tracer.stop()
+
+        if self.__lastwindow is not None:
+            # samples read after the stop belong to the last window
+            self.__close_window()
+
+        # the system histogram is the sum of all the per core histograms
+        for core in self.__cpus:
+            self.__cyclicdata['system'] += self.__cyclicdata[core]
 
         # generate statistics for each RunData object
         for n in list(self.__cyclicdata.keys()):
@@ -368,7 +1822,14 @@ class Cyclictest(rtevalModulePrototype):
 
     def MakeReport(self):
         rep_n = libxml2.newNode('cyclictest')
-        rep_n.newProp('command_line', ' '.join(self.__cmd))
+        rep_n.newProp('command_line', ' ; '.join([' '.join(s['cmd']) for s in self.__shards]))
+        if len(self.__shards) > 1:
+            shards_n = rep_n.newChild(None, 'shards', None)
+            for shard in self.__shards:
+                s_n = shards_n.newChild(None, 'shard', None)
+                if shard['node'] is not None:
+                    s_n.newProp('node', str(shard['node']))
+                s_n.newProp('cpus', compress_cpulist(shard['cpus']))
 
         # If it was detected cyclictest was aborted somehow,
         # report the reason
@@ -385,15 +1846,158 @@ class Cyclictest(rtevalModulePrototype):
         if abrt:
             rep_n.addChild(abrt_n)
 
-        rep_n.addChild(self.__cyclicdata["system"].MakeReport())
+        # Describes the time windows of the <timeseries/> data
+        if self.__windowcount:
+            win_n = rep_n.newChild(None, 'windows', None)
+            win_n.newProp('length', str(self.__window))
+            win_n.newProp('count', str(self.__windowcount))
+            win_n.newProp('start', str(datetime.fromtimestamp(self.__windowstart)))
+            win_n.newProp('last_length', "%.3f" % self.__lastwindow)
+
+        # Where to find the raw samples, see rteval.rawsamples
+        if self.__rawwriter:
+            raw_n = rep_n.newChild(None, 'rawdata', None)
+            raw_n.newProp('file', os.path.basename(self.__rawfile))
+            raw_n.newProp('format', rawsamples.RECORD_FORMAT)
+            raw_n.newProp('fields', ','.join(rawsamples.RECORD_FIELDS))
+            raw_n.newProp('samples', str(self.__rawwriter.records))
+            raw_n.newProp('unit', self.__unit)
+
+        if self.__tracer:
+            rep_n.addChild(self.__tracer.MakeReport())
+
+        if self.__outliers is not None:
+            rep_n.addChild(self.__outliers.MakeReport())
+
+        if self.__calibration:
+            cal_n = rep_n.newChild(None, 'calibration', None)
+            for key in ('duration', 'samples', 'p99', 'max', 'unit', 'histogram',
+                        'buckets', 'interval', 'needed', 'runtime', 'sufficient'):
+                cal_n.newProp(key, str(self.__calibration[key]))
+
+        if self.__convergence:
+            conv_n = rep_n.newChild(None, 'convergence', None)
+            conv_n.newProp('target', str(self.__convergence))
+            conv_n.newProp('converged', self.__convergetime is not None and 'yes' or 'no')
+            if self.__convergetime is not None:
+                conv_n.newProp('time', "%.0f" % self.__convergetime)
+            for (label, lower, estimate, upper) in self.__bounds:
+                n = conv_n.newChild(None, 'percentile', str(estimate))
+                n.newProp('p', label)
+                n.newProp('lower', str(lower))
+                n.newProp('upper', str(upper))
+                n.newProp('unit', self.__unit)
+
+        rep_n.addChild(self.__cyclicdata["system"].MakeReport(self.__compact))
         for thr in self.__cpus:
             if str(thr) not in self.__cyclicdata:
                 continue
-            rep_n.addChild(self.__cyclicdata[str(thr)].MakeReport())
+            rep_n.addChild(self.__cyclicdata[str(thr)].MakeReport(self.__compact))
 
         return rep_n
 
 
+def histograms_from_report(fname):
+    """Reads the cyclictest histograms from a summary.xml report or a report
+    tarball.  Returns a dictionary with 'system' and the core ids as keys,
+    holding plain Python types only so it can be passed between processes"""
+    if fname.endswith('.tar.bz2'):
+        import tarfile
+        tar = tarfile.open(fname)
+        members = [m for m in tar.getnames() if m.endswith('summary.xml')]
+        if not members:
+            tar.close()
+            raise RuntimeError("No summary.xml found in tar archive %s" % fname)
+        xmldoc = lxml.etree.parse(tar.extractfile(members[0]))
+        tar.close()
+    else:
+        xmldoc = lxml.etree.parse(fname)
+
+    ret = {}
+    for node in xmldoc.xpath('/rteval/Measurements/Profile/cyclictest/*[self::system or self::core]'):
+        hist = node.find('histogram')
+        stats = node.find('statistics')
+        if hist is None or stats is None:
+            continue
+        data = {'type': node.tag,
+                'priority': int(node.get('priority', 95)),
+                'layout': hist.get('type', 'linear'),
+                'nbuckets': int(hist.get('nbuckets', 0)),
+                'precision': int(hist.get('precision', 0)),
+                'maxvalue': int(hist.get('maxvalue', 1 << 24)),
+                # reports from before nanosecond support are in microseconds
+                'unit': hist.get('unit', 'us'),
+                'buckets': hist.get('encoding') and \
+                    decode_histogram(hist.text, hist.get('encoding'), hist.get('schema')) or \
+                    [(int(b.get('index')), int(b.get('value'))) for b in hist.iter('bucket')],
+                'overflows': int(stats.findtext('overflows', 0)),
+                'minimum': stats.findtext('minimum'),
+                'maximum': stats.findtext('maximum')}
+        for k in ('minimum', 'maximum'):
+            if data[k] is not None:
+                data[k] = int(float(data[k]))
+        ret[node.tag == 'system' and 'system' or node.get('id')] = data
+    return ret
+
+
+def AggregateReports(fnames, logfnc, percentiles=None, processes=None):
+    """Combines the cyclictest histograms of several reports into one
+    statistics report.  The reports are loaded in parallel by a pool of
+    worker processes.  Returns a <cyclictest_aggregate/> node"""
+    import multiprocessing
+
+    nproc = min(len(fnames), processes or os.cpu_count() or 1)
+    if nproc > 1:
+        pool = multiprocessing.Pool(nproc)
+        try:
+            reports = pool.map(histograms_from_report, fnames)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        reports = [histograms_from_report(f) for f in fnames]
+
+    # All reports must share one layout, the widest linear histogram
+    # unless any of them used log scaled buckets
+    hists = [h for r in reports for h in list(r.values())]
+    units = set([h['unit'] for h in hists]) or set(['us'])
+    if len(units) > 1:
+        raise ValueError("can't aggregate reports with different latency units (%s)"
+                         % ', '.join(sorted(units)))
+    unit = units.pop()
+    logprec = [h['precision'] for h in hists if h['layout'] == 'log']
+    if logprec:
+        layout = LogBuckets(precision=min(logprec),
+                            maxvalue=max([h['maxvalue'] for h in hists if h['layout'] == 'log']))
+    else:
+        layout = LinearBuckets(max([h['nbuckets'] for h in hists] + [1]))
+
+    pctdefs = parse_percentiles(percentiles)
+    combined = {}
+    for report in reports:
+        for key, h in list(report.items()):
+            if key not in combined:
+                combined[key] = RunData(key, h['type'], h['priority'], logfnc,
+                                        percentiles=pctdefs, layout=layout, unit=unit)
+            rd = combined[key]
+            for (index, value) in h['buckets']:
+                rd.bucket(index, value)
+            rd.overflow(h['overflows'])
+            rd.limits(h['minimum'], h['maximum'])
+
+    rep_n = libxml2.newNode('cyclictest_aggregate')
+    rep_n.newProp('reports', str(len(fnames)))
+    for f in fnames:
+        f_n = rep_n.newChild(None, 'report', None)
+        f_n.newProp('file', f)
+
+    for key in ['system'] + sorted([k for k in combined if k != 'system'], key=int):
+        if key not in combined:
+            continue
+        combined[key].reduce()
+        rep_n.addChild(combined[key].MakeReport())
+    return rep_n
+
 
 def ModuleInfo():
     return {"parallel": True,
@@ -413,7 +2017,72 @@ def ModuleParameters():
                          "metavar": "PRIO"},
             "breaktrace": {"descr": "Send a break trace command when latency > USEC",
                            "default": None,
-                           "metavar": "USEC"}
+                           "metavar": "USEC"},
+            "percentiles": {"descr": "Comma separated list of latency percentiles to report",
+                            "default": "50,90,99,99.9,99.99,99.999,99.9999",
+                            "metavar": "LIST"},
+            "histogram": {"descr": "Histogram type, 'linear' (1us buckets) or 'log' "
+                                   "(log scaled buckets fed from per-sample output)",
+                          "default": "linear",
+                          "metavar": "TYPE"},
+            "window": {"descr": "Record latency statistics per time window of SECS seconds",
+                       "default": None,
+                       "metavar": "SECS"},
+            "windowpct": {"descr": "Percentiles recorded per time window with --cyclictest-window",
+                          "default": "99,99.9",
+                          "metavar": "LIST"},
+            "rawcapture": {"descr": "Store every sample in a binary FILE in the report directory",
+                           "default": None,
+                           "metavar": "FILE"},
+            "tracethreshold": {"descr": "Save an ftrace snapshot when latency > USEC, "
+                                        "without stopping the run",
+                               "default": None,
+                               "metavar": "USEC"},
+            "tracemax": {"descr": "Maximum number of ftrace snapshots to save",
+                         "default": 20,
+                         "metavar": "NUM"},
+            "tracer": {"descr": "ftrace tracer to use with --cyclictest-tracethreshold",
+                       "default": None,
+                       "metavar": "TRACER"},
+            "traceevents": {"descr": "Comma separated ftrace events to enable with "
+                                     "--cyclictest-tracethreshold",
+                            "default": "sched:sched_switch,sched:sched_wakeup,sched:sched_waking,"
+                                       "irq:irq_handler_entry,irq:irq_handler_exit,"
+                                       "irq:softirq_entry,irq:softirq_exit,"
+                                       "timer:hrtimer_expire_entry,timer:hrtimer_expire_exit",
+                            "metavar": "LIST"},
+            "outliers": {"descr": "Log the time and cpu of each sample with latency > USEC",
+                         "default": None,
+                         "metavar": "USEC"},
+            "outliermax": {"descr": "Number of most recent outliers kept in the log",
+                           "default": 1000,
+                           "metavar": "NUM"},
+            "shards": {"descr": "Run one cyclictest per NUMA node ('numa') or per cpu group "
+                                "(groups separated by ':', e.g. 0-7:8-15)",
+                       "default": None,
+                       "metavar": "SHARDS"},
+            "convergence": {"descr": "Stop the run once the 95% confidence intervals of the "
+                                     "tracked percentiles are narrower than FRAC of their value",
+                            "default": None,
+                            "metavar": "FRAC"},
+            "convergepct": {"descr": "Percentiles tracked by --cyclictest-convergence",
+                            "default": "99.9,99.99",
+                            "metavar": "LIST"},
+            "convergemin": {"descr": "Minimum run time in seconds with --cyclictest-convergence",
+                            "default": 600,
+                            "metavar": "SECS"},
+            "resolution": {"descr": "Latency resolution, 'us' or 'ns' (cyclictest --nsecs, "
+                                    "always uses the log histogram)",
+                           "default": "us",
+                           "metavar": "UNIT"},
+            "calibrate": {"descr": "Run cyclictest for SECS seconds under load first to size "
+                                   "the histogram, the interval and the run duration",
+                          "default": None,
+                          "metavar": "SECS"},
+            "histencoding": {"descr": "Histogram encoding in the report, 'xml' (one element "
+                                      "per bucket) or 'compact' (packed base64 data)",
+                             "default": "xml",
+                             "metavar": "ENC"}
             }
 
 
@@ -422,6 +2091,207 @@ def create(params, logger):
     return Cyclictest(params, logger)
 
 
+def unit_test(rootdir):
+    import random
+    import statistics
+
+    def nolog(logtype, msg):
+        pass
+
+    try:
+        data = [int(random.expovariate(0.1)) % 200 for i in range(10001)]
+        rd = RunData(0, 'core', 95, nolog, nbuckets=200,
+                     percentiles=[('50', 50.0), ('99.9', 99.9)])
+        for v in data:
+            rd.sample(v)
+        rd.reduce()
+
+        kept = list(data)
+        expect = {'median': statistics.median(kept),
+                  'mean': statistics.mean(kept),
+                  'stddev': statistics.stdev(kept),
+                  'min': min(kept),
+                  'max': max(kept)}
+        failed = 0
+        for k, v in list(expect.items()):
+            got = getattr(rd, '_RunData__%s' % k)
+            ok = abs(got - v) < 1e-6
+            print("%-8s expected: %-20s got: %-20s %s" % (k, v, got, ok and "OK" or "FAILED"))
+            failed += not ok
+
+        kept.sort()
+        for (label, value) in getattr(rd, '_RunData__percentiles'):
+            expected = kept[int(math.ceil(float(label) * len(kept) / 100.0)) - 1]
+            ok = value == expected
+            print("p%-7s expected: %-20s got: %-20s %s" % (label, expected, value,
+                                                          ok and "OK" or "FAILED"))
+            failed += not ok
+
+        (lower, estimate, upper) = rd.confidence(99.9)
+        if not lower <= estimate <= upper or estimate != dict(getattr(rd, '_RunData__percentiles'))['99.9'] \
+           or rd.confidence(99.999) is not None:
+            print("percentile confidence interval FAILED")
+            failed += 1
+
+        # the overflows rank above the histogram
+        over = RunData(0, 'core', 95, nolog, nbuckets=100,
+                       percentiles=[('99', 99.0), ('99.9', 99.9)])
+        for v in range(990):
+            over.bucket(v % 100, 1)
+        over.overflow(10)
+        over.limits(0, 5000)
+        over.reduce()
+        pcts = over.statistics()['percentiles']
+        print("percentiles with overflows: %s" % pcts)
+        if pcts != {'99': 99, '99.9': 5000} or getattr(over, '_RunData__pctoverflows') != {'99.9'}:
+            print("percentiles with overflows FAILED")
+            failed += 1
+
+        layout = LogBuckets(precision=4, maxvalue=100000)
+        for v in list(range(0, 2048)) + [99999]:
+            idx = layout.index(v)
+            if not layout.lower(idx) <= v <= layout.upper(idx):
+                print("log bucket layout FAILED for %d (bucket %d)" % (v, idx))
+                failed += 1
+                break
+
+        if numpy is not None:
+            values = numpy.array(list(range(0, 2048)) + [99999, 100000, -1], dtype=numpy.int64)
+            if list(layout.indices(values)) != [layout.index(int(v)) for v in values]:
+                print("vectorised log bucket layout FAILED")
+                failed += 1
+            batch = RunData(0, 'core', 95, nolog, nbuckets=200,
+                            percentiles=[('50', 50.0), ('99.9', 99.9)])
+            batch.samples(numpy.array(data, dtype=numpy.int64))
+            batch.reduce()
+            if batch.statistics() != rd.statistics():
+                print("batched samples FAILED: %s" % batch.statistics())
+                failed += 1
+
+        windowed = RunData(0, 'core', 95, nolog, nbuckets=200, windows=True)
+        syswin = RunData('system', 'system', 95, nolog, nbuckets=200, windows=True)
+        for part in (data[:5000], [], data[5000:]):
+            for v in part:
+                windowed.sample(v)
+            syswin.merge_window(*windowed.window())
+            syswin.window()
+        part = sorted(data[5000:])
+        expected = (len(part), max(part), part[int(math.ceil(0.99 * len(part))) - 1],
+                    part[int(math.ceil(0.999 * len(part))) - 1])
+        for wins in (getattr(windowed, '_RunData__windows'), getattr(syswin, '_RunData__windows')):
+            (count, mean, maxval, p99, p999) = wins[2]
+            if len(wins) != 3 or wins[1][0] != 0 or (count, maxval, p99, p999) != expected \
+               or abs(mean - statistics.mean(part)) > 1e-6:
+                print("time window statistics FAILED: %s" % wins)
+                failed += 1
+
+        windowed = RunData(0, 'core', 95, nolog, nbuckets=200, windows=True,
+                           windowpcts=parse_percentiles('50,99.99'))
+        for v in part:
+            windowed.sample(v)
+        windowed.window()
+        wins = getattr(windowed, '_RunData__windows')
+        if wins[0][3:] != (part[int(math.ceil(0.5 * len(part))) - 1],
+                           part[int(math.ceil(0.9999 * len(part))) - 1]):
+            print("configured time window percentiles FAILED: %s" % wins)
+            failed += 1
+
+        sysdata = RunData('system', 'system', 95, nolog, nbuckets=200)
+        sysdata += rd
+        sysdata += rd
+        sysdata.reduce()
+        if getattr(sysdata, '_RunData__numsamples') != 2 * len(kept):
+            print("system histogram summing FAILED")
+            failed += 1
+
+        pairs = [(0, 1), (3, 200), (130, 1), (100000, 123456789)]
+        if decode_histogram(encode_histogram(pairs)) != pairs:
+            print("compact histogram encoding FAILED")
+            failed += 1
+
+        both = rd + rd
+        both.reduce()
+        if getattr(both, '_RunData__numsamples') != 2 * len(kept) \
+           or getattr(both, '_RunData__percentiles') != getattr(rd, '_RunData__percentiles'):
+            print("RunData addition FAILED")
+            failed += 1
+
+        nsdata = RunData(0, 'core', 95, nolog, layout=LogBuckets(maxvalue=NSECS_MAXVALUE),
+                         unit='ns')
+        for v in data:
+            nsdata.sample(v * 1000 + 999)
+        nsdata.reduce()
+        nsmax = getattr(nsdata, '_RunData__max')
+        try:
+            nsdata += RunData(0, 'core', 95, nolog, layout=LogBuckets(maxvalue=NSECS_MAXVALUE))
+            mixed = True
+        except ValueError:
+            mixed = False
+        if nsmax != max(kept) * 1000 + 999 or mixed:
+            print("nanosecond histogram FAILED")
+            failed += 1
+
+        log = OutlierLog(50, capacity=4)
+        for i in range(10):
+            log.add(i, 60 + i, stamp=float(i))
+        if [e[1] for e in log.events()] != [6, 7, 8, 9] or len(log) != 4:
+            print("outlier ring buffer FAILED: %s" % log.events())
+            failed += 1
+        log = OutlierLog(50)
+        log.add(0, 60, stamp=0.0)
+        if log.events()[0][0] != 0.0:
+            print("outlier timestamp 0.0 FAILED: %s" % log.events())
+            failed += 1
+
+        # a plain file stands in for the tracefs snapshot file
+        import tempfile
+        tmpdir = tempfile.mkdtemp()
+        open(os.path.join(tmpdir, 'snapshot'), 'w').close()
+        tracer = SnapshotTracer(tmpdir, os.path.join(tmpdir, 'trace'), 50, [], nolog,
+                                maxcaptures=2, holdoff=0)
+        tracer.start()
+        for i in range(5):
+            tracer.trigger(0, i, 60 + i)
+        tracer.stop()
+        captures = getattr(tracer, '_SnapshotTracer__captures')
+        if not 1 <= len(captures) <= 2 or getattr(tracer, '_SnapshotTracer__crossings') != 5:
+            print("trace snapshot capturing FAILED")
+            failed += 1
+
+        # the same with an in-kernel trigger, which fires once
+        for d in ('sched/sched_waking', 'sched/sched_switch', 'synthetic/rteval_latency'):
+            os.makedirs(os.path.join(tmpdir, 'events', d))
+            open(os.path.join(tmpdir, 'events', d, 'trigger'), 'w').close()
+        for (f, value) in (('synthetic_events', ''), ('current_tracer', 'nop\n'),
+                           ('set_event', 'irq:irq_handler_entry\n')):
+            with open(os.path.join(tmpdir, f), 'w') as fp:
+                fp.write(value)
+        tracer = SnapshotTracer(tmpdir, os.path.join(tmpdir, 'ktrace'), 50, [], nolog,
+                                holdoff=0, tracer='function', events=['sched:sched_switch'])
+        tracer.start()
+        with open(os.path.join(tmpdir, 'current_tracer')) as fp:
+            selected = fp.read()
+        with open(os.path.join(tmpdir, 'events', 'synthetic', 'rteval_latency', 'trigger'), 'w') as fp:
+            fp.write('snapshot:count=0 if lat >= 50\n')
+        tracer.trigger(1, 2, 70)
+        tracer.stop()
+        captures = getattr(tracer, '_SnapshotTracer__captures')
+        with open(os.path.join(tmpdir, 'events', 'sched', 'sched_switch', 'trigger')) as fp:
+            switch = fp.read()
+        with open(os.path.join(tmpdir, 'current_tracer')) as fp:
+            restored = fp.read()
+        if selected != 'function' or restored != 'nop' or len(captures) != 1 \
+           or captures[0][5] != 'kernel' or switch.count('onmatch(sched.sched_waking)') != 2 \
+           or switch.count('!hist:') != 1:
+            print("in-kernel trace snapshot FAILED: %s" % captures)
+            failed += 1
+        shutil.rmtree(tmpdir)
+        return failed
+    except Exception as e:
+        print("** EXCEPTION %s" % str(e))
+        return 1
+
+
 if __name__ == '__main__':
     from rteval.rtevalConfig import rtevalConfig
 
@@ -58,6 +58,8 @@ class sysstat(rtevalModulePrototype):
 
 
     def _WorkloadPrepare(self):
+        # sadc is only run from WorkloadAlive(), on the main loop's schedule
+        self._setTaskInterval(None)
         os.mkdir(self.__datadir)
 
 
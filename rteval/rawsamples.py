@@ -0,0 +1,225 @@
+#
+#   rawsamples.py - compact binary storage of raw latency samples
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with this program; if not, write to the Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+#   For the avoidance of doubt the "preferred form" of this code is one which
+#   is in an open unpatent encumbered format. Where cryptographic key signing
+#   forms part of the process of creating an executable the information
+#   including keys needed to generate an equivalently functional executable
+#   are deemed to be part of the source code.
+#
+
+import os
+import sys
+import struct
+
+# NumPy is optional, it is only used to speed up reading the samples
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Each sample is stored as a fixed width little endian record with the
+# same fields as the cyclic_rawdata table: cpu_num, sampleseq, latency
+RECORD_FORMAT = '<IQI'
+RECORD_FIELDS = ('cpu', 'sampleseq', 'latency')
+RECORD = struct.Struct(RECORD_FORMAT)
+
+if numpy is not None:
+    RECORD_DTYPE = numpy.dtype([('cpu', '<u4'), ('sampleseq', '<u8'), ('latency', '<u4')])
+
+
+class RawSampleWriter:
+    "Appends raw samples to a binary file through a fixed size buffer"
+
+    def __init__(self, fname, bufrecords=65536):
+        self.fname = fname
+        self.records = 0
+        self.__fp = open(fname, 'wb')
+        self.__buf = bytearray(RECORD.size * bufrecords)
+        self.__offset = 0
+
+    def append(self, cpu, sampleseq, latency):
+        "Adds a single sample"
+        RECORD.pack_into(self.__buf, self.__offset, cpu, sampleseq, latency)
+        self.__offset += RECORD.size
+        self.records += 1
+        if self.__offset == len(self.__buf):
+            self.flush()
+
+    def extend(self, cpu, sampleseqs, latencies):
+        "Adds the samples of one cpu from NumPy arrays"
+        recs = numpy.empty(len(latencies), dtype=RECORD_DTYPE)
+        recs['cpu'] = cpu
+        recs['sampleseq'] = sampleseqs
+        recs['latency'] = latencies
+        if self.__offset:
+            self.__fp.write(memoryview(self.__buf)[:self.__offset])
+            self.__offset = 0
+        self.__fp.write(recs.tobytes())
+        self.records += len(recs)
+
+    def flush(self):
+        "Writes out all the buffered samples"
+        if self.__offset:
+            self.__fp.write(memoryview(self.__buf)[:self.__offset])
+            self.__offset = 0
+        self.__fp.flush()
+
+    def close(self):
+        if self.__fp is None:
+            return
+        self.flush()
+        self.__fp.close()
+        self.__fp = None
+
+
+class RawSampleFile:
+    """Reads a file written by RawSampleWriter.  The file is processed in
+    chunks, so memory use does not depend on the file size"""
+
+    def __init__(self, fname):
+        self.fname = fname
+        size = os.path.getsize(fname)
+        if size % RECORD.size:
+            raise ValueError("%s: size %d is not a multiple of the %d byte record size"
+                             % (fname, size, RECORD.size))
+        self.__records = size // RECORD.size
+
+    def __len__(self):
+        return self.__records
+
+    def chunks(self, nrecords=1 << 20):
+        """Iterates over the samples in chunks of at most nrecords samples.
+        Each chunk is a NumPy structured array with the fields cpu, sampleseq
+        and latency, or a list of (cpu, sampleseq, latency) tuples if NumPy
+        is not available"""
+        fp = open(self.fname, 'rb')
+        try:
+            for start in range(0, self.__records, nrecords):
+                count = min(nrecords, self.__records - start)
+                data = fp.read(count * RECORD.size)
+                if numpy is not None:
+                    yield numpy.frombuffer(data, dtype=RECORD_DTYPE)
+                else:
+                    yield list(RECORD.iter_unpack(data))
+        finally:
+            fp.close()
+
+    def feed(self, targets):
+        """Feeds all samples into histogram objects.  targets is a dictionary
+        with the cpu number as key, the values must provide the bucket() and
+        limits() methods of RunData.  Samples for other cpus are ignored"""
+        for chunk in self.chunks():
+            if numpy is not None:
+                for cpu in numpy.unique(chunk['cpu']):
+                    if int(cpu) not in targets:
+                        continue
+                    lat = chunk['latency'][chunk['cpu'] == cpu]
+                    tgt = targets[int(cpu)]
+                    tgt.limits(int(lat.min()), int(lat.max()))
+                    # bincount() would allocate a counter for every value
+                    # up to the largest latency, a single spike of seconds
+                    # in nanoseconds takes gigabytes
+                    (values, counts) = numpy.unique(lat, return_counts=True)
+                    for (value, count) in zip(values, counts):
+                        tgt.bucket(int(value), int(count))
+            else:
+                for (cpu, seq, lat) in chunk:
+                    if cpu in targets:
+                        targets[cpu].limits(lat, lat)
+                        targets[cpu].bucket(lat, 1)
+
+    def gaps(self):
+        """Returns a dictionary with the number of samples missing from the
+        sample sequence of each cpu.  Samples can go missing if cyclictest
+        overwrites them before they were read"""
+        first = {}
+        last = {}
+        seen = {}
+        for chunk in self.chunks():
+            if numpy is not None:
+                for cpu in numpy.unique(chunk['cpu']):
+                    seq = chunk['sampleseq'][chunk['cpu'] == cpu]
+                    cpu = int(cpu)
+                    first.setdefault(cpu, int(seq.min()))
+                    last[cpu] = max(last.get(cpu, 0), int(seq.max()))
+                    seen[cpu] = seen.get(cpu, 0) + len(seq)
+            else:
+                for (cpu, seq, lat) in chunk:
+                    first.setdefault(cpu, seq)
+                    last[cpu] = max(last.get(cpu, 0), seq)
+                    seen[cpu] = seen.get(cpu, 0) + 1
+        return dict([(cpu, (last[cpu] - first[cpu] + 1) - seen[cpu]) for cpu in seen])
+
+
+def unit_test(rootdir):
+    import tempfile
+
+    class Histogram:
+        def __init__(self):
+            self.buckets = {}
+            self.minmax = (None, None)
+
+        def bucket(self, index, value):
+            self.buckets[index] = self.buckets.get(index, 0) + value
+
+        def limits(self, minval, maxval):
+            lo, hi = self.minmax
+            self.minmax = (minval if lo is None else min(lo, minval),
+                           maxval if hi is None else max(hi, maxval))
+
+    try:
+        (fd, fname) = tempfile.mkstemp(suffix='.raw')
+        os.close(fd)
+        w = RawSampleWriter(fname, bufrecords=7)
+        expected = {0: {}, 3: {}}
+        for seq in range(1, 101):
+            for cpu in (0, 3):
+                if cpu == 3 and seq == 50:
+                    # simulate a lost sample
+                    continue
+                lat = (seq * (cpu + 1)) % 17
+                w.append(cpu, seq, lat)
+                expected[cpu][lat] = expected[cpu].get(lat, 0) + 1
+        w.close()
+
+        f = RawSampleFile(fname)
+        print("records written: %d, read: %d" % (w.records, len(f)))
+        if len(f) != w.records:
+            return 1
+
+        hists = {0: Histogram(), 3: Histogram()}
+        f.feed(hists)
+        for cpu in (0, 3):
+            if hists[cpu].buckets != expected[cpu]:
+                print("histogram mismatch for cpu %d" % cpu)
+                return 1
+        print("histograms: OK")
+
+        gaps = f.gaps()
+        print("gaps: %s" % gaps)
+        if gaps != {0: 0, 3: 1}:
+            return 1
+        os.unlink(fname)
+        return 0
+    except Exception as e:
+        print("** EXCEPTION %s" % str(e))
+        return 1
+
+
+if __name__ == '__main__':
+    sys.exit(unit_test('..'))
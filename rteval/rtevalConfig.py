@@ -97,6 +97,11 @@ default_config = {
         'xslt_histogram': default_config_search(['rteval_histogram_raw.xsl'], os.path.isfile),
         'report_interval': '600',
         'logging'    : False,
+        'settle_min' : '10',
+        'settle_max' : '300',
+        'settle_tolerance': '0.05',
+        'settle_metrics': 'utilization',
+        'calibrate_shorten': False,
         }
     }
 
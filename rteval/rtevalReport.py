@@ -37,15 +37,15 @@ class rtevalReport:
         self.__annotate = annotate
         self.__start = datetime.now()
         self.__xmlreport = None
+        self.__sysinfo_n = None
+        # (seconds, settled) of the wait for the loads to settle down
+        self._settle_time = None
         self.__reportdir = None
         self.__xmlfname = None
 
 
-    def _report(self, measure_start, xslt_tpl):
-        "Create a screen report, based on a predefined XSLT template"
-
-        if measure_start is None:
-            raise Exception("No measurement runs have been attempted")
+    def __build_report(self, measure_start, measurements_n, sweep_n=None):
+        "Creates an XML report around the given measurement data"
 
         duration = datetime.now() - measure_start
         seconds = duration.seconds
@@ -59,30 +59,58 @@ class rtevalReport:
             seconds -= (minutes * 60)
 
         # Start new XML report
-        self.__xmlreport = xmlout.XMLOut('rteval', self.__version)
-        self.__xmlreport.NewReport()
-
-        self.__xmlreport.openblock('run_info', {'days': duration.days,
-                                                'hours': hours,
-                                                'minutes': minutes,
-                                                'seconds': seconds})
-        self.__xmlreport.taggedvalue('date', self.__start.strftime('%Y-%m-%d'))
-        self.__xmlreport.taggedvalue('time', self.__start.strftime('%H:%M:%S'))
+        xmlreport = xmlout.XMLOut('rteval', self.__version)
+        xmlreport.NewReport()
+
+        xmlreport.openblock('run_info', {'days': duration.days,
+                                         'hours': hours,
+                                         'minutes': minutes,
+                                         'seconds': seconds})
+        xmlreport.taggedvalue('date', self.__start.strftime('%Y-%m-%d'))
+        xmlreport.taggedvalue('time', self.__start.strftime('%H:%M:%S'))
         if self.__annotate:
-            self.__xmlreport.taggedvalue('annotate', self.__annotate)
-        self.__xmlreport.closeblock()
-
-        # Collect and add info about the system
-        self.__xmlreport.AppendXMLnodes(self._sysinfo.MakeReport())
+            xmlreport.taggedvalue('annotate', self.__annotate)
+        if self._settle_time is not None:
+            xmlreport.taggedvalue('settle_time', '%.1f' % self._settle_time[0],
+                                  {'settled': self._settle_time[1] and '1' or '0'})
+        xmlreport.closeblock()
+
+        # Collect and add info about the system, only once when several
+        # reports are written during a sweep.  The collected node is kept
+        # outside of any report, as the reports are freed with their XMLOut
+        # objects, each report gets a copy of it
+        if self.__sysinfo_n is None:
+            self.__sysinfo_n = self._sysinfo.MakeReport()
+        xmlreport.AppendXMLnodes(self.__sysinfo_n.copyNode(1))
 
         # Add load info
-        self.__xmlreport.AppendXMLnodes(self._loadmods.MakeReport())
+        xmlreport.AppendXMLnodes(self._loadmods.MakeReport())
 
         # Add measurement data
-        self.__xmlreport.AppendXMLnodes(self._measuremods.MakeReport())
+        if measurements_n is not None:
+            xmlreport.AppendXMLnodes(measurements_n)
+        if sweep_n is not None:
+            xmlreport.AppendXMLnodes(sweep_n)
 
         # Close the report - prepare for return the result
-        self.__xmlreport.close()
+        xmlreport.close()
+        return xmlreport
+
+
+    def _report(self, measure_start, xslt_tpl, sweep_n=None):
+        """Create a screen report, based on a predefined XSLT template.  After
+        a sweep, sweep_n holds the overview of all the iterations instead of
+        the measurement data"""
+
+        if measure_start is None:
+            raise Exception("No measurement runs have been attempted")
+
+        self.__xmlreport = self.__build_report(measure_start,
+                                               sweep_n is None and self._measuremods.MakeReport() or None,
+                                               sweep_n)
+        # this is the final report, the system info isn't needed anymore
+        self.__sysinfo_n.freeNode()
+        self.__sysinfo_n = None
 
         # Write the XML to the report directory
         if self.__xmlfname is not None:
@@ -93,6 +121,18 @@ class rtevalReport:
         self.__xmlreport.Write("-", xslt_tpl)
 
 
+    def _iteration_report(self, measure_start, measuremods, iteration_n, fname):
+        """Writes the complete XML report of one sweep iteration to fname,
+        iteration_n describes the iteration.  Returns the XMLOut object"""
+
+        if measure_start is None:
+            raise Exception("No measurement runs have been attempted")
+
+        xmlreport = self.__build_report(measure_start, measuremods.MakeReport(), iteration_n)
+        xmlreport.Write(fname, None)
+        return xmlreport
+
+
     def GetXMLreport(self):
         "Retrieves the complete rteval XML report as a libxml2.xmlDoc object"
         return self.__xmlreport.GetXMLdocument()
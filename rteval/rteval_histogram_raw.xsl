@@ -7,7 +7,7 @@
   <!--                       -->
   <xsl:template match="/rteval">
     <!-- Heading -->
-    <xsl:text>core&#09;index&#09;value&#10;</xsl:text>
+    <xsl:text>core&#09;index&#09;value&#09;unit&#10;</xsl:text>
 
     <!-- Extract overall system histogram data -->
     <xsl:apply-templates select="Measurements/Profile/cyclictest/system/histogram/bucket">
@@ -39,6 +39,13 @@
     <xsl:text>&#09;</xsl:text>
 
     <xsl:value-of select="@value"/>
+    <xsl:text>&#09;</xsl:text>
+
+    <!-- Reports without a unit are in microseconds -->
+    <xsl:choose>
+      <xsl:when test="../@unit"><xsl:value-of select="../@unit"/></xsl:when>
+      <xsl:otherwise><xsl:text>us</xsl:text></xsl:otherwise>
+    </xsl:choose>
     <xsl:text>&#10;</xsl:text>
   </xsl:template>
 
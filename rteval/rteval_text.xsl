@@ -19,6 +19,14 @@
     <xsl:value-of select="run_info/@minutes"/><xsl:text>m </xsl:text>
     <xsl:value-of select="run_info/@seconds"/><xsl:text>s</xsl:text>
     <xsl:text>&#10;</xsl:text>
+    <xsl:if test="run_info/settle_time">
+      <xsl:text>   Load settle:  </xsl:text>
+      <xsl:value-of select="run_info/settle_time"/><xsl:text>s</xsl:text>
+      <xsl:if test="run_info/settle_time/@settled = '0'">
+        <xsl:text> (did not settle)</xsl:text>
+      </xsl:if>
+      <xsl:text>&#10;</xsl:text>
+    </xsl:if>
     <xsl:if test="run_info/annotate">
       <xsl:text>   Remarks:      </xsl:text>
       <xsl:value-of select="run_info/annotate"/>
@@ -129,6 +137,30 @@
     <xsl:text>       Load average: </xsl:text>
     <xsl:value-of select="loads/@load_average"/>
     <xsl:text>&#10;</xsl:text>
+    <xsl:if test="loads/controller">
+      <xsl:text>       Load controller: target </xsl:text>
+      <xsl:value-of select="format-number(loads/controller/@target * 100, '0.0')"/>
+      <xsl:text>%, utilization </xsl:text>
+      <xsl:choose>
+        <xsl:when test="loads/controller/@utilization">
+          <xsl:value-of select="format-number(loads/controller/@utilization * 100, '0.0')"/>
+          <xsl:text>%</xsl:text>
+        </xsl:when>
+        <xsl:otherwise>(unknown)</xsl:otherwise>
+      </xsl:choose>
+      <xsl:text>, intensity </xsl:text>
+      <xsl:value-of select="format-number(loads/controller/@intensity, '0.00')"/>
+      <xsl:text> (</xsl:text>
+      <xsl:value-of select="loads/controller/@steps"/>
+      <xsl:text> steps)&#10;</xsl:text>
+    </xsl:if>
+    <xsl:if test="loads/memory_guard/@decisions > 0">
+      <xsl:text>       Memory guard: </xsl:text>
+      <xsl:value-of select="loads/memory_guard/@decisions"/>
+      <xsl:text> decisions, the loads ended at </xsl:text>
+      <xsl:value-of select="format-number(loads/memory_guard/@limit * 100, '0')"/>
+      <xsl:text>% of their size&#10;</xsl:text>
+    </xsl:if>
 
     <xsl:if test="loads/command_line">
       <xsl:text>&#10;</xsl:text>
@@ -143,6 +175,9 @@
 
     <!-- Generate a summary report for all measurement profiles -->
     <xsl:apply-templates select="Measurements/Profile"/>
+
+    <!-- A parameter sweep has the combined results of each combination -->
+    <xsl:apply-templates select="sweep"/>
    <xsl:text>  ===================================================================&#10;</xsl:text>
 </xsl:template>
   <!--                              -->
@@ -158,6 +193,30 @@
     <xsl:choose>
       <xsl:when test="not(@run) or @run = '1'">
 	<xsl:value-of select="."/>
+	<xsl:if test="supervisor">
+	  <xsl:text>&#10;           (restarts: </xsl:text>
+	  <xsl:value-of select="supervisor/@restarts"/>
+	  <xsl:text>, duty cycle: </xsl:text>
+	  <xsl:value-of select="format-number(supervisor/@dutycycle * 100, '0.0')"/>
+	  <xsl:text>%)</xsl:text>
+	</xsl:if>
+	<xsl:if test="usage">
+	  <xsl:text>&#10;           (CPU: </xsl:text>
+	  <xsl:value-of select="format-number(usage/@cpu_utilization * 100, '0.0')"/>
+	  <xsl:text>% on cpus </xsl:text>
+	  <xsl:value-of select="usage/@cpus"/>
+	  <xsl:text>, user </xsl:text>
+	  <xsl:value-of select="usage/@utime"/>
+	  <xsl:text>s, sys </xsl:text>
+	  <xsl:value-of select="usage/@stime"/>
+	  <xsl:text>s, I/O wait </xsl:text>
+	  <xsl:value-of select="usage/@iowait"/>
+	  <xsl:text>s, context switches </xsl:text>
+	  <xsl:value-of select="usage/@voluntary_ctxt_switches"/>
+	  <xsl:text>/</xsl:text>
+	  <xsl:value-of select="usage/@involuntary_ctxt_switches"/>
+	  <xsl:text> vol/invol)</xsl:text>
+	</xsl:if>
       </xsl:when>
       <xsl:otherwise>(Not run)</xsl:otherwise>
     </xsl:choose>
@@ -165,6 +224,43 @@
   </xsl:template>
 
 
+  <!-- Format the overview of a parameter sweep -->
+  <xsl:template match="/rteval/sweep">
+    <xsl:text>   Parameter sweep: </xsl:text>
+    <xsl:value-of select="count(combination)"/>
+    <xsl:text> combinations, repeated </xsl:text>
+    <xsl:value-of select="@repeat"/>
+    <xsl:text> times&#10;</xsl:text>
+    <xsl:apply-templates select="combination"/>
+    <xsl:text>&#10;</xsl:text>
+  </xsl:template>
+
+
+  <xsl:template match="/rteval/sweep/combination">
+    <xsl:text>&#10;     Combination </xsl:text>
+    <xsl:value-of select="@id"/>
+    <xsl:text>:</xsl:text>
+    <xsl:for-each select="setting">
+      <xsl:text> --</xsl:text>
+      <xsl:value-of select="@module"/>
+      <xsl:text>-</xsl:text>
+      <xsl:value-of select="@option"/>
+      <xsl:text>=</xsl:text>
+      <xsl:value-of select="@value"/>
+    </xsl:for-each>
+    <xsl:text>&#10;</xsl:text>
+
+    <xsl:text>          Iterations: </xsl:text>
+    <xsl:value-of select="count(iteration)"/>
+    <xsl:text>&#10;</xsl:text>
+
+    <xsl:if test="cyclictest_aggregate/system">
+      <xsl:text>          Statistics (all iterations): &#10;</xsl:text>
+      <xsl:apply-templates select="cyclictest_aggregate/system/statistics"/>
+    </xsl:if>
+  </xsl:template>
+
+
   <xsl:template match="/rteval/Measurements/Profile">
     <xsl:text>   Measurement profile </xsl:text>
     <xsl:value-of select="position()"/><xsl:text>: </xsl:text>
@@ -210,6 +306,70 @@
 
     <xsl:apply-templates select="abort_report"/>
 
+    <xsl:if test="calibration">
+      <xsl:text>          Calibrated: </xsl:text>
+      <xsl:value-of select="calibration/@histogram"/>
+      <xsl:text> histogram, </xsl:text>
+      <xsl:value-of select="calibration/@buckets"/>
+      <xsl:text> buckets, interval </xsl:text>
+      <xsl:value-of select="calibration/@interval"/>
+      <xsl:text>us (max </xsl:text>
+      <xsl:value-of select="calibration/@max"/>
+      <xsl:value-of select="calibration/@unit"/>
+      <xsl:text> in </xsl:text>
+      <xsl:value-of select="calibration/@duration"/>
+      <xsl:text>s)&#10;</xsl:text>
+      <xsl:if test="calibration/@sufficient = 'no'">
+        <xsl:text>          WARNING: </xsl:text>
+        <xsl:value-of select="calibration/@needed"/>
+        <xsl:text>s needed to bound the highest percentile, the run was </xsl:text>
+        <xsl:value-of select="calibration/@runtime"/>
+        <xsl:text>s&#10;</xsl:text>
+      </xsl:if>
+      <xsl:text>&#10;</xsl:text>
+    </xsl:if>
+
+    <xsl:if test="windows">
+      <xsl:text>          Windows: </xsl:text>
+      <xsl:value-of select="windows/@count"/>
+      <xsl:text> x </xsl:text>
+      <xsl:value-of select="windows/@length"/>
+      <xsl:text>s time series recorded&#10;&#10;</xsl:text>
+    </xsl:if>
+
+    <xsl:if test="tracecaptures">
+      <xsl:text>          Traces:  </xsl:text>
+      <xsl:value-of select="count(tracecaptures/capture)"/>
+      <xsl:text> snapshots of </xsl:text>
+      <xsl:value-of select="tracecaptures/@crossings"/>
+      <xsl:text> samples above </xsl:text>
+      <xsl:value-of select="tracecaptures/@threshold"/>
+      <xsl:value-of select="tracecaptures/@unit"/>
+      <xsl:text>&#10;&#10;</xsl:text>
+    </xsl:if>
+
+    <xsl:if test="convergence">
+      <xsl:text>          Converged: </xsl:text>
+      <xsl:value-of select="convergence/@converged"/>
+      <xsl:if test="convergence/@time">
+        <xsl:text> (after </xsl:text>
+        <xsl:value-of select="convergence/@time"/>
+        <xsl:text>s)</xsl:text>
+      </xsl:if>
+      <xsl:text>&#10;&#10;</xsl:text>
+    </xsl:if>
+
+    <xsl:if test="outliers">
+      <xsl:text>          Outliers: </xsl:text>
+      <xsl:value-of select="outliers/@count"/>
+      <xsl:text> samples above </xsl:text>
+      <xsl:value-of select="outliers/@threshold"/>
+      <xsl:value-of select="outliers/@unit"/>
+      <xsl:text> (</xsl:text>
+      <xsl:value-of select="count(outliers/outlier)"/>
+      <xsl:text> most recent logged)&#10;&#10;</xsl:text>
+    </xsl:if>
+
     <xsl:text>          System:  </xsl:text>
     <xsl:value-of select="system/@description"/>
     <xsl:text>&#10;</xsl:text>
@@ -238,7 +398,7 @@
 
 
   <!-- Generic formatting of statistics information -->
-  <xsl:template match="/rteval/Measurements/Profile/cyclictest/*/statistics">
+  <xsl:template match="/rteval/Measurements/Profile/cyclictest/*/statistics|/rteval/sweep/combination/cyclictest_aggregate/system/statistics">
     <xsl:text>            Samples:           </xsl:text>
     <xsl:value-of select="samples"/>
     <xsl:text>&#10;</xsl:text>
@@ -283,6 +443,29 @@
       <xsl:value-of select="standard_deviation"/>
       <xsl:value-of select="standard_deviation/@unit"/>
       <xsl:text>&#10;</xsl:text>
+
+      <xsl:if test="overflows">
+        <xsl:text>            Overflows:         </xsl:text>
+        <xsl:value-of select="overflows"/>
+        <xsl:text>&#10;</xsl:text>
+      </xsl:if>
+
+      <xsl:if test="lost_samples">
+        <xsl:text>            Lost samples:      </xsl:text>
+        <xsl:value-of select="lost_samples"/>
+        <xsl:text>&#10;</xsl:text>
+      </xsl:if>
+
+      <xsl:for-each select="percentiles/percentile">
+        <xsl:text>            </xsl:text>
+        <xsl:value-of select="substring(concat('P', @p, ':                   '), 1, 19)"/>
+        <xsl:value-of select="."/>
+        <xsl:value-of select="@unit"/>
+        <xsl:if test="@overflow = 'yes'">
+          <xsl:text> (beyond the histogram)</xsl:text>
+        </xsl:if>
+        <xsl:text>&#10;</xsl:text>
+      </xsl:for-each>
     </xsl:if>
     <xsl:text>&#10;</xsl:text>
   </xsl:template>
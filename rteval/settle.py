@@ -0,0 +1,206 @@
+#
+#   settle.py - detect when the loads have settled down
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with this program; if not, write to the Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+#   For the avoidance of doubt the "preferred form" of this code is one which
+#   is in an open unpatent encumbered format. Where cryptographic key signing
+#   forms part of the process of creating an executable the information
+#   including keys needed to generate an equivalently functional executable
+#   are deemed to be part of the source code.
+#
+
+import os
+import sys
+import time
+from rteval.Log import Log
+
+# Load intensity metrics the detector can watch
+SETTLE_METRICS = ('utilization', 'runqueue', 'psi')
+
+
+class SettleDetector:
+    """Waits until the load on the load CPUs has settled down.  Once per
+    interval the metrics are sampled:
+
+        utilization  busy fraction of the load CPUs, from /proc/stat
+        runqueue     runnable tasks per load CPU, from /proc/loadavg
+        psi          fraction of time tasks waited for a CPU, from
+                     /proc/pressure/cpu
+
+    The load has settled when the mean of every metric over the last window
+    of samples is within tolerance of its mean over the window before.
+    Fractions are compared absolutely and the run queue relative to its
+    size, once it is above one task per CPU"""
+
+    def __init__(self, cpulist=None, metrics=('utilization',), tolerance=0.05,
+                 minwait=10.0, maxwait=300.0, interval=1.0, window=5, logger=None):
+        for m in metrics:
+            if m not in SETTLE_METRICS:
+                raise ValueError("unknown settle metric '%s'" % m)
+        self.__cpus = cpulist and set([int(c) for c in cpulist]) or None
+        self.__metrics = list(metrics)
+        self.__tolerance = tolerance
+        self.__minwait = minwait
+        self.__maxwait = max(maxwait, minwait)
+        self.__interval = interval
+        self.__window = window
+        self.__logger = logger
+        self.__laststat = None
+        self.__history = []
+        if 'psi' in self.__metrics and not os.path.exists('/proc/pressure/cpu'):
+            self.__log(Log.WARN, "no PSI support in the kernel, not watching CPU pressure")
+            self.__metrics.remove('psi')
+
+
+    def __log(self, logtype, msg):
+        if self.__logger:
+            self.__logger.log(logtype, "[settle] %s" % msg)
+
+
+    def __read_stat(self):
+        "Returns the busy and total jiffies summed over the load CPUs"
+        busy = total = 0
+        with open('/proc/stat') as f:
+            for line in f:
+                if not line.startswith('cpu') or line.startswith('cpu '):
+                    continue
+                fields = line.split()
+                if self.__cpus is not None and int(fields[0][3:]) not in self.__cpus:
+                    continue
+                # user nice system idle iowait irq softirq steal, the guest
+                # times are already part of user and nice
+                vals = [int(v) for v in fields[1:9]]
+                total += sum(vals)
+                busy += sum(vals) - vals[3] - vals[4]
+        return (busy, total)
+
+
+    def __ncpus(self):
+        if self.__cpus is not None:
+            return len(self.__cpus)
+        return os.cpu_count() or 1
+
+
+    def sample(self):
+        """Reads the current metrics.  Returns a dictionary with a value per
+        metric, or None on the first call which only reads the baseline
+        of the CPU times"""
+        stat = self.__read_stat()
+        last = self.__laststat
+        self.__laststat = stat
+        if last is None:
+            return None
+
+        values = {}
+        if 'utilization' in self.__metrics:
+            total = stat[1] - last[1]
+            values['utilization'] = total and float(stat[0] - last[0]) / total or 0.0
+        if 'runqueue' in self.__metrics:
+            with open('/proc/loadavg') as f:
+                runnable = int(f.read().split()[3].split('/')[0])
+            values['runqueue'] = float(runnable) / self.__ncpus()
+        if 'psi' in self.__metrics:
+            with open('/proc/pressure/cpu') as f:
+                for line in f:
+                    if line.startswith('some'):
+                        avg10 = line.split()[1].split('=')[1]
+                        values['psi'] = float(avg10) / 100.0
+        return values
+
+
+    def add(self, values):
+        "Adds a sample of the metrics, as returned by sample()"
+        self.__history.append(values)
+        del self.__history[:-2 * self.__window]
+
+
+    def settled(self):
+        "Returns True if the metrics are stable within the tolerance"
+        if len(self.__history) < 2 * self.__window:
+            return False
+
+        for m in self.__metrics:
+            prev = sum([s[m] for s in self.__history[:self.__window]]) / self.__window
+            last = sum([s[m] for s in self.__history[self.__window:]]) / self.__window
+            if abs(last - prev) > self.__tolerance * max(prev, last, 1.0):
+                return False
+        return True
+
+
+    def wait(self, stopevent=None):
+        """Samples the metrics until the load has settled, for at least minwait
+        and at most maxwait seconds.  Returns early if stopevent is set.
+        Returns a tuple with the seconds waited and whether the load settled"""
+        start = time.time()
+        self.__laststat = None
+        self.__history = []
+        self.sample()
+        is_settled = False
+        while True:
+            if stopevent is not None:
+                if stopevent.wait(self.__interval):
+                    break
+            else:
+                time.sleep(self.__interval)
+
+            values = self.sample()
+            if values is not None:
+                self.add(values)
+            elapsed = time.time() - start
+            is_settled = self.settled()
+            if is_settled and elapsed >= self.__minwait:
+                self.__log(Log.DEBUG, "load settled after %.1f seconds: %s"
+                           % (elapsed, ", ".join(["%s %.3f" % (m, values[m]) for m in self.__metrics])))
+                break
+            if elapsed >= self.__maxwait:
+                self.__log(Log.WARN, "load did not settle within %.0f seconds" % self.__maxwait)
+                break
+        return (time.time() - start, is_settled)
+
+
+def unit_test(rootdir):
+    try:
+        det = SettleDetector(metrics=('utilization', 'runqueue'), tolerance=0.05, window=3)
+        # a load ramping up, then steady with a little noise
+        ramp = [0.1, 0.3, 0.6, 0.8, 0.9, 0.92, 0.93, 0.91, 0.92, 0.93]
+        results = []
+        for util in ramp:
+            det.add({'utilization': util, 'runqueue': util * 4})
+            results.append(det.settled())
+        print("settled: %s" % results)
+        if results[-1] is not True or True in results[:8]:
+            return 1
+
+        try:
+            SettleDetector(metrics=('loadavg',))
+            return 1
+        except ValueError:
+            pass
+
+        if os.path.exists('/proc/stat'):
+            det = SettleDetector(minwait=0.2, maxwait=0.5, interval=0.1, window=2)
+            (secs, is_settled) = det.wait()
+            print("waited %.2f seconds, settled: %s" % (secs, is_settled))
+            if not 0.2 <= secs < 2.0:
+                return 1
+        return 0
+    except Exception as e:
+        print("** EXCEPTION %s" % str(e))
+        return 1
+
+
+if __name__ == '__main__':
+    sys.exit(unit_test('..'))
@@ -76,6 +76,36 @@ class XMLRPC_API1():
                                               fname.translate(self.fnametrans), idx)
 
 
+    def __expand_histograms(self, xmldoc):
+        """Replaces compact encoded cyclictest histograms with <bucket/> elements,
+        which is what the report parser expects.  The compact format is a list of
+        (index delta, count) pairs as unsigned LEB128 varints, base64 encoded"""
+        for hist in xmldoc.xpathEval('//cyclictest/*/histogram[@encoding]'):
+            if hist.prop('encoding') != 'delta-varint-base64' or hist.prop('schema') != '1':
+                raise Exception("Unsupported histogram encoding: %s (schema %s)"
+                                % (hist.prop('encoding'), hist.prop('schema')))
+            vals = []
+            v = 0
+            shift = 0
+            for b in bytearray(base64.b64decode(hist.getContent())):
+                v |= (b & 0x7f) << shift
+                if b & 0x80:
+                    shift += 7
+                else:
+                    vals.append(v)
+                    v = 0
+                    shift = 0
+            hist.setContent('')
+            hist.unsetProp('encoding')
+            hist.unsetProp('schema')
+            index = 0
+            for i in range(0, len(vals) - 1, 2):
+                index += vals[i]
+                b_n = hist.newChild(None, 'bucket', None)
+                b_n.newProp('index', str(index))
+                b_n.newProp('value', str(vals[i+1]))
+
+
     def Dispatch(self, method, params):
         # Call the method requested
         # FIXME: Improve checking for valid methods
@@ -91,6 +121,7 @@ class XMLRPC_API1():
     def SendReport(self, clientid, xmlbzb64):
         decompr = bz2.BZ2Decompressor()
         xmldoc = libxml2.parseDoc(decompr.decompress(base64.b64decode(xmlbzb64)))
+        self.__expand_histograms(xmldoc)
 
         # Save a copy of the report on the file system
         # Make sure we have a directory to write files into
@@ -123,6 +123,12 @@ if __name__ == '__main__':
             ('rteval/sysinfo','dmi'),
             ('rteval','rtevalConfig'),
             ('rteval','xmlout'),
+            ('rteval','rawsamples'),
+            ('rteval','settle'),
+            ('rteval','cgroup'),
+            ('rteval','extract'),
+            ('rteval/modules','loads'),
+            ('rteval/modules/measurement','cyclictest'),
             ('server','unittest')
             ))
     # Run all tests